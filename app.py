@@ -1,21 +1,70 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import (
+    Flask,
+    Response,
+    render_template,
+    request,
+    redirect,
+    url_for,
+    session,
+    flash,
+)
+from flask.json.provider import DefaultJSONProvider
 from utils.quiz_handler import QuizHandler
 import os
 import json
+import logging
 import secrets
 from datetime import datetime
-from utils.models import Subject, TestHistory, engine, init_db
-from sqlalchemy.orm import sessionmaker
+from utils.models import Subject, TestHistory, UserStats, engine, init_db
+from utils.question import QuestionMapping
+from utils import (
+    analytics,
+    export,
+    fragment_cache,
+    images,
+    jobs,
+    logs,
+    maintenance,
+    metrics,
+    mixed_quiz,
+    query_audit,
+    quiz_pool,
+    search,
+    user_context,
+)
 from functools import wraps
 from sqlalchemy import func
 
+
+class JSONProvider(DefaultJSONProvider):
+    """Serialize compact bank questions (``tojson``, JSON responses) as dicts"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, QuestionMapping):
+            return o.as_dict()
+        return DefaultJSONProvider.default(o)
+
+
+logger = logging.getLogger("app")
+
 app = Flask(__name__)
+app.json = JSONProvider(app)
 app.secret_key = os.urandom(24)
-
-quiz_handler = QuizHandler()
+# Admin pages are disabled unless a token is configured
+app.config["ADMIN_TOKEN"] = os.environ.get("EOS_ADMIN_TOKEN", "")
+logs.init_app(app)
+metrics.init_app(app, engine)
+query_audit.init_app(app, engine)
+user_context.init_app(app)
+quiz_pool.init_app(app)
+jobs.init_app(app)
+fragment_cache.init_app(app)
 
 init_db()
 
+quiz_handler = QuizHandler()
+
 
 def login_required(f):
     @wraps(f)
@@ -27,6 +76,27 @@ def login_required(f):
     return decorated_function
 
 
+def valid_admin_token(given):
+    token = app.config["ADMIN_TOKEN"]
+    return bool(token) and secrets.compare_digest(given.encode(), token.encode())
+
+
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not app.config["ADMIN_TOKEN"]:
+            return "Admin access is disabled", 403
+        given = request.headers.get("X-Admin-Token")
+        if given is not None:
+            if not valid_admin_token(given):
+                return "Forbidden", 403
+        elif not session.get("admin"):
+            return redirect(url_for("admin_login", next=request.full_path))
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 @app.route("/")
 def index():
     if "username" in session:
@@ -46,6 +116,22 @@ def login():
     return render_template("login.html")
 
 
+@app.route("/admin/login", methods=["GET", "POST"])
+def admin_login():
+    if not app.config["ADMIN_TOKEN"]:
+        return "Admin access is disabled", 403
+    next_url = request.args.get("next", "")
+    if not next_url.startswith("/admin/"):
+        next_url = url_for("admin_questions")
+    if request.method == "POST":
+        if not valid_admin_token(request.form.get("token", "")):
+            return render_template("admin_login.html", error="Invalid token"), 403
+
+        session["admin"] = True
+        return redirect(next_url)
+    return render_template("admin_login.html")
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -56,18 +142,33 @@ def logout():
 @login_required
 def dashboard():
     username = session["username"]
-    db = sessionmaker(bind=engine)()
+    db = user_context.current().session
     user = quiz_handler.get_user_progress(username)
-
-    stats = (
-        db.query(
-            func.count(TestHistory.id).label("tests_taken"),
-            (func.avg(TestHistory.score) / 10).label("avg_score"),
-            func.sum(TestHistory.time_taken).label("total_time"),
+    quiz_pool.pool.note_activity(username, session.get("subject", "AIL303m"))
+
+    stats = db.get(UserStats, user.id)
+    stats_key = None
+    if stats is not None:
+        stats_key = ("dashboard-stats", user.id, stats.updated_at)
+        stats = {
+            "tests_taken": stats.tests_taken,
+            "avg_score": stats.score_total / stats.tests_taken / 10
+            if stats.tests_taken
+            else None,
+            "total_time": stats.time_total,
+        }
+    else:
+        stats = (
+            db.query(
+                func.count(TestHistory.id).label("tests_taken"),
+                (func.avg(TestHistory.score) / 10).label("avg_score"),
+                func.sum(TestHistory.time_taken).label("total_time"),
+            )
+            .filter(TestHistory.user_id == user.id)
+            .first()
         )
-        .filter(TestHistory.user_id == user.id)
-        .first()
-    )
+        if stats.tests_taken:
+            jobs.enqueue("rollup_user_stats", user_id=user.id)
 
     active_quiz = None
     if user.active_quiz:
@@ -80,7 +181,12 @@ def dashboard():
         }
 
     return render_template(
-        "dashboard.html", username=username, stats=stats, active_quiz=active_quiz
+        "dashboard.html",
+        username=username,
+        user_id=user.id,
+        stats=stats,
+        stats_key=stats_key,
+        active_quiz=active_quiz,
     )
 
 
@@ -97,24 +203,80 @@ def clear_active_test():
 @login_required
 def history():
     username = session["username"]
-    db = sessionmaker(bind=engine)()
+    db = user_context.current().session
     user = quiz_handler.get_user_progress(username)
-    tests = (
-        db.query(TestHistory)
-        .filter_by(user_id=user.id)
-        .order_by(TestHistory.completed_at.desc())
-        .all()
+    count, last_id = (
+        db.query(func.count(TestHistory.id), func.max(TestHistory.id))
+        .filter(TestHistory.user_id == user.id)
+        .one()
+    )
+
+    def load_tests():
+        tests = (
+            db.query(TestHistory)
+            .filter_by(user_id=user.id)
+            .order_by(TestHistory.completed_at.desc())
+            .all()
+        )
+        # Archived tests are older than every test still in test_history
+        return tests + maintenance.archived_tests(user.id)
+
+    # Archiving changes the count, grading the last id, a regrade the version
+    return render_template(
+        "history.html",
+        tests=fragment_cache.Deferred(load_tests),
+        cache_key=("history", user.id, count, last_id, user.results_version),
+        user_id=user.id,
     )
-    return render_template("history.html", tests=tests)
+
+
+def export_response(username=None):
+    """Stream the question results of the matching tests as CSV or NDJSON"""
+    fmt = request.args.get("format", "csv")
+    if fmt not in export.FORMATS:
+        return f"Unknown format {fmt}", 400
+    subject_code = request.args.get("subject") or None
+    try:
+        filters = export.resolve(
+            username,
+            subject_code,
+            request.args.get("since") or None,
+            request.args.get("until") or None,
+        )
+    except ValueError as e:
+        return str(e), 400
+
+    name = "-".join(part for part in ("history", username, subject_code) if part)
+    return Response(
+        export.stream(filters, fmt),
+        mimetype=export.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'},
+    )
+
+
+@app.route("/export")
+@login_required
+def export_history():
+    username = session["username"]
+    quiz_handler.get_user_progress(username)
+    return export_response(username)
+
+
+@app.route("/admin/export")
+@admin_required
+def admin_export():
+    return export_response(request.args.get("user") or None)
 
 
 @app.route("/result/<int:test_id>")
 @login_required
 def view_result(test_id):
     username = session["username"]
-    db = sessionmaker(bind=engine)()
+    db = user_context.current().session
     user = quiz_handler.get_user_progress(username)
     test = db.query(TestHistory).filter_by(id=test_id, user_id=user.id).first()
+    if not test:
+        test = maintenance.archived_test(test_id, user.id)
 
     if not test:
         flash("Test result not found", "error")
@@ -124,23 +286,25 @@ def view_result(test_id):
         subject_code = test.subject.code if test.subject else "Unknown"
         subject_name = test.subject.name if test.subject else "Unknown Subject"
 
+        # Decoded once: for archived tests each access decompresses
+        question_results = (test.questions or {}).get("results", [])
         results = {
             "score": test.score,
-            "correct_count": len(
-                [r for r in test.questions.get("results", []) if r.get("is_correct")]
-            ),
-            "total_questions": len(test.questions.get("results", []))
-            if test.questions
-            else 0,
+            "correct_count": len([r for r in question_results if r.get("is_correct")]),
+            "total_questions": len(question_results),
             "time_taken": test.time_taken,
-            "question_results": test.questions.get("results", []),
+            "question_results": question_results,
             "subject": {"code": subject_code, "name": subject_name},
             "from_history": True,
+            "test_id": test.id,
+            "archived": getattr(test, "archived", False),
+            "user_id": user.id,
+            "version": user.results_version,
         }
 
         return render_template("grade.html", results=results)
     except Exception as e:
-        print(f"Error processing test results: {e}")
+        logger.exception(f"Error processing test results: {e}")
         flash("Error processing test results", "error")
         return redirect(url_for("history"))
 
@@ -175,25 +339,50 @@ def configure():
         num_questions = int(request.form.get("num_questions", 50))
         time_limit = int(request.form.get("time_limit", 30))
         shuffle_options = request.form.get("shuffle_options") == "on"
+        adaptive = request.form.get("adaptive") == "on"
         subject_code = request.form.get("subject", "AIL303m")
+        mixed_subjects = request.form.getlist("mixed_subjects")
+        if len(mixed_subjects) > 1:
+            subject_code = mixed_subjects[0]
 
         subject_quiz_handler = QuizHandler(subject_code)
-        quiz = subject_quiz_handler.initialize_quiz(
-            username, num_questions, shuffle_options
-        )
+        if len(mixed_subjects) > 1:
+            weights = {
+                code: mixed_quiz.parse_weight(request.form.get(f"weight_{code}"))
+                for code in mixed_subjects
+            }
+            try:
+                quiz = subject_quiz_handler.initialize_mixed_quiz(
+                    username, weights, num_questions, shuffle_options
+                )
+            except ValueError as e:
+                flash(str(e), "warning")
+                return redirect(url_for("configure"))
+        elif adaptive:
+            quiz = subject_quiz_handler.initialize_adaptive_quiz(
+                username, num_questions, shuffle_options
+            )
+        else:
+            quiz = subject_quiz_handler.initialize_quiz(
+                username, num_questions, shuffle_options
+            )
 
         quiz["token"] = secrets.token_urlsafe(32)
         session["quiz_token"] = quiz["token"]
         session["subject"] = subject_code
         quiz["time_limit"] = time_limit
-        quiz["subject"] = {
-            "code": subject_quiz_handler.subject.code,
-            "name": subject_quiz_handler.subject.name,
-        }
+        quiz.setdefault(
+            "subject",
+            {
+                "code": subject_quiz_handler.subject.code,
+                "name": subject_quiz_handler.subject.name,
+            },
+        )
         subject_quiz_handler.save_quiz_state(username, quiz["token"], quiz)
         return redirect(url_for("exam"))
 
-    db = sessionmaker(bind=engine)()
+    quiz_pool.pool.note_activity(username, session.get("subject", "AIL303m"))
+    db = user_context.current().session
     subjects = db.query(Subject).all()
     return render_template("config.html", subjects=subjects)
 
@@ -234,6 +423,7 @@ def exam():
     return render_template(
         "exam.html",
         quiz=quiz,
+        questions=images.annotate(quiz["questions"]),
         time_limit=time_limit,
         enumerate=enumerate,
         hide_nav=True,
@@ -266,10 +456,13 @@ def submit():
 
         results = quiz_handler.grade_quiz(username, quiz, formatted_answers)
 
-        results["subject"] = {
-            "code": quiz_handler.subject.code,
-            "name": quiz_handler.subject.name,
-        }
+        results.setdefault(
+            "subject",
+            {
+                "code": quiz_handler.subject.code,
+                "name": quiz_handler.subject.name,
+            },
+        )
 
         result_token = secrets.token_urlsafe(16)
         quiz_handler.save_results(username, result_token, results)
@@ -281,7 +474,7 @@ def submit():
 
         return redirect(url_for("grade"))
     except Exception as e:
-        print(f"Error during quiz submission: {e}")
+        logger.exception(f"Error during quiz submission: {e}")
         session["error"] = (
             "An error occurred while submitting your quiz. Please try again."
         )
@@ -307,6 +500,54 @@ def grade():
     return render_template("grade.html", results=results)
 
 
+@app.route("/admin/questions")
+@admin_required
+def admin_questions():
+    db = user_context.current().session
+    subjects = db.query(Subject).order_by(Subject.code).all()
+    subject_code = request.args.get("subject", "AIL303m")
+    flagged_only = request.args.get("flagged") == "1"
+
+    try:
+        handler = QuizHandler(subject_code)
+    except ValueError:
+        return "Subject not found", 404
+
+    stats = analytics.load()
+    rows = analytics.report(handler.questions, stats)
+    if flagged_only:
+        rows = [row for row in rows if row["flags"]]
+
+    return render_template(
+        "admin_questions.html",
+        subjects=subjects,
+        subject_code=subject_code,
+        flagged_only=flagged_only,
+        rows=rows[:500],
+        total=len(rows),
+        stats=stats,
+    )
+
+
+@app.route("/admin/search")
+@admin_required
+def admin_search():
+    stale = search.stale_subjects()
+    if stale:
+        search.schedule_update()
+    try:
+        result = search.search(
+            request.args.get("q", ""),
+            request.args.get("subject") or None,
+            request.args.get("page", 1, type=int),
+            request.args.get("per_page", search.PER_PAGE, type=int),
+        )
+    except ValueError as e:
+        return {"error": str(e), "stale": stale}, 400
+    result["stale"] = stale
+    return result
+
+
 @app.route("/debug/user/<username>")
 def debug_user(username):
     if not app.debug:
@@ -0,0 +1,250 @@
+"""Production entry point: preload the app once, then fork worker processes.
+
+The parent process imports the app, parses every subject's question bank and
+compiles every template, freezes the garbage collector so that those objects
+are never touched again, and forks the workers. The workers share the parsed
+banks copy-on-write and accept connections on the same listening socket.
+
+Usage:
+    python serve.py --workers 4 --port 8000
+
+A worker exits after --max-requests requests (with some jitter) and is
+replaced by a fresh fork. SIGHUP recycles every worker, SIGTERM or Ctrl-C
+stops the server after the requests in flight.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+from typing import Dict
+
+logger = logging.getLogger("serve")
+
+worker_slot = None
+
+
+def memory_stats(pid="self") -> Dict[str, int]:
+    """RSS, PSS, shared and private bytes of a process (Linux only)"""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return {}
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def _format_memory(stats: Dict[str, int]) -> str:
+    return " ".join(f"{k}={v / 2**20:.1f}MiB" for k, v in stats.items()) or "n/a"
+
+
+def preload(app):
+    """Parse every bank and compile every template before forking"""
+    from utils.quiz_handler import preload_banks
+
+    banks = preload_banks()
+    templates = 0
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+        templates += 1
+    logger.info(f"Preloaded {banks} question banks and {templates} templates")
+
+
+def run_worker(app, sock, args) -> int:
+    """Serve requests on the shared socket until stopped or recycled"""
+    from werkzeug.serving import make_server
+
+    from utils.models import engine
+
+    # Connections opened by the parent must not be shared with the children
+    engine.dispose(close=False)
+    gc.enable()
+
+    state = {"requests": 0, "stopping": False}
+    max_requests = args.max_requests
+    if max_requests:
+        max_requests += random.randint(0, args.max_requests_jitter)
+
+    def stop(signum, frame):
+        state["stopping"] = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+
+    def counting_app(environ, start_response):
+        state["requests"] += 1
+        return app(environ, start_response)
+
+    server = make_server(
+        args.host, args.port, counting_app, threaded=args.threaded, fd=sock.fileno()
+    )
+    # Several workers wait on the same socket; the losers of a race for a
+    # connection must return to the loop instead of blocking in accept()
+    server.socket.setblocking(False)
+    server.timeout = 1.0
+    # Werkzeug makes request threads daemons, which server_close() doesn't
+    # wait for; they would be killed by os._exit() when the worker recycles
+    server.daemon_threads = False
+
+    logger.info(f"Worker {worker_slot} (pid {os.getpid()}) started")
+    while not state["stopping"]:
+        server.handle_request()
+        if max_requests and state["requests"] >= max_requests:
+            break
+    server.server_close()
+
+    logger.info(
+        f"Worker {worker_slot} (pid {os.getpid()}) exiting after "
+        f"{state['requests']} requests, {_format_memory(memory_stats())}"
+    )
+    return 0
+
+
+def _register_worker_metrics():
+    from utils import metrics
+
+    def collect():
+        for kind, value in memory_stats().items():
+            yield {"worker": worker_slot, "kind": kind}, value
+
+    metrics.registry.append(
+        metrics.Gauge(
+            "eos_worker_memory_bytes",
+            "Memory of the worker that served this scrape (rss, pss, shared, private)",
+            collect,
+        )
+    )
+
+
+def main(argv=None):
+    global worker_slot
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--threaded", action="store_true", help="Thread per request")
+    parser.add_argument("--max-requests", type=int, default=10000)
+    parser.add_argument("--max-requests-jitter", type=int, default=500)
+    parser.add_argument(
+        "--shared-banks",
+        action="store_true",
+        help="Map question banks from shared segments instead of per-process lists",
+    )
+    args = parser.parse_args(argv)
+
+    if args.shared_banks:
+        os.environ["EOS_SHARED_BANKS"] = "1"
+
+    from utils import logs
+
+    logs.configure()
+
+    # Collections in the parent would touch (and unshare) every page holding
+    # the preloaded objects, so the collector stays off until the fork
+    gc.disable()
+
+    from app import app
+
+    preload(app)
+
+    sock = socket.create_server((args.host, args.port), reuse_port=False, backlog=128)
+    sock.set_inheritable(True)
+    _register_worker_metrics()
+
+    if not hasattr(os, "fork"):
+        logger.warning("os.fork is not available, serving from a single process")
+        worker_slot = 0
+        gc.enable()
+        return run_worker(app, sock, args)
+
+    from utils.models import engine
+
+    engine.dispose()
+    gc.collect()
+    gc.freeze()
+
+    workers: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(slot: int):
+        global worker_slot
+        # The log listener thread doesn't survive the fork; each process
+        # starts its own on its next record
+        logs.flush()
+        pid = os.fork()
+        if pid == 0:
+            worker_slot = slot
+            code = 1
+            try:
+                code = run_worker(app, sock, args)
+            except Exception:
+                logger.exception(f"Worker {slot} crashed")
+            finally:
+                logs.flush()
+                os._exit(code)
+        workers[pid] = slot
+
+    def signal_workers():
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        signal_workers()
+
+    def recycle(signum, frame):
+        logger.info("Recycling all workers")
+        signal_workers()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, recycle)
+
+    logger.info(
+        f"Serving on http://{args.host}:{args.port} with {args.workers} workers, "
+        f"parent {_format_memory(memory_stats())}"
+    )
+    for slot in range(args.workers):
+        spawn(slot)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = workers.pop(pid, None)
+        if slot is None:
+            continue
+        if os.waitstatus_to_exitcode(status) != 0:
+            logger.warning(f"Worker {slot} (pid {pid}) exited with status {status}")
+            # Don't spin if workers die straight after the fork
+            time.sleep(1)
+        if not stopping:
+            spawn(slot)
+
+    sock.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
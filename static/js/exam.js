@@ -1,83 +1,22 @@
-class QuizNode {
-    constructor(question, index) {
-        this.question = question;
-        this.index = index;
-        this.next = null;
-        this.prev = null;
-    }
-}
-
-class CircularQuizList {
-    constructor(questions) {
-        if (!questions || questions.length === 0) {
-            throw new Error("Questions array cannot be empty");
-        }
-
-        this.head = null;
-        this.current = null;
-        this.size = questions.length;
-
-        let lastNode = null;
-        questions.forEach((question, index) => {
-            const node = new QuizNode(question, index);
-            if (!this.head) {
-                this.head = node;
-            } else {
-                node.prev = lastNode;
-                lastNode.next = node;
-            }
-            lastNode = node;
-        });
-
-        lastNode.next = this.head;
-        this.head.prev = lastNode;
-
-        this.current = this.head;
-    }
-
-    next() {
-        if (!this.current) return null;
-        this.current = this.current.next;
-        return this.current;
-    }
-
-    prev() {
-        if (!this.current) return null;
-        this.current = this.current.prev;
-        return this.current;
-    }
-
-    getCurrentIndex() {
-        return this.current ? this.current.index : 0;
-    }
-
-    getCurrentQuestion() {
-        return this.current ? this.current.question : null;
-    }
-
-    moveTo(index) {
-        let node = this.head;
-        for (let i = 0; i < this.size; i++) {
-            if (node.index === index) {
-                this.current = node;
-                return;
-            }
-            node = node.next;
-        }
-    }
-}
-
+const { ExamState, Batcher, visibleRange, questionImages, upcomingQuestions } = ExamCore;
 
 const questions = questionsData;
-let quizList;
+let exam;
 try {
-    quizList = new CircularQuizList(questions);
+    exam = new ExamState(questions);
 } catch (e) {
     console.error('Failed to initialize quiz:', e);
     location.href = '/';
 }
 
-let answers = new Array(questions.length).fill(null);
+const storageKey = `quiz_${quizToken}`;
+const SAVE_INTERVAL_MS = 1000;
+const NAV_COLUMNS = 5;
+const NAV_ROW_HEIGHT = 36;
+const NAV_OVERSCAN = 2;
+const PRELOAD_AHEAD = 3;
+const QUESTION_IMAGE_SIZES = '(max-width: 768px) 100vw, 70vw';
+const OPTION_IMAGE_SIZES = '(max-width: 768px) 100vw, 60vw';
 
 if (!window.location.search.includes('token') && quizToken) {
     const newUrl = `${window.location.pathname}?token=${quizToken}`;
@@ -85,38 +24,66 @@ if (!window.location.search.includes('token') && quizToken) {
 }
 
 
-
-
-function saveProgress() {
-    localStorage.setItem(`quiz_${quizToken}`, JSON.stringify({
-        answers,
-        startTime: new Date().getTime(),
-        timeLimit,
-        currentIndex: quizList.getCurrentIndex()
-    }));
-}
+// Progress is written at most once per SAVE_INTERVAL_MS, and right away when
+// the page is hidden or left, instead of on every click.
+const saver = new Batcher(() => {
+    try {
+        localStorage.setItem(storageKey, JSON.stringify(exam.snapshot()));
+    } catch (error) {
+        console.error('Failed to save progress:', error);
+    }
+}, SAVE_INTERVAL_MS);
 
 function loadProgress() {
-    const saved = localStorage.getItem(`quiz_${quizToken}`);
+    const saved = localStorage.getItem(storageKey);
     if (saved) {
         try {
-            const data = JSON.parse(saved);
-            answers = data.answers || new Array(questions.length).fill(null);
-            if (typeof data.currentIndex === 'number') {
-                quizList.moveTo(data.currentIndex);
-            }
+            exam.restore(JSON.parse(saved));
         } catch (error) {
             console.error('Failed to load saved progress:', error);
         }
     }
     updateQuestion();
     updateProgress();
-    document.getElementById('answersInput').value = JSON.stringify(answers);
+    renderNav();
+}
+
+// `question.images` holds the srcset and dimensions of the images built by
+// utils/images.py; images without them are served as they are.
+function imageTag(question, url, alt, sizes) {
+    const attrs = (question.images || {})[url];
+    let extra = '';
+    if (attrs) {
+        extra = ` width="${attrs.width}" height="${attrs.height}"`;
+        if (attrs.srcset) extra += ` srcset="${attrs.srcset}" sizes="${sizes}"`;
+    }
+    return `<img src="${url}" alt="${alt}" class="img-fluid" decoding="async"${extra}>`;
+}
+
+const preloaded = new Set();
+
+function preloadImages() {
+    upcomingQuestions(questions, exam.index, PRELOAD_AHEAD).forEach(question => {
+        questionImages(question).forEach(url => {
+            if (preloaded.has(url)) return;
+            preloaded.add(url);
+            const attrs = (question.images || {})[url];
+            const image = new Image();
+            if (attrs && attrs.srcset) {
+                // The sizes of the rendered tag, so the same candidate loads
+                image.sizes = url === question.image_url
+                    ? QUESTION_IMAGE_SIZES
+                    : OPTION_IMAGE_SIZES;
+                image.srcset = attrs.srcset;
+            }
+            image.src = url;
+        });
+    });
 }
 
 function updateQuestion() {
-    const question = quizList.getCurrentQuestion();
-    const currentQuestion = quizList.getCurrentIndex();
+    const question = exam.current();
+    const selected = new Set(exam.selected[exam.index] || []);
 
     document.getElementById('selectInfo').textContent =
         `Choose your answer(s) - Select ${question.correct_answers.length} option(s)`;
@@ -126,7 +93,7 @@ function updateQuestion() {
     if (question.image_url) {
         questionTextEl.innerHTML += `
           <div class="question-image mt-2">
-              <img src="${question.image_url}" alt="Question image" class="img-fluid">
+              ${imageTag(question, question.image_url, 'Question image', QUESTION_IMAGE_SIZES)}
           </div>`;
     }
 
@@ -135,7 +102,8 @@ function updateQuestion() {
     optionsPanel.innerHTML = question.options
         .map((option, index) => {
             const letter = String.fromCharCode(65 + index);
-            return `<div class="form-check"><input class="form-check-input" type="checkbox" name="answer_option" id="option${letter}" value="${letter}"><label class="form-check-label text-nowrap" for="option${letter}">${letter}</label></div>`;
+            const checked = selected.has(index) ? ' checked' : '';
+            return `<div class="form-check"><input class="form-check-input" type="checkbox" name="answer_option" id="option${letter}" value="${index}"${checked}><label class="form-check-label text-nowrap" for="option${letter}">${letter}</label></div>`;
         }).join('');
 
 
@@ -144,79 +112,113 @@ function updateQuestion() {
         .map((option, index) => {
             const letter = String.fromCharCode(65 + index);
             return option.type === 'image'
-                ? `<div class="option-row"><span class="option-letter">${letter}.</span><div class="option-image"><img src="${option.content}" alt="Option ${letter}" class="img-fluid"></div></div>`
+                ? `<div class="option-row"><span class="option-letter">${letter}.</span><div class="option-image">${imageTag(question, option.content, `Option ${letter}`, OPTION_IMAGE_SIZES)}</div></div>`
                 : `<div class="option-row"><span class="option-letter text-nowrap">${letter}. </span><span class="option-content">${option.content.replace(/\n/g, '<br>')}</span></div>`;
         }).join('');
 
+    document.getElementById('prevBtn').disabled = false;
+    optionsPanel.style.height = 'auto';
+    optionsPanel.style.maxHeight = '300px';
+    optionsPanel.style.minHeight = '200px';
+    preloadImages();
+}
 
-    document.querySelectorAll('input[name="answer_option"]').forEach(cb => cb.checked = false);
+function updateProgress() {
+    document.getElementById('progress-bar').style.width = `${exam.progress() * 100}%`;
+}
 
 
-    if (answers[currentQuestion]) {
-        const savedAnswers = answers[currentQuestion];
-        savedAnswers.forEach(answer => {
+// Question navigator: a grid of buttons of which only the rows in view are in
+// the DOM, so long exams don't pay for thousands of elements.
+const nav = document.getElementById('questionNav');
+const navSpacer = document.createElement('div');
+const navCells = document.createElement('div');
+navSpacer.className = 'question-nav-spacer';
+navCells.className = 'question-nav-cells';
+navSpacer.appendChild(navCells);
+nav.appendChild(navSpacer);
+
+function renderNav() {
+    const range = visibleRange(
+        exam.size, NAV_COLUMNS, NAV_ROW_HEIGHT,
+        nav.scrollTop, nav.clientHeight, NAV_OVERSCAN
+    );
+    navSpacer.style.height = `${range.totalHeight}px`;
+    navCells.style.transform = `translateY(${range.offsetTop}px)`;
+
+    let html = '';
+    for (let i = range.first; i < range.last; i++) {
+        const classes = ['question-nav-cell'];
+        if (exam.isAnswered(i)) classes.push('answered');
+        if (i === exam.index) classes.push('current');
+        html += `<button type="button" class="${classes.join(' ')}" data-index="${i}">${i + 1}</button>`;
+    }
+    navCells.innerHTML = html;
+}
 
-            const index = question.options.findIndex(opt =>
-                JSON.stringify(opt) === JSON.stringify(answer)
-            );
-            if (index !== -1) {
-                const letter = String.fromCharCode(65 + index);
-                const checkbox = document.getElementById(`option${letter}`);
-                if (checkbox) {
-                    checkbox.checked = true;
-                }
-            }
+function scrollNavToCurrent() {
+    const top = Math.floor(exam.index / NAV_COLUMNS) * NAV_ROW_HEIGHT;
+    if (top < nav.scrollTop || top + NAV_ROW_HEIGHT > nav.scrollTop + nav.clientHeight) {
+        nav.scrollTop = top - (nav.clientHeight - NAV_ROW_HEIGHT) / 2;
+    }
+}
+
+let navFrame = null;
+nav.addEventListener('scroll', () => {
+    if (navFrame === null) {
+        navFrame = requestAnimationFrame(() => {
+            navFrame = null;
+            renderNav();
         });
     }
+});
 
-    document.getElementById('prevBtn').disabled = false;
-    optionsPanel.style.height = 'auto';
-    optionsPanel.style.maxHeight = '300px';
-    optionsPanel.style.minHeight = '200px';
-}
+nav.addEventListener('click', (e) => {
+    const cell = e.target.closest('.question-nav-cell');
+    if (cell) goTo(Number(cell.dataset.index));
+});
 
-function updateProgress() {
-    const answered = answers.filter(answer => answer !== null && answer.length > 0).length;
-    const progress = (answered / questions.length) * 100;
-    document.getElementById('progress-bar').style.width = `${progress}%`;
+
+function goTo(index) {
+    exam.moveTo(index);
+    updateQuestion();
+    scrollNavToCurrent();
+    renderNav();
+    saver.schedule();
 }
 
 function updateAnswers() {
-
-    const question = quizList.getCurrentQuestion();
-    const selectedLetters = Array.from(
+    const selected = Array.from(
         document.querySelectorAll('input[name="answer_option"]:checked')
-    ).map(cb => cb.value);
+    ).map(cb => Number(cb.value));
 
-    const selectedAnswers = selectedLetters.map(letter =>
-        question.options[letter.charCodeAt(0) - 65]
-    );
+    exam.select(exam.index, selected);
+    updateProgress();
+    renderNav();
+    saver.schedule();
+}
 
-    answers[quizList.getCurrentIndex()] = selectedAnswers.length > 0 ? selectedAnswers : null;
-    document.getElementById('answersInput').value = JSON.stringify(answers);
-    saveProgress();
+function submitQuiz() {
+    saver.cancel();
+    document.getElementById('answersInput').value = JSON.stringify(exam.answers());
+    localStorage.removeItem(storageKey);
 }
 
 document.querySelector('.answer-options').addEventListener('change', updateAnswers);
 
-document.getElementById('prevBtn').addEventListener('click', () => {
-    quizList.prev();
-    updateProgress();
-    updateQuestion();
-    saveProgress();
-});
+document.getElementById('prevBtn').addEventListener('click', () => goTo(exam.index - 1));
 
-document.getElementById('nextBtn').addEventListener('click', () => {
-    quizList.next();
-    updateProgress();
-    updateQuestion();
-    saveProgress();
-});
+document.getElementById('nextBtn').addEventListener('click', () => goTo(exam.index + 1));
 
 document.getElementById('finishCheck').addEventListener('change', (e) => {
     document.getElementById('finishBtn').disabled = !e.target.checked;
 });
 
+window.addEventListener('pagehide', () => saver.flush());
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'hidden') saver.flush();
+});
+
 
 function calculateRemainingTime() {
     if (!startTime) return timeLimit;
@@ -226,6 +228,8 @@ function calculateRemainingTime() {
     return Math.max(0, timeLimit - elapsed);
 }
 
+let submitted = false;
+
 function updateTimer() {
     const remaining = calculateRemainingTime();
     const minutes = Math.floor(remaining / 60);
@@ -234,7 +238,10 @@ function updateTimer() {
     const timeDisplay = document.getElementById('time');
     if (timeDisplay) {
         timeDisplay.textContent = `${String(minutes).padStart(2, '0')}:${String(seconds).padStart(2, '0')}`;
-        if (remaining <= 0) {
+        if (remaining <= 0 && !submitted) {
+            submitted = true;
+            // form.submit() doesn't fire the submit event
+            submitQuiz();
             document.getElementById('quizForm').submit();
         }
     }
@@ -248,22 +255,20 @@ document.addEventListener('DOMContentLoaded', () => {
             location.href = '/configure';
             return;
         }
-        updateQuestion();
-        updateProgress();
-
 
         updateTimer();
         const timerInterval = setInterval(updateTimer, 1000);
 
-
         loadProgress();
+        scrollNavToCurrent();
     } catch (error) {
         console.error('Failed to initialize quiz:', error);
     }
 });
 
 document.getElementById('quizForm').addEventListener('submit', () => {
-    localStorage.removeItem(`quiz_${quizToken}`);
+    submitted = true;
+    submitQuiz();
 });
 
 let currentFontSize = 1.3;
@@ -280,4 +285,4 @@ function adjustFontSize(delta) {
     document.querySelectorAll('.option-content').forEach(el => {
         el.style.fontSize = `${currentFontSize}rem`;
     });
-}
\ No newline at end of file
+}
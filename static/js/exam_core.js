@@ -0,0 +1,200 @@
+// DOM-free state of the exam client, shared by exam.js and the Node
+// benchmark (utils/js/benchmark_exam.js).
+//
+// Answers are kept as arrays of option indexes, and persisted as indexes
+// too; they are only turned into the option objects the server grades
+// when the exam is submitted.
+// Navigation is array indexing, the answered count is maintained on every
+// change, and persistence goes through a batcher that writes at most once
+// per interval, however many selections happen in between.
+(function (root, factory) {
+    if (typeof module === 'object' && module.exports) {
+        module.exports = factory();
+    } else {
+        root.ExamCore = factory();
+    }
+}(typeof self !== 'undefined' ? self : this, function () {
+    'use strict';
+
+    const STORAGE_VERSION = 2;
+
+    function optionKey(option) {
+        return option && typeof option === 'object'
+            ? `${option.type}\u0000${option.content}`
+            : String(option);
+    }
+
+    class ExamState {
+        constructor(questions) {
+            if (!questions || questions.length === 0) {
+                throw new Error('Questions array cannot be empty');
+            }
+            this.questions = questions;
+            this.size = questions.length;
+            this.index = 0;
+            this.selected = new Array(this.size).fill(null);
+            this.answered = 0;
+            this.version = 0;
+        }
+
+        current() {
+            return this.questions[this.index];
+        }
+
+        moveTo(index) {
+            this.index = ((index % this.size) + this.size) % this.size;
+            return this.index;
+        }
+
+        next() {
+            return this.moveTo(this.index + 1);
+        }
+
+        prev() {
+            return this.moveTo(this.index - 1);
+        }
+
+        isAnswered(index) {
+            return this.selected[index] !== null;
+        }
+
+        // `optionIndexes` are indexes into the question's options
+        select(index, optionIndexes) {
+            const value = optionIndexes && optionIndexes.length > 0
+                ? Array.from(optionIndexes)
+                : null;
+            this.answered += (value !== null) - (this.selected[index] !== null);
+            this.selected[index] = value;
+            this.version++;
+        }
+
+        progress() {
+            return this.answered / this.size;
+        }
+
+        // The submitted format: per question, the chosen option objects or null
+        answers() {
+            return this.selected.map((indexes, i) => indexes === null
+                ? null
+                : indexes.map(option => this.questions[i].options[option]));
+        }
+
+        snapshot() {
+            return {
+                v: STORAGE_VERSION,
+                selected: this.selected,
+                currentIndex: this.index,
+            };
+        }
+
+        restore(data) {
+            if (!data) return;
+            if (data.v === STORAGE_VERSION && Array.isArray(data.selected)) {
+                data.selected.slice(0, this.size).forEach((indexes, i) => {
+                    if (Array.isArray(indexes)) this.select(i, indexes);
+                });
+            } else if (Array.isArray(data.answers)) {
+                // Saved by the previous client: option objects per question
+                data.answers.slice(0, this.size).forEach((answer, i) => {
+                    if (!Array.isArray(answer)) return;
+                    const keys = new Set(answer.map(optionKey));
+                    const indexes = [];
+                    this.questions[i].options.forEach((option, j) => {
+                        if (keys.has(optionKey(option))) indexes.push(j);
+                    });
+                    this.select(i, indexes);
+                });
+            }
+            if (typeof data.currentIndex === 'number') {
+                this.moveTo(data.currentIndex);
+            }
+        }
+    }
+
+    // Calls `write` at most once per `wait` ms after `schedule()`, and right
+    // away on `flush()`. Timers are injectable for the benchmark.
+    class Batcher {
+        constructor(write, wait, timers) {
+            this.write = write;
+            this.wait = wait;
+            this.timers = timers || {
+                setTimeout: (fn, ms) => setTimeout(fn, ms),
+                clearTimeout: id => clearTimeout(id),
+            };
+            this.timer = null;
+            this.dirty = false;
+            this.writes = 0;
+        }
+
+        schedule() {
+            this.dirty = true;
+            if (this.timer === null) {
+                this.timer = this.timers.setTimeout(() => {
+                    this.timer = null;
+                    this.flush();
+                }, this.wait);
+            }
+        }
+
+        // Drop the pending write, if any
+        cancel() {
+            if (this.timer !== null) {
+                this.timers.clearTimeout(this.timer);
+                this.timer = null;
+            }
+            this.dirty = false;
+        }
+
+        flush() {
+            const dirty = this.dirty;
+            this.cancel();
+            if (!dirty) return;
+            this.writes++;
+            this.write();
+        }
+    }
+
+    // Rows of a grid of `total` cells that are visible in a scrolled
+    // viewport, plus `overscan` rows on each side
+    function visibleRange(total, columns, rowHeight, scrollTop, viewportHeight, overscan) {
+        const rows = Math.ceil(total / columns);
+        const firstRow = Math.max(0, Math.floor(scrollTop / rowHeight) - overscan);
+        const lastRow = Math.min(
+            rows, Math.ceil((scrollTop + viewportHeight) / rowHeight) + overscan
+        );
+        return {
+            first: firstRow * columns,
+            last: Math.min(total, lastRow * columns),
+            offsetTop: firstRow * rowHeight,
+            totalHeight: rows * rowHeight,
+        };
+    }
+
+    function questionImages(question) {
+        const urls = question.image_url ? [question.image_url] : [];
+        question.options.forEach(option => {
+            if (option.type === 'image') urls.push(option.content);
+        });
+        return urls;
+    }
+
+    // The `count` questions after `index`, wrapping around like Next does
+    function upcomingQuestions(questions, index, count) {
+        const upcoming = [];
+        const ahead = Math.min(count, questions.length - 1);
+        for (let step = 1; step <= ahead; step++) {
+            upcoming.push(questions[(index + step) % questions.length]);
+        }
+        return upcoming;
+    }
+
+    return {
+        ExamState,
+        Batcher,
+        visibleRange,
+        questionImages,
+        upcomingQuestions,
+        optionKey,
+        STORAGE_VERSION,
+    };
+}));
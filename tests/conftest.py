@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Banks are read relative to the working directory
+os.chdir(ROOT)
+# Set before utils.models is imported, so no test touches instance/quiz.db
+os.environ["QUIZ_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "quiz.db")
+os.environ.setdefault("EOS_QUIZ_POOL", "0")
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app import app
+
+    app.config["TESTING"] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,44 @@
+import pytest
+
+
+@pytest.fixture
+def admin_token(app, monkeypatch):
+    monkeypatch.setitem(app.config, "ADMIN_TOKEN", "s3cret")
+    return "s3cret"
+
+
+def test_admin_pages_are_off_without_a_token(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, "ADMIN_TOKEN", "")
+    client.post("/login", data={"username": "admin"})
+    assert client.get("/admin/export").status_code == 403
+    assert client.get("/admin/login").status_code == 403
+
+
+def test_username_is_not_a_credential(client, admin_token):
+    client.post("/login", data={"username": "admin"})
+    response = client.get("/admin/export")
+    assert response.status_code == 302
+    assert "/admin/login" in response.location
+
+
+def test_admin_token_header(client, admin_token):
+    wrong = client.get("/admin/search", headers={"X-Admin-Token": "nope"})
+    assert wrong.status_code == 403
+    response = client.get("/admin/search?q=x", headers={"X-Admin-Token": admin_token})
+    assert response.status_code in (200, 400)
+
+
+def test_admin_login(client, admin_token):
+    assert client.post("/admin/login", data={"token": "nope"}).status_code == 403
+    response = client.post(
+        "/admin/login?next=/admin/export", data={"token": admin_token}
+    )
+    assert response.status_code == 302 and response.location.endswith("/admin/export")
+    assert client.get("/admin/export?subject=AIL303m").status_code == 200
+
+
+def test_admin_login_only_redirects_to_admin_pages(client, admin_token):
+    response = client.post(
+        "/admin/login?next=//example.com/", data={"token": admin_token}
+    )
+    assert response.location.endswith("/admin/questions")
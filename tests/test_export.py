@@ -0,0 +1,52 @@
+import json
+import sqlite3
+from datetime import datetime
+
+from sqlalchemy import text
+
+from utils import export
+from utils.models import db_path, engine, init_db
+
+
+def _add_tests(user_id, count):
+    results = {
+        "results": [
+            {
+                "question": "Q",
+                "submitted": ["A"],
+                "correct": ["A"],
+                "is_correct": True,
+                "is_unanswered": False,
+            }
+        ]
+    }
+    with engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO users (id, username) VALUES (:u, 'export-user')"),
+            {"u": user_id},
+        )
+        for _ in range(count):
+            conn.execute(
+                text(
+                    "INSERT INTO test_history (user_id, score, questions, "
+                    "completed_at) VALUES (:u, 10, :q, :t)"
+                ),
+                {"u": user_id, "q": json.dumps(results), "t": datetime.now()},
+            )
+
+
+def test_paused_export_does_not_block_writers(monkeypatch):
+    init_db()
+    _add_tests(7001, 5)
+    monkeypatch.setattr(export, "PAGE_ROWS", 2, raising=False)
+
+    rows = export.rows(export.Filters(user_id=7001))
+    first = next(rows)
+    # The client stalls here; a submission must still be able to write
+    writer = sqlite3.connect(db_path, timeout=0.1)
+    writer.execute("UPDATE test_history SET score = score WHERE user_id = 7001")
+    writer.commit()
+    writer.close()
+
+    ids = [first["test_id"]] + [row["test_id"] for row in rows]
+    assert len(ids) == 5 and ids == sorted(ids)
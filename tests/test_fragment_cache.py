@@ -0,0 +1,111 @@
+import json
+import zlib
+from datetime import datetime
+
+from sqlalchemy import text
+
+from utils import maintenance
+from utils.fragment_cache import FragmentCache
+from utils.models import engine
+
+
+def test_evicted_keys_leave_their_tag():
+    cache = FragmentCache(max_bytes=10)
+    for i in range(100):
+        cache.put(("result", i), "x" * 5, tag=("user", i))
+    assert len(cache) == 2
+    assert len(cache._tags) == 2
+    assert cache.invalidate(("user", 99)) == 1
+    assert len(cache._tags) == 1
+
+
+def _results(question, is_correct):
+    return {
+        "questions": [],
+        "answers": {},
+        "results": [
+            {
+                "question": question,
+                "submitted": ["A"],
+                "correct": ["A" if is_correct else "B"],
+                "is_correct": is_correct,
+                "is_unanswered": False,
+            }
+        ],
+    }
+
+
+def _user_id(client, username):
+    client.post("/login", data={"username": username})
+    client.get("/dashboard")
+    with engine.connect() as conn:
+        return conn.execute(
+            text("SELECT id FROM users WHERE username = :u"), {"u": username}
+        ).scalar()
+
+
+def test_result_fragment_is_per_user(app):
+    alice, bob = app.test_client(), app.test_client()
+    alice_id, bob_id = _user_id(alice, "frag-alice"), _user_id(bob, "frag-bob")
+    with engine.begin() as conn:
+        test_id = conn.execute(
+            text(
+                "INSERT INTO test_history (user_id, score, time_taken, questions, "
+                "completed_at) VALUES (:u, 10, 60, :q, :t) RETURNING id"
+            ),
+            {
+                "u": alice_id,
+                "q": json.dumps(_results("Alice's question", True)),
+                "t": datetime.now(),
+            },
+        ).scalar()
+    # An archived attempt of another user under the same id
+    payload = json.dumps(_results("Bob's question", False)).encode()
+    with maintenance.archive_engine(create=True).begin() as conn:
+        conn.execute(
+            maintenance.archived_history.insert().values(
+                id=test_id,
+                user_id=bob_id,
+                score=0.0,
+                time_taken=60,
+                completed_at=datetime.now(),
+                payload=zlib.compress(payload),
+            )
+        )
+
+    assert "Alice&#39;s question" in alice.get(f"/result/{test_id}").get_data(True)
+    page = bob.get(f"/result/{test_id}").get_data(True)
+    assert "Bob&#39;s question" in page
+    assert "Alice" not in page
+
+
+def test_regraded_result_is_not_served_from_cache(client):
+    from utils import regrade
+
+    user_id = _user_id(client, "frag-regraded")
+    with engine.begin() as conn:
+        test_id = conn.execute(
+            text(
+                "INSERT INTO test_history (user_id, score, time_taken, questions, "
+                "completed_at) VALUES (:u, 0, 60, :q, :t) RETURNING id"
+            ),
+            {
+                "u": user_id,
+                "q": json.dumps(_results("Regraded question", False)),
+                "t": datetime.now(),
+            },
+        ).scalar()
+    assert "Correct answer: B" in client.get(f"/result/{test_id}").get_data(True)
+    assert "0.0" in client.get("/history").get_data(True)
+
+    attempt = {
+        "id": test_id,
+        "user_id": user_id,
+        "score": 10.0,
+        "questions": _results("Regraded question", True),
+    }
+    counts = dict.fromkeys(regrade.COUNTS, 0)
+    regrade._write_batch(0, user_id, "AIL303m", 1, [attempt], [], {}, {}, {}, counts)
+
+    assert "Correct answer: B" not in client.get(f"/result/{test_id}").get_data(True)
+    assert "10.0" in client.get("/history").get_data(True)
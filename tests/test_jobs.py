@@ -0,0 +1,29 @@
+import sqlite3
+
+from utils import jobs
+from utils.models import Job, db_path, engine
+
+
+def test_idle_poll_does_not_need_the_write_lock():
+    with engine.begin() as conn:
+        conn.execute(Job.__table__.delete())
+    writer = sqlite3.connect(db_path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")  # e.g. a request committing a quiz
+    try:
+        assert jobs.JobRunner().claim(2) == []
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+
+
+def test_due_jobs_are_claimed():
+    with engine.begin() as conn:
+        conn.execute(Job.__table__.delete())
+        conn.execute(Job.__table__.insert().values(kind="noop", status="queued"))
+    runner = jobs.JobRunner()
+    try:
+        assert len(runner.claim(2)) == 1
+        assert runner.counts["running"] == 1
+    finally:
+        with engine.begin() as conn:
+            conn.execute(Job.__table__.delete())
@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from utils import maintenance
+from utils.models import engine, init_db
+
+
+def _add_test(user_id, completed_at):
+    with engine.begin() as conn:
+        return conn.execute(
+            text(
+                "INSERT INTO test_history (user_id, score, questions, completed_at) "
+                "VALUES (:user_id, 5, '{}', :completed_at) RETURNING id"
+            ),
+            {"user_id": user_id, "completed_at": completed_at},
+        ).scalar()
+
+
+def test_archived_ids_are_not_reused():
+    init_db()
+    cutoff = datetime.now() - timedelta(days=maintenance.ARCHIVE_DAYS)
+    old = cutoff - timedelta(days=30)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM test_history"))
+
+    first = _add_test(9001, old)
+    maintenance.archive(cutoff)
+    second = _add_test(9002, old)
+    assert second > first
+
+    maintenance.archive(cutoff)
+    assert maintenance.archived_test(first, 9001) is not None
+    assert maintenance.archived_test(second, 9002) is not None
@@ -0,0 +1,42 @@
+import pytest
+from sqlalchemy import select
+
+from utils import migrations, models
+from utils.models import engine, init_db
+
+
+@pytest.fixture(scope="module", autouse=True)
+def schema():
+    init_db()
+
+
+def test_database_is_at_the_latest_version():
+    with engine.connect() as conn:
+        assert migrations.current_version(conn) == migrations.latest_version()
+
+
+def test_hot_queries_use_their_indexes():
+    assert migrations.check() == []
+
+
+@pytest.mark.parametrize(
+    "name, statement, index",
+    migrations.hot_queries(),
+    ids=[name for name, _, _ in migrations.hot_queries()],
+)
+def test_query_plan(name, statement, index):
+    with engine.connect() as conn:
+        plan = migrations.explain(conn, statement)
+    assert any(f"INDEX {index}" in step for step in plan), plan
+
+
+def test_history_by_user_and_date_needs_no_sort():
+    statement = (
+        select(models.TestHistory)
+        .where(models.TestHistory.user_id == 1)
+        .order_by(models.TestHistory.completed_at.desc())
+    )
+    with engine.connect() as conn:
+        plan = migrations.explain(conn, statement)
+    assert any("INDEX idx_user_completed (user_id=?)" in step for step in plan), plan
+    assert not any("TEMP B-TREE" in step for step in plan), plan
@@ -0,0 +1,43 @@
+import pytest
+
+from utils import mixed_quiz
+
+
+@pytest.mark.parametrize(
+    "value, weight",
+    [("2.5", 2.5), ("0", 0.0), ("-3", 0.0), (None, 1.0), ("", 1.0), ("abc", 1.0)],
+)
+def test_parse_weight(value, weight):
+    assert mixed_quiz.parse_weight(value) == weight
+
+
+@pytest.mark.parametrize("value", ["inf", "-inf", "nan"])
+def test_non_finite_weights_count_as_one(value):
+    assert mixed_quiz.parse_weight(value) == 1.0
+
+
+def _configure(client, **weights):
+    data = {
+        "num_questions": "10",
+        "time_limit": "30",
+        "mixed_subjects": ["AIL303m", "SWE201c"],
+    }
+    data.update({f"weight_{code}": value for code, value in weights.items()})
+    return client.post("/configure", data=data)
+
+
+def test_all_zero_weights_are_rejected(client):
+    client.post("/login", data={"username": "mixed-zero"})
+    response = _configure(client, AIL303m="0", SWE201c="0")
+    assert response.status_code == 302
+    assert response.location.endswith("/configure")
+    assert "at least one subject" in client.get("/configure").get_data(True)
+    # No empty quiz was left behind as the active one
+    assert "Active Test" not in client.get("/dashboard").get_data(True)
+
+
+def test_unparsable_weights_fall_back_to_one(client):
+    client.post("/login", data={"username": "mixed-inf"})
+    response = _configure(client, AIL303m="inf", SWE201c="abc")
+    assert response.status_code == 302
+    assert response.location.endswith("/exam")
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from utils import regrade, spaced_repetition, user_context
+from utils.analytics import question_id
+from utils.models import ReviewItem, User, engine
+from utils.quiz_handler import QuizHandler
+
+REGRADED = "A question whose key was fixed"
+
+
+def _write_batch(user_id, subject_id, penalty_deltas=None, review_flips=None):
+    regrade._write_batch(
+        0,
+        user_id,
+        "AIL303m",
+        subject_id,
+        [],
+        [],
+        {},
+        penalty_deltas or {},
+        review_flips or {},
+        dict.fromkeys(regrade.COUNTS, 0),
+    )
+
+
+def _penalties(username):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(User.penalty_questions).where(User.username == username)
+        ).scalar()["AIL303m"]
+
+
+def test_grading_does_not_undo_a_concurrent_regrade(app):
+    handler = QuizHandler("AIL303m")
+    with user_context.unit_of_work():
+        quiz = handler.initialize_quiz("regrade-race", 5)
+
+    with user_context.unit_of_work():
+        # Loaded by the request before the regrade batch commits
+        user = handler.get_user_progress("regrade-race")
+        _write_batch(user.id, handler.subject.id, {user.id: {REGRADED: 2}})
+        handler.grade_quiz("regrade-race", quiz, {})
+
+    penalties = _penalties("regrade-race")
+    assert penalties[REGRADED] == 2
+    # The quiz was still graded: every question was left unanswered
+    assert all(penalties[q["text"]] == 1 for q in quiz["questions"])
+
+
+def test_flipped_results_are_reviewed_again(app):
+    handler = QuizHandler("AIL303m")
+    with user_context.unit_of_work():
+        user_id = handler.get_user_progress("regrade-reviews").id
+    now = datetime.now()
+    with user_context.unit_of_work() as context:
+        spaced_repetition.record(
+            context.session,
+            user_id,
+            handler.subject.id,
+            [{"question": REGRADED, "is_correct": False}],
+            {},
+            now,
+        )
+
+    _write_batch(user_id, handler.subject.id, review_flips={user_id: {REGRADED: True}})
+
+    with engine.connect() as conn:
+        item = conn.execute(
+            select(ReviewItem).where(
+                ReviewItem.user_id == user_id,
+                ReviewItem.question_id == question_id(REGRADED),
+            )
+        ).one()
+    # Answered right after all: no longer due within minutes
+    assert item.due_at > now + timedelta(hours=12)
+    assert item.repetitions == 1
@@ -0,0 +1,43 @@
+import os
+import socket
+import time
+import types
+import urllib.request
+
+import pytest
+
+import serve
+
+
+def _slow_app(environ, start_response):
+    time.sleep(1)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"done"]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_recycled_worker_finishes_requests_in_flight():
+    sock = socket.create_server(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    args = types.SimpleNamespace(
+        host="127.0.0.1",
+        port=port,
+        threaded=True,
+        max_requests=1,
+        max_requests_jitter=0,
+    )
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            code = serve.run_worker(_slow_app, sock, args)
+        finally:
+            os._exit(code)
+    try:
+        # The worker recycles as soon as it has taken this request
+        body = urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=10).read()
+    finally:
+        _, status = os.waitpid(pid, 0)
+        sock.close()
+    assert body == b"done"
+    assert os.waitstatus_to_exitcode(status) == 0
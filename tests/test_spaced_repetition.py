@@ -0,0 +1,25 @@
+from sqlalchemy.orm import Session
+
+from utils import spaced_repetition
+from utils.analytics import question_id
+from utils.models import Subject, User, engine
+
+
+def test_penalties_are_seeded_when_a_quiz_is_graded_first(app):
+    texts = ["Q1", "Q2", "Q3"]
+    penalties = {"Q1": 2, "Q2": 1, "Q3": 3}
+    ids = {question_id(text): i for i, text in enumerate(texts)}
+    with Session(engine) as db:
+        user = User(username="sr-legacy", penalty_questions={"X": penalties})
+        db.add(user)
+        db.flush()
+        subject_id = db.query(Subject.id).first()[0]
+
+        # Graded before the user's queue was ever loaded, e.g. an adaptive quiz
+        results = [{"question": "Q1", "is_correct": True}]
+        spaced_repetition.record(db, user.id, subject_id, results, penalties)
+        db.commit()
+
+        due = spaced_repetition.due_indexes(db, user.id, subject_id, ids, penalties, 10)
+        # Q1 was just answered correctly; the others keep their penalty order
+        assert due == [2, 1]
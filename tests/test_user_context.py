@@ -0,0 +1,20 @@
+from sqlalchemy import func, select
+
+from utils.models import User, engine
+
+
+def _user_count(username):
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count(User.id)).where(User.username == username)
+        ).scalar()
+
+
+def test_first_get_persists_user(client):
+    client.post("/login", data={"username": "first-get"})
+    assert client.get("/dashboard").status_code == 200
+    assert _user_count("first-get") == 1
+
+    for path in ("/history", "/dashboard"):
+        assert client.get(path).status_code == 200
+    assert _user_count("first-get") == 1
@@ -0,0 +1,323 @@
+"""Cross-user question difficulty analytics from the answers stored in test history.
+
+Every graded quiz keeps a per-question ``results`` list in
+``TestHistory.questions``. This module streams those rows in chunks (never
+the whole table) and accumulates, per question ID:
+
+- attempts, correct answers and unanswered attempts
+- how often each option was chosen
+
+Question IDs are a stable 63-bit hash of the question text, choices are keyed
+by a hash of the question text and the chosen content, so the state is two
+sorted ``int64`` key arrays with their count arrays. Each chunk is reduced
+with ``np.unique``/``np.add.at`` and merged into the state with
+``searchsorted``. The state is saved to ``instance/analytics/question_stats.npz``
+with the id of the last history row it includes, so updates only read new
+submissions.
+
+Graded quizzes schedule a background update (at most one per
+``UPDATE_DELAY`` seconds per process). The report joins the state with a
+subject's bank to flag hard, ambiguous and possibly mis-keyed questions.
+
+Usage:
+    python -m utils.analytics update               # fold in new submissions
+    python -m utils.analytics update --rebuild     # recompute from scratch
+    python -m utils.analytics report --subject AIL303m
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import func, select
+
+from . import jobs, user_context
+from .models import TestHistory, instance_path
+from .shared_bank import file_lock
+
+STATE_FILE = os.path.join(instance_path, "analytics", "question_stats.npz")
+CHUNK_ROWS = 500
+UPDATE_DELAY = 60.0
+
+MIN_ATTEMPTS = 10
+HARD_RATE = 0.3
+AMBIGUOUS_RATIO = 0.8
+
+_EMPTY_KEYS = np.empty(0, dtype=np.int64)
+
+
+@lru_cache(maxsize=65536)
+def question_id(text: str) -> int:
+    """Stable 63-bit ID of a question (or of a choice key) from its text"""
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+def choice_id(question_text: str, content: str) -> int:
+    return question_id(f"{question_text}\0{content}")
+
+
+def _normalize(content) -> str:
+    # Submitted and correct contents are stored without the leading "/"
+    return content.lstrip("/") if isinstance(content, str) else str(content)
+
+
+class CountTable:
+    """Sorted int64 keys with one row of int64 counts per key"""
+
+    def __init__(self, columns: int, keys=None, counts=None):
+        self.keys = _EMPTY_KEYS if keys is None else keys
+        self.counts = np.zeros((0, columns), np.int64) if counts is None else counts
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, keys: np.ndarray, counts: np.ndarray):
+        """Add ``counts`` (one row per entry of ``keys``, repeats allowed)"""
+        if not len(keys):
+            return
+        unique, inverse = np.unique(keys, return_inverse=True)
+        reduced = np.zeros((len(unique), self.counts.shape[1]), np.int64)
+        np.add.at(reduced, inverse, counts)
+
+        merged = np.union1d(self.keys, unique)
+        if len(merged) != len(self.keys):
+            grown = np.zeros((len(merged), self.counts.shape[1]), np.int64)
+            grown[np.searchsorted(merged, self.keys)] = self.counts
+            self.keys, self.counts = merged, grown
+        self.counts[np.searchsorted(self.keys, unique)] += reduced
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Counts for ``keys``, zeros for keys never seen"""
+        keys = np.asarray(keys, dtype=np.int64)
+        result = np.zeros((len(keys), self.counts.shape[1]), np.int64)
+        if not len(self.keys) or not len(keys):
+            return result
+        index = np.searchsorted(self.keys, keys)
+        index[index == len(self.keys)] = 0
+        found = self.keys[index] == keys
+        result[found] = self.counts[index[found]]
+        return result
+
+
+class QuestionStats:
+    def __init__(self):
+        self.questions = CountTable(3)
+        self.choices = CountTable(1)
+        self.watermark = 0
+        self.records = 0
+
+    def add_results(self, histories: Iterable[List[Dict[str, Any]]]):
+        """Fold the ``results`` lists of a chunk of history rows into the counts"""
+        qids: List[int] = []
+        flags: List[tuple] = []
+        cids: List[int] = []
+        for results in histories:
+            if not isinstance(results, list):
+                continue
+            for result in results:
+                text = result.get("question")
+                if not isinstance(text, str):
+                    continue
+                unanswered = bool(result.get("is_unanswered"))
+                qids.append(question_id(text))
+                flags.append((1, bool(result.get("is_correct")), unanswered))
+                if not unanswered:
+                    for content in result.get("submitted") or ():
+                        cids.append(choice_id(text, _normalize(content)))
+
+        self.records += len(qids)
+        self.questions.add(
+            np.array(qids, dtype=np.int64), np.array(flags, dtype=np.int64)
+        )
+        self.choices.add(
+            np.array(cids, dtype=np.int64), np.ones((len(cids), 1), np.int64)
+        )
+
+    def save(self, path: Optional[str] = None):
+        path = path or STATE_FILE
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            question_keys=self.questions.keys,
+            question_counts=self.questions.counts,
+            choice_keys=self.choices.keys,
+            choice_counts=self.choices.counts,
+            meta=np.array([self.watermark, self.records], dtype=np.int64),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> "QuestionStats":
+        path = path or STATE_FILE
+        stats = cls()
+        if not os.path.exists(path):
+            return stats
+        with np.load(path) as data:
+            stats.questions = CountTable(
+                3, data["question_keys"], data["question_counts"]
+            )
+            stats.choices = CountTable(1, data["choice_keys"], data["choice_counts"])
+            stats.watermark, stats.records = (int(v) for v in data["meta"])
+        return stats
+
+
+_cached: Optional[QuestionStats] = None
+_cached_mtime = None
+_last_scheduled = 0.0
+
+
+def load(path: Optional[str] = None) -> QuestionStats:
+    """The saved state, read again only when the file changed"""
+    global _cached, _cached_mtime
+    path = path or STATE_FILE
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return QuestionStats()
+    if _cached is None or _cached_mtime != mtime:
+        _cached, _cached_mtime = QuestionStats.load(path), mtime
+    return _cached
+
+
+def update(rebuild: bool = False, chunk_rows: int = CHUNK_ROWS, path=None):
+    """Fold history rows newer than the saved watermark into the state"""
+    path = path or STATE_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_lock(path):
+        stats = QuestionStats() if rebuild else QuestionStats.load(path)
+        session = user_context.Session()
+        rows = 0
+        try:
+            # Only the results are decoded, not the question snapshots
+            result = session.execute(
+                select(
+                    TestHistory.id,
+                    func.json_extract(TestHistory.questions, "$.results"),
+                )
+                .where(TestHistory.id > stats.watermark)
+                .order_by(TestHistory.id)
+                .execution_options(yield_per=chunk_rows)
+            )
+            for partition in result.partitions():
+                stats.add_results(
+                    json.loads(results) for _, results in partition if results
+                )
+                stats.watermark = partition[-1][0]
+                rows += len(partition)
+        finally:
+            session.close()
+        if rows or rebuild:
+            stats.save(path)
+    return rows, stats
+
+
+@jobs.job("update_question_stats")
+def _update_job():
+    update()
+
+
+def schedule_update():
+    """Queue a background update, at most once per UPDATE_DELAY in this process"""
+    global _last_scheduled
+    now = time.monotonic()
+    if now - _last_scheduled < UPDATE_DELAY:
+        return
+    _last_scheduled = now
+    jobs.enqueue("update_question_stats", delay=UPDATE_DELAY)
+
+
+def report(questions, stats: Optional[QuestionStats] = None) -> List[Dict[str, Any]]:
+    """Per-question rows for a bank, hardest first"""
+    stats = stats or load()
+    texts = [q["text"] for q in questions]
+    counts = stats.questions.lookup([question_id(t) for t in texts])
+
+    contents = [[_normalize(o["content"]) for o in q["options"]] for q in questions]
+    chosen = stats.choices.lookup(
+        [choice_id(t, c) for t, options in zip(texts, contents) for c in options]
+    )[:, 0]
+    offsets = np.cumsum([0] + [len(options) for options in contents])
+
+    rows = []
+    for i, question in enumerate(questions):
+        attempts, correct, unanswered = (int(v) for v in counts[i])
+        answered = attempts - unanswered
+        keyed = {_normalize(a) for a in question["correct_answers"]}
+        choices = sorted(
+            (
+                {"content": c, "count": int(n), "keyed": c in keyed}
+                for c, n in zip(contents[i], chosen[offsets[i] : offsets[i + 1]])
+            ),
+            key=lambda choice: -choice["count"],
+        )
+
+        flags = []
+        rate = correct / attempts if attempts else None
+        if attempts >= MIN_ATTEMPTS:
+            keyed_picks = sum(c["count"] for c in choices if c["keyed"])
+            wrong = [c for c in choices if not c["keyed"]]
+            top_wrong = wrong[0]["count"] if wrong else 0
+            if rate < HARD_RATE:
+                flags.append("hard")
+            if answered and top_wrong > keyed_picks and top_wrong * 2 >= answered:
+                flags.append("mis-keyed?")
+            elif keyed_picks and top_wrong >= AMBIGUOUS_RATIO * keyed_picks:
+                flags.append("ambiguous")
+
+        rows.append(
+            {
+                "text": texts[i],
+                "attempts": attempts,
+                "correct_rate": rate,
+                "unanswered_rate": unanswered / attempts if attempts else None,
+                "choices": choices,
+                "flags": flags,
+            }
+        )
+
+    rows.sort(key=lambda r: (r["correct_rate"] is None, r["correct_rate"] or 0))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Question difficulty analytics")
+    sub = parser.add_subparsers(dest="command", required=True)
+    update_parser = sub.add_parser("update", help="Fold new submissions in")
+    update_parser.add_argument("--rebuild", action="store_true")
+    update_parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    report_parser = sub.add_parser("report", help="Print a subject's hardest questions")
+    report_parser.add_argument("--subject", default="AIL303m")
+    report_parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    if args.command == "update":
+        start = time.perf_counter()
+        rows, stats = update(args.rebuild, args.chunk_rows)
+        print(
+            f"Read {rows} history rows in {time.perf_counter() - start:.2f}s; "
+            f"{stats.records} answers over {len(stats.questions)} questions, "
+            f"watermark {stats.watermark}"
+        )
+        return 0
+
+    from .quiz_handler import QuizHandler
+
+    handler = QuizHandler(args.subject)
+    for row in report(handler.questions)[: args.limit]:
+        rate = "-" if row["correct_rate"] is None else f"{row['correct_rate']:.0%}"
+        print(
+            f"{rate:>5} {row['attempts']:>7} {','.join(row['flags']):<18} "
+            f"{row['text'][:70]!r}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,331 @@
+"""Micro-benchmarks for the QuizHandler hot paths.
+
+Runs each hot path against synthetic banks and users with large penalty and
+bag state, then compares the timings and allocations with the last saved run
+in ``data/benchmark/results.json``.
+
+Usage:
+    python -m utils.benchmark                      # run and compare with the baseline
+    python -m utils.benchmark --save --label pr-12 # run and append to the results file
+    python -m utils.benchmark --sizes 1000 10000 --threshold 0.25
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+# The benchmarks write users, quizzes and history rows, so they run against a
+# scratch database instead of instance/quiz.db.
+_scratch_dir = tempfile.mkdtemp(prefix="eos-bench-")
+os.environ.setdefault("QUIZ_DB_PATH", os.path.join(_scratch_dir, "bench.db"))
+
+import logging  # noqa: E402
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from utils.generate_data import write_bank  # noqa: E402
+from utils.models import Subject, engine, init_db  # noqa: E402
+from utils.quiz_handler import QuizHandler  # noqa: E402
+
+RESULTS_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "data", "benchmark", "results.json"
+)
+RESULTS_SCHEMA = 1
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_THRESHOLD = 0.20
+BENCH_USER = "bench_user"
+
+
+def _seed_user(handler: QuizHandler, penalty_ratio: float, bag_ratio: float, seed=0):
+    """Give the benchmark user a large penalty and bag state for the handler's bank"""
+    rng = random.Random(seed)
+    texts = [q["text"] for q in handler.questions]
+    penalties = rng.sample(texts, int(len(texts) * penalty_ratio))
+    penalty_set = set(penalties)
+    rest = [t for t in texts if t not in penalty_set]
+    bag = rng.sample(rest, int(len(rest) * bag_ratio))
+
+    user = handler.get_user_progress(BENCH_USER)
+    user.penalty_questions = {
+        handler.subject.code: {t: rng.randint(1, 3) for t in penalties}
+    }
+    user.question_bag = {handler.subject.code: bag}
+    if user.active_quiz:
+        handler.db.delete(user.active_quiz)
+    handler.db.commit()
+
+
+def _answers_for(quiz, correct_ratio=0.5, seed=0):
+    rng = random.Random(seed)
+    answers = {}
+    for i, question in enumerate(quiz["questions"]):
+        if rng.random() < correct_ratio:
+            answers[str(i + 1)] = list(question["correct_answers"])
+        else:
+            answers[str(i + 1)] = [question["options"][0]["content"]]
+    return answers
+
+
+def _measure(fn, setup=None, min_time=0.5, max_repeat=5):
+    """Time ``fn`` a few times and record the allocations of one extra run"""
+    timings = []
+    while len(timings) < max_repeat and (not timings or sum(timings) < min_time):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    fn(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "repeat": len(timings),
+        "alloc_peak": peak,
+        "alloc_retained": current,
+    }
+
+
+def _cases(handler: QuizHandler, num_questions: int):
+    """Yield (name, fn, setup) for every hot path on the given handler"""
+    choices = [row for row in _raw_choices(handler.quiz_file)]
+
+    def load_questions():
+        handler._options_cache.clear()
+        handler._load_questions()
+
+    def clean_list_string():
+        handler._options_cache.clear()
+        for s in choices:
+            handler._clean_list_string(s)
+
+    def reset_user():
+        _seed_user(handler, penalty_ratio=0.1, bag_ratio=0.5)
+        return ()
+
+    def empty_bag():
+        user = handler.get_user_progress(BENCH_USER)
+        user.question_bag[handler.subject.code] = []
+        handler.db.commit()
+        return ()
+
+    def prepare_grading():
+        # Built by hand so that grading is not dominated by quiz generation
+        _seed_user(handler, penalty_ratio=0.1, bag_ratio=0.5)
+        selected = random.Random(0).sample(handler.questions, num_questions)
+        quiz = {
+            "questions": selected,
+            "num_questions": len(selected),
+            "start_time": datetime.now().isoformat(),
+        }
+        return quiz, _answers_for(quiz)
+
+    yield "load_questions", load_questions, None
+    yield "clean_list_string", clean_list_string, None
+    yield "get_user_progress", lambda: handler.get_user_progress(BENCH_USER), reset_user
+    yield "get_user_progress_refill", (
+        lambda: handler.get_user_progress(BENCH_USER, handler.subject.code)
+    ), empty_bag
+    yield "initialize_quiz", (
+        lambda: handler.initialize_quiz(BENCH_USER, num_questions)
+    ), reset_user
+    yield "initialize_quiz_shuffled", (
+        lambda: handler.initialize_quiz(BENCH_USER, num_questions, True)
+    ), reset_user
+    yield "grade_quiz", (
+        lambda quiz, answers: handler.grade_quiz(BENCH_USER, quiz, answers)
+    ), prepare_grading
+
+
+def _raw_choices(path):
+    import csv
+
+    with open(path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            yield row[1]
+
+
+def _register_bank(db, size: int) -> str:
+    code = f"BENCH{size}"
+    path = os.path.join(_scratch_dir, f"{code}.csv")
+    write_bank(path, size)
+    subject = db.query(Subject).filter_by(code=code).first()
+    if not subject:
+        db.add(Subject(code=code, name=f"Benchmark bank ({size})", data_file=path))
+    else:
+        subject.data_file = path
+    db.commit()
+    return code
+
+
+def _project(history, size):
+    """Extrapolate the time per call at ``size`` from the growth seen so far"""
+    if not history:
+        return 0.0
+    last_size, last_time = history[-1]
+    exponent = 1.0
+    if len(history) > 1:
+        prev_size, prev_time = history[-2]
+        if prev_time > 0 and last_time > 0:
+            exponent = max(
+                1.0, math.log(last_time / prev_time) / math.log(last_size / prev_size)
+            )
+    return last_time * (size / last_size) ** exponent
+
+
+def run_benchmarks(sizes, num_questions=50, budget=60.0, only=None):
+    """Run every case for every bank size, skipping sizes projected to blow the budget"""
+    init_db()
+    db = sessionmaker(bind=engine)()
+    history = {}
+    results = {}
+
+    for size in sizes:
+        code = _register_bank(db, size)
+        with contextlib.redirect_stdout(io.StringIO()):
+            handler = QuizHandler(code)
+            _seed_user(handler, penalty_ratio=0.1, bag_ratio=0.5)
+
+        for name, fn, setup in _cases(handler, num_questions):
+            if only and name not in only:
+                continue
+            key = f"{name}[{size}]"
+            projected = _project(history.get(name, []), size)
+            if projected > budget:
+                results[key] = {"skipped": f"projected {projected:.0f}s per call"}
+                print(f"{key:40} skipped (projected {projected:.0f}s per call)")
+                continue
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = _measure(fn, setup)
+            results[key] = result
+            print(
+                f"{key:40} median {result['median'] * 1000:10.2f} ms"
+                f"  peak {result['alloc_peak'] / 1024:10.1f} KiB"
+            )
+            history.setdefault(name, []).append((size, result["median"]))
+
+    db.close()
+    return results
+
+
+def load_results(path=RESULTS_FILE):
+    if not os.path.exists(path):
+        return {"schema": RESULTS_SCHEMA, "runs": []}
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("schema") != RESULTS_SCHEMA:
+        raise ValueError(f"Unsupported benchmark results schema: {data.get('schema')}")
+    return data
+
+
+def save_run(results, label, path=RESULTS_FILE):
+    data = load_results(path)
+    data["runs"].append(
+        {
+            "label": label,
+            "commit": _git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+    )
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+def find_regressions(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """Return (case, metric, old, new) for every metric slower or larger than allowed"""
+    regressions = []
+    for key, new in results.items():
+        old = baseline.get(key)
+        if not old or "skipped" in old or "skipped" in new:
+            continue
+        for metric in ("median", "alloc_peak"):
+            if old[metric] and new[metric] > old[metric] * (1 + threshold):
+                regressions.append((key, metric, old[metric], new[metric]))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--num-questions", type=int, default=50)
+    parser.add_argument("--only", nargs="+", help="Only run the named cases")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Allowed slowdown before a case is flagged (0.2 = 20%%)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=60.0,
+        help="Skip a size when a case is projected to take longer than this per call",
+    )
+    parser.add_argument("--baseline", help="Label of the run to compare against")
+    parser.add_argument("--save", action="store_true", help="Append this run")
+    parser.add_argument("--label", default=None)
+    args = parser.parse_args(argv)
+
+    logging.getLogger("utils").setLevel(logging.WARNING)
+    results = run_benchmarks(
+        args.sizes, args.num_questions, budget=args.budget, only=args.only
+    )
+
+    runs = load_results()["runs"]
+    if args.baseline:
+        runs = [run for run in runs if run["label"] == args.baseline]
+    regressions = []
+    if runs:
+        baseline = runs[-1]
+        regressions = find_regressions(results, baseline["results"], args.threshold)
+        print(f"\nCompared with run '{baseline['label']}' ({baseline['commit']})")
+        for key, metric, old, new in regressions:
+            print(f"REGRESSION {key} {metric}: {old:.6g} -> {new:.6g}")
+        if not regressions:
+            print("No regressions")
+
+    if args.save:
+        save_run(results, args.label or _git_commit() or "unlabelled")
+        print(f"Saved results to {RESULTS_FILE}")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,309 @@
+"""Streaming export of test history, one row per question result.
+
+Rows are read by id in pages of ``PAGE_ROWS`` attempts, each in its own
+short read, and written out in chunks. An export holds one page of
+attempts at a time however many it covers, and never keeps the database
+locked while the client downloads. Only the ``results`` list of each
+attempt's payload is read: SQLite extracts it with ``json_extract``, so the
+stored questions are never decoded.
+Archived attempts (see ``utils.maintenance``) come first, as they are older
+than every attempt left in test_history.
+
+Each row has the attempt (id, user, subject, date, score, time) and one
+question result (number, stable question id, text, submitted and correct
+answers, outcome). In CSV the answer lists are JSON arrays.
+
+The app serves the same export at ``/export`` (the user's own attempts) and
+``/admin/export``.
+
+Usage:
+    python -m utils.export --user alice --subject AIL303m > alice.csv
+    python -m utils.export --format ndjson --since 2024-09-01 --output all.ndjson
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+import zlib
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from sqlalchemy import func, select
+
+from . import maintenance
+from .analytics import question_id
+from .models import Subject, TestHistory, User, engine
+
+PAGE_ROWS = 500
+CHUNK_ROWS = 1000
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+_encode = json.JSONEncoder(ensure_ascii=False).encode
+FIELDS = (
+    "test_id",
+    "archived",
+    "username",
+    "subject",
+    "completed_at",
+    "score",
+    "time_taken",
+    "question_number",
+    "question_id",
+    "question",
+    "submitted",
+    "correct",
+    "is_correct",
+    "is_unanswered",
+)
+_LIST_COLUMNS = (FIELDS.index("submitted"), FIELDS.index("correct"))
+
+
+class Filters:
+    """Which attempts to export; ``None`` matches everything"""
+
+    def __init__(
+        self,
+        user_id: Optional[int] = None,
+        subject_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        archived: bool = True,
+    ):
+        self.user_id = user_id
+        self.subject_id = subject_id
+        self.since = since
+        self.until = until
+        self.archived = archived
+
+    def apply(self, statement, columns):
+        if self.user_id is not None:
+            statement = statement.where(columns.user_id == self.user_id)
+        if self.subject_id is not None:
+            statement = statement.where(columns.subject_id == self.subject_id)
+        if self.since is not None:
+            statement = statement.where(columns.completed_at >= self.since)
+        if self.until is not None:
+            statement = statement.where(columns.completed_at < self.until)
+        return statement
+
+
+def resolve(
+    username: Optional[str] = None,
+    subject_code: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    archived: bool = True,
+) -> Filters:
+    """Filters from names and ISO dates; raises ValueError for unknown ones"""
+    filters = Filters(archived=archived)
+    with engine.connect() as conn:
+        if username:
+            filters.user_id = conn.execute(
+                select(User.id).where(User.username == username)
+            ).scalar()
+            if filters.user_id is None:
+                raise ValueError(f"User {username} not found")
+        if subject_code:
+            filters.subject_id = conn.execute(
+                select(Subject.id).where(Subject.code == subject_code)
+            ).scalar()
+            if filters.subject_id is None:
+                raise ValueError(f"Subject {subject_code} not found")
+    filters.since = datetime.fromisoformat(since) if since else None
+    filters.until = datetime.fromisoformat(until) if until else None
+    return filters
+
+
+@lru_cache(maxsize=10000)
+def _username(user_id: int) -> Optional[str]:
+    with engine.connect() as conn:
+        return conn.execute(select(User.username).where(User.id == user_id)).scalar()
+
+
+def _subject_codes() -> Dict[int, str]:
+    with engine.connect() as conn:
+        return dict(conn.execute(select(Subject.id, Subject.code)).all())
+
+
+def _question_rows(
+    row, username: Optional[str], subject: Optional[str], archived: bool, results
+) -> Iterator[Dict[str, Any]]:
+    attempt = {
+        "test_id": row.id,
+        "archived": archived,
+        "username": username,
+        "subject": subject,
+        "completed_at": row.completed_at.isoformat() if row.completed_at else None,
+        "score": row.score,
+        "time_taken": row.time_taken,
+    }
+    for number, result in enumerate(results or (), 1):
+        text = result.get("question", "")
+        yield {
+            **attempt,
+            "question_number": number,
+            "question_id": question_id(text),
+            "question": text,
+            "submitted": result.get("submitted", []),
+            "correct": result.get("correct", []),
+            "is_correct": bool(result.get("is_correct")),
+            "is_unanswered": bool(result.get("is_unanswered")),
+        }
+
+
+def _pages(bind, statement, id_column, page_rows: Optional[int] = None):
+    """Rows of ``statement`` in id order, one short read per page
+
+    No read stays open while the client downloads: in rollback-journal mode
+    an open read would lock out every writer, quiz submissions included.
+    """
+    page_rows = page_rows or PAGE_ROWS
+    last_id = 0
+    while True:
+        with bind.connect() as conn:
+            page = conn.execute(
+                statement.where(id_column > last_id)
+                .order_by(id_column)
+                .limit(page_rows)
+            ).all()
+        yield from page
+        if len(page) < page_rows:
+            return
+        last_id = page[-1].id
+
+
+def _archived_rows(filters: Filters, codes: Dict[int, str]):
+    archive = maintenance.archive_engine() if filters.archived else None
+    if archive is None:
+        return
+    t = maintenance.archived_history.c
+    statement = filters.apply(
+        select(
+            t.id,
+            t.user_id,
+            t.subject_id,
+            t.score,
+            t.time_taken,
+            t.completed_at,
+            t.payload,
+        ),
+        t,
+    )
+    for row in _pages(archive, statement, t.id):
+        questions = json.loads(zlib.decompress(row.payload)) if row.payload else {}
+        yield from _question_rows(
+            row,
+            _username(row.user_id),
+            codes.get(row.subject_id),
+            True,
+            questions.get("results"),
+        )
+
+
+def _live_rows(filters: Filters, codes: Dict[int, str]):
+    statement = filters.apply(
+        select(
+            TestHistory.id,
+            User.username,
+            TestHistory.subject_id,
+            TestHistory.score,
+            TestHistory.time_taken,
+            TestHistory.completed_at,
+            func.json_extract(TestHistory.questions, "$.results").label("results"),
+        ).join(User, User.id == TestHistory.user_id),
+        TestHistory,
+    )
+    for row in _pages(engine, statement, TestHistory.id):
+        yield from _question_rows(
+            row,
+            row.username,
+            codes.get(row.subject_id),
+            False,
+            json.loads(row.results) if row.results else None,
+        )
+
+
+def rows(filters: Filters) -> Iterator[Dict[str, Any]]:
+    """Question result rows of the matching attempts, oldest attempt first"""
+    codes = _subject_codes()
+    yield from _archived_rows(filters, codes)
+    yield from _live_rows(filters, codes)
+
+
+def _chunks(lines: Iterable[str], chunk_rows: int) -> Iterator[str]:
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= chunk_rows:
+            yield "".join(buffer)
+            buffer.clear()
+    if buffer:
+        yield "".join(buffer)
+
+
+def to_csv(records: Iterable[Dict], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for count, record in enumerate(records, 1):
+        values = [record[field] for field in FIELDS]
+        for column in _LIST_COLUMNS:
+            values[column] = _encode(values[column])
+        writer.writerow(values)
+        if count % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_ndjson(records: Iterable[Dict], chunk_rows: int = CHUNK_ROWS) -> Iterator[str]:
+    return _chunks(
+        (_encode(record) + "\n" for record in records),
+        chunk_rows,
+    )
+
+
+def stream(filters: Filters, fmt: str = "csv") -> Iterator[str]:
+    """Chunks of the export in ``fmt`` (a key of ``FORMATS``)"""
+    writer = to_csv if fmt == "csv" else to_ndjson
+    return writer(rows(filters))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export test history results")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+    parser.add_argument("--user", help="Username (default: every user)")
+    parser.add_argument("--subject", help="Subject code (default: every subject)")
+    parser.add_argument("--since", help="ISO date or time, inclusive")
+    parser.add_argument("--until", help="ISO date or time, exclusive")
+    parser.add_argument("--no-archived", action="store_true")
+    parser.add_argument("--output", help="File to write (default: stdout)")
+    args = parser.parse_args(argv)
+
+    try:
+        filters = resolve(
+            args.user, args.subject, args.since, args.until, not args.no_archived
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    out = (
+        open(args.output, "w", encoding="utf-8", newline="")
+        if args.output
+        else sys.stdout
+    )
+    try:
+        for chunk in stream(filters, args.format):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
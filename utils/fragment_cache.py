@@ -0,0 +1,186 @@
+"""Template bytecode cache and an LRU cache of rendered template fragments.
+
+Compiled templates are kept in ``instance/jinja`` (``FileSystemBytecodeCache``),
+so a new worker loads bytecode instead of compiling every template again.
+
+Parts of a page that only change with known data are cached with the
+``cache`` tag, keyed by stable identifiers (a history row id, a user and
+the number and latest id of their tests, the stats row's update time)::
+
+    {% cache ("result", results.user_id, results.test_id), ("user", results.user_id) %}
+      ... expensive loop ...
+    {% endcache %}
+
+The optional second expression is a tag: ``cache.invalidate(tag)`` drops
+every fragment stored under it, which grade_quiz does for the user's tag.
+Keys are built from the data itself, so a fragment stored by one worker
+process never goes stale when another one changes the data; invalidation
+mostly frees memory early. A missing or ``None`` key renders without
+caching. The cache is bounded by the total size of the fragments and
+evicts the least recently used.
+
+Enabled by ``init_app`` unless ``EOS_FRAGMENT_CACHE=0``.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Set
+
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from jinja2.runtime import Undefined
+
+from .metrics import Counter, Gauge, registry
+from .models import instance_path
+
+BYTECODE_DIR = os.path.join(instance_path, "jinja")
+DEFAULT_MAX_BYTES = 32 * 2**20
+
+FRAGMENT_LOOKUPS = Counter(
+    "eos_fragment_cache_lookups_total", "Template fragment cache lookups by result"
+)
+
+
+class FragmentCache:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.enabled = False
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        self._key_tags: Dict[Hashable, Hashable] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: str, tag: Optional[Hashable] = None):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            self._untag(key)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+                self._key_tags[key] = tag
+            while self.size > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self._untag(evicted_key)
+
+    def _untag(self, key: Hashable):
+        tag = self._key_tags.pop(key, None)
+        if tag is not None:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, tag: Hashable) -> int:
+        """Drop every fragment stored under ``tag``; return how many were cached"""
+        with self._lock:
+            dropped = 0
+            for key in self._tags.pop(tag, ()):
+                self._key_tags.pop(key, None)
+                value = self._entries.pop(key, None)
+                if value is not None:
+                    self.size -= len(value)
+                    dropped += 1
+            return dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._key_tags.clear()
+            self.size = 0
+
+    def render(
+        self, key: Hashable, render: Callable[[], str], tag: Optional[Hashable] = None
+    ) -> str:
+        if not self.enabled:
+            return render()
+        value = self.get(key)
+        if value is not None:
+            FRAGMENT_LOOKUPS.inc(result="hit")
+            return value
+        FRAGMENT_LOOKUPS.inc(result="miss")
+        value = render()
+        self.put(key, value, tag)
+        return value
+
+
+cache = FragmentCache()
+
+registry.append(FRAGMENT_LOOKUPS)
+registry.append(
+    Gauge(
+        "eos_fragment_cache_bytes",
+        "Characters of rendered fragments held in this process's cache",
+        lambda: [({}, cache.size)],
+    )
+)
+
+
+def _missing(value) -> bool:
+    return value is None or isinstance(value, Undefined)
+
+
+class CacheExtension(Extension):
+    """``{% cache key[, tag] %}...{% endcache %}`` backed by ``cache``"""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render", args), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, key, tag, caller):
+        if _missing(key):
+            return caller()
+        return cache.render(key, caller, None if _missing(tag) else tag)
+
+
+class Deferred:
+    """Iterable that runs ``load`` on first use, so a cached fragment skips it"""
+
+    def __init__(self, load: Callable):
+        self._load = load
+        self._value = None
+
+    def __iter__(self):
+        if self._value is None:
+            self._value = self._load()
+        return iter(self._value)
+
+
+def init_app(app):
+    app.config.setdefault(
+        "FRAGMENT_CACHE", os.environ.get("EOS_FRAGMENT_CACHE", "1") != "0"
+    )
+    app.config.setdefault("FRAGMENT_CACHE_BYTES", DEFAULT_MAX_BYTES)
+    cache.enabled = app.config["FRAGMENT_CACHE"]
+    cache.max_bytes = app.config["FRAGMENT_CACHE_BYTES"]
+
+    os.makedirs(BYTECODE_DIR, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(BYTECODE_DIR)
+    app.jinja_env.add_extension(CacheExtension)
@@ -0,0 +1,262 @@
+"""Generate production-shaped question banks and user histories for scaling tests.
+
+Usage:
+    python -m utils.generate_data bank --code SYN10K --size 10000
+    python -m utils.generate_data users --subject SYN10K --count 5000 --history 5
+
+Banks are written to data/bank/<code>.csv in the same dialect as the shipped
+banks and registered as subjects. Users, their penalty and bag state and their
+test history are written to the configured database (instance/quiz.db unless
+QUIZ_DB_PATH is set).
+"""
+
+import argparse
+import csv
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+
+from .models import Subject, TestHistory, User, engine, init_db
+
+BANK_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "bank")
+IMAGES = [f"static/img/{i}.png" for i in range(1, 11)]
+
+WORDS = (
+    "model data training feature label gradient loss function network layer "
+    "requirement design testing process agile waterfall module component class "
+    "object interface dataset variance bias regression classification cluster "
+    "kernel margin vector matrix algorithm complexity software system user "
+    "stakeholder review quality defect iteration sprint accuracy precision recall"
+).split()
+STEMS = [
+    "Which of the following best describes {}?",
+    "What is the main purpose of {}?",
+    "Which statement about {} is correct?",
+    "In the context of {}, which option is true?",
+    "What happens to {} when the {} increases?",
+]
+
+
+def _phrase(rng: random.Random, low: int = 2, high: int = 6) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def _sentence(rng: random.Random) -> str:
+    text = _phrase(rng, 4, 14).capitalize()
+    if rng.random() < 0.2:
+        # Commas and apostrophes exercise the quoting of the list literals
+        text += f", {_phrase(rng, 1, 4)}'s {_phrase(rng, 1, 3)}"
+    return text + "."
+
+
+def generate_question(
+    rng: random.Random, index: int, image_ratio: float = 0.05, multi_ratio: float = 0.2
+) -> Dict[str, object]:
+    """Build one question row as {"question", "choices", "answer"}"""
+    roll = rng.random()
+
+    if roll < 0.1:
+        text = f"(True/False) {_sentence(rng)[:-1]} (#{index})"
+        choices = rng.choice([["False", "True"], ["True", "False"]])
+        answer = [rng.choice(choices)]
+        return {"question": text, "choices": choices, "answer": answer}
+
+    stem = rng.choice(STEMS).format(*(_phrase(rng, 1, 3) for _ in range(2)))
+    text = f"{stem} (#{index})"
+
+    if roll < 0.1 + image_ratio / 2:
+        choices = rng.sample(IMAGES, 4)
+        text = f"Select the image that best shows the {_phrase(rng, 1, 3)} (#{index})."
+        return {"question": text, "choices": choices, "answer": [rng.choice(choices)]}
+
+    if roll < 0.1 + image_ratio:
+        spacer = rng.choice(["", " "])
+        text = f"{text} [Image:{spacer}{rng.choice(IMAGES)}]"
+
+    choices = [_sentence(rng) for _ in range(rng.randint(3, 6))]
+    if rng.random() < multi_ratio:
+        count = rng.randint(2, len(choices) - 1)
+        text = f"{text} Select {count}."
+        answer = rng.sample(choices, count)
+    else:
+        answer = [rng.choice(choices)]
+    return {"question": text, "choices": choices, "answer": answer}
+
+
+def write_bank(
+    path: str,
+    size: int,
+    seed: int = 0,
+    image_ratio: float = 0.05,
+    multi_ratio: float = 0.2,
+):
+    """Write a bank of ``size`` questions in the CSV dialect of data/bank"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["question", "choices", "answer"])
+        for i in range(size):
+            row = generate_question(rng, i, image_ratio, multi_ratio)
+            writer.writerow([row["question"], str(row["choices"]), str(row["answer"])])
+
+
+def register_bank(code: str, path: str, name: str = None) -> Subject:
+    """Add the bank as a subject, or point the existing subject at it"""
+    session = sessionmaker(bind=engine)()
+    subject = session.query(Subject).filter_by(code=code).first()
+    data_file = os.path.relpath(path, BANK_DIR) if path.startswith(BANK_DIR) else path
+    if subject:
+        subject.data_file = data_file
+    else:
+        subject = Subject(code=code, name=name or f"Synthetic {code}", data_file=data_file)
+        session.add(subject)
+    session.commit()
+    session.close()
+    return subject
+
+
+def _history_entry(
+    rng: random.Random, questions: List[Dict], penalties: Dict[str, int], now: datetime
+) -> Dict[str, object]:
+    """One TestHistory row with the payload shape written by grade_quiz"""
+    selected = rng.sample(questions, min(len(questions), rng.randint(20, 50)))
+    skill = rng.uniform(0.3, 0.95)
+    answers, results = {}, []
+    correct_count = 0
+
+    for i, question in enumerate(selected):
+        correct = [c.lstrip("/") for c in question["correct_answers"]]
+        if rng.random() < 0.05:
+            submitted, answered = ["No answer"], False
+        elif rng.random() < skill:
+            submitted, answered = correct, True
+        else:
+            submitted = [rng.choice(question["options"])["content"].lstrip("/")]
+            answered = True
+        is_correct = answered and set(submitted) == set(correct)
+        if answered:
+            answers[str(i + 1)] = submitted
+        if is_correct:
+            correct_count += 1
+        else:
+            penalties[question["text"]] = penalties.get(question["text"], 0) + 1
+        results.append(
+            {
+                "question": question["text"],
+                "submitted": submitted,
+                "correct": correct,
+                "is_correct": is_correct,
+                "is_unanswered": not answered,
+            }
+        )
+
+    return {
+        "score": round(correct_count / len(selected) * 10, 1),
+        "time_taken": rng.randint(60, 45 * 60),
+        "completed_at": now - timedelta(minutes=rng.randint(0, 180 * 24 * 60)),
+        "questions": {"questions": selected, "answers": answers, "results": results},
+    }
+
+
+def populate_users(
+    subject_code: str,
+    count: int,
+    history: int = 3,
+    seed: int = 0,
+    prefix: str = "synthetic_user",
+    batch_size: int = 500,
+):
+    """Insert ``count`` users with penalty, bag and TestHistory rows for a subject"""
+    from .quiz_handler import QuizHandler
+
+    handler = QuizHandler(subject_code)
+    questions = handler.questions
+    if not questions:
+        raise ValueError(f"Subject {subject_code} has no questions")
+    texts = [q["text"] for q in questions]
+    subject_id = handler.subject.id
+    handler.db.close()
+
+    rng = random.Random(seed)
+    now = datetime.now()
+    session = sessionmaker(bind=engine)()
+    start = session.query(User).filter(User.username.like(f"{prefix}_%")).count()
+
+    for offset in range(0, count, batch_size):
+        users, histories = [], []
+        for n in range(start + offset, start + min(offset + batch_size, count)):
+            penalties = {}
+            attempts = [
+                _history_entry(rng, questions, penalties, now)
+                for _ in range(rng.randint(0, history * 2))
+            ]
+            for text in list(penalties):
+                # Later correct answers pay most penalties back off
+                penalties[text] -= rng.randint(0, penalties[text])
+                if penalties[text] <= 0:
+                    del penalties[text]
+            seen = rng.random()
+            bag = [t for t in texts if t not in penalties and rng.random() > seen]
+            users.append(
+                {
+                    "username": f"{prefix}_{n}",
+                    "penalty_questions": {subject_code: penalties},
+                    "question_bag": {subject_code: bag},
+                }
+            )
+            histories.append(attempts)
+
+        ids = session.scalars(insert(User).returning(User.id), users).all()
+        rows = [
+            dict(attempt, user_id=user_id, subject_id=subject_id)
+            for user_id, attempts in zip(ids, histories)
+            for attempt in attempts
+        ]
+        if rows:
+            session.execute(insert(TestHistory), rows)
+        session.commit()
+        print(f"Inserted {offset + len(users)}/{count} users, {len(rows)} attempts")
+
+    session.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bank = commands.add_parser("bank", help="Write a synthetic question bank")
+    bank.add_argument("--code", required=True, help="Subject code, e.g. SYN10K")
+    bank.add_argument("--size", type=int, default=10000)
+    bank.add_argument("--output", help="CSV path (default data/bank/<code>.csv)")
+    bank.add_argument("--image-ratio", type=float, default=0.05)
+    bank.add_argument("--multi-ratio", type=float, default=0.2)
+    bank.add_argument("--seed", type=int, default=0)
+
+    users = commands.add_parser("users", help="Insert synthetic users and history")
+    users.add_argument("--subject", required=True)
+    users.add_argument("--count", type=int, default=2000)
+    users.add_argument(
+        "--history", type=int, default=3, help="Average attempts per user"
+    )
+    users.add_argument("--prefix", default="synthetic_user")
+    users.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args(argv)
+    init_db()
+
+    if args.command == "bank":
+        path = args.output or os.path.join(BANK_DIR, f"{args.code}.csv")
+        write_bank(path, args.size, args.seed, args.image_ratio, args.multi_ratio)
+        register_bank(args.code, path)
+        print(f"Wrote {args.size} questions to {path}")
+    else:
+        populate_users(args.subject, args.count, args.history, args.seed, args.prefix)
+
+
+if __name__ == "__main__":
+    main()
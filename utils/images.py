@@ -0,0 +1,267 @@
+"""Responsive variants of the images referenced by question banks.
+
+Questions reference images in their text (``[Image:static/img/...]``) and as
+image options, and used to be served at full resolution only.
+``python -m utils.images build`` writes, for every image a bank references,
+WebP variants at ``WIDTHS`` (and at the original width, never upscaled) to
+``static/img/variants``, and a manifest with each image's dimensions and
+``srcset``. Variant names carry a hash of the source file, so an edited image
+gets new URLs; unchanged images are skipped and variants no longer listed are
+deleted. Animated GIFs only get their dimensions.
+
+The exam page attaches the manifest entries to the questions it sends
+(``annotate``), so the client can render ``srcset``/``width``/``height`` and
+preload the images of the next questions. Images missing from the manifest
+are served as before.
+
+Pillow is only needed to build: ``pip install -r requirements-optional.txt``.
+
+Usage:
+    python -m utils.images build                     # every subject
+    python -m utils.images build --subject AIL303m --widths 480 960
+    python -m utils.images status
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set
+
+from sqlalchemy import select
+
+from .models import Subject, engine
+from .question import QuestionMapping
+
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+STATIC_DIR = "static"
+VARIANT_DIR = os.path.join(STATIC_DIR, "img", "variants")
+MANIFEST_PATH = os.path.join(VARIANT_DIR, "manifest.json")
+WIDTHS = (320, 640, 1024)
+QUALITY = 80
+
+_manifest: Dict[str, Any] = {"mtime": None, "images": {}}
+_manifest_lock = threading.Lock()
+
+
+def question_images(question) -> List[str]:
+    """URLs of the images of a question: its stem image, then image options"""
+    urls = [question["image_url"]] if question["image_url"] else []
+    urls.extend(
+        option["content"] for option in question["options"] if option["type"] == "image"
+    )
+    return urls
+
+
+def bank_images(subject_codes: Optional[Sequence[str]] = None) -> Set[str]:
+    """URLs of every image referenced by the banks of the given subjects"""
+    from .quiz_handler import QuizHandler
+
+    with engine.connect() as conn:
+        codes = conn.execute(select(Subject.code).order_by(Subject.code)).scalars()
+        codes = [code for code in codes if not subject_codes or code in subject_codes]
+
+    urls = set()
+    for code in codes:
+        try:
+            questions = QuizHandler(code).questions
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping subject {code}: {e}")
+            continue
+        for question in questions:
+            urls.update(question_images(question))
+    return urls
+
+
+def _source_path(url: str) -> str:
+    return url.lstrip("/")
+
+
+def _digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.blake2b(f.read(), digest_size=6).hexdigest()
+
+
+def _variant_url(name: str) -> str:
+    return "/" + os.path.join(VARIANT_DIR, name).replace(os.sep, "/")
+
+
+def build_image(url: str, widths: Sequence[int], quality: int = QUALITY) -> Dict:
+    """Write the variants of one image; return its manifest entry"""
+    path = _source_path(url)
+    digest = _digest(path)
+    with Image.open(path) as image:
+        width, height = image.size
+        entry = {"digest": digest, "width": width, "height": height, "variants": []}
+        if getattr(image, "is_animated", False):
+            return entry
+
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        stem = os.path.splitext(os.path.basename(path))[0]
+        for target in sorted({w for w in widths if w < width} | {width}):
+            name = f"{stem}-{digest}-q{quality}-{target}w.webp"
+            variant_path = os.path.join(VARIANT_DIR, name)
+            if not os.path.exists(variant_path):
+                resized = image
+                if target != width:
+                    size = (target, max(1, round(height * target / width)))
+                    resized = image.resize(size, Image.LANCZOS)
+                resized.save(variant_path, "WEBP", quality=quality, method=6)
+            entry["variants"].append([name, target, os.path.getsize(variant_path)])
+    return entry
+
+
+def srcset(entry: Dict) -> str:
+    return ", ".join(f"{_variant_url(name)} {w}w" for name, w, _ in entry["variants"])
+
+
+def load_manifest() -> Dict[str, Dict]:
+    """The manifest's images by URL, reloaded when the file changes"""
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime_ns
+    except OSError:
+        return {}
+    if _manifest["mtime"] != mtime:
+        with _manifest_lock:
+            if _manifest["mtime"] != mtime:
+                with open(MANIFEST_PATH, encoding="utf-8") as f:
+                    images = json.load(f)["images"]
+                for entry in images.values():
+                    entry["srcset"] = srcset(entry)
+                _manifest.update(mtime=mtime, images=images)
+    return _manifest["images"]
+
+
+def _attributes(entry: Dict) -> Dict[str, Any]:
+    attrs = {"width": entry["width"], "height": entry["height"]}
+    if entry["srcset"]:
+        attrs["srcset"] = entry["srcset"]
+    return attrs
+
+
+def attributes(url: str) -> Optional[Dict[str, Any]]:
+    """``srcset``, ``width`` and ``height`` of an image, if it was built"""
+    entry = load_manifest().get(url)
+    return None if entry is None else _attributes(entry)
+
+
+def annotate(questions: Iterable) -> List[Dict[str, Any]]:
+    """Questions as dicts, each with the attributes of its images by URL"""
+    manifest = load_manifest()
+    annotated = []
+    for question in questions:
+        data = question.as_dict() if isinstance(question, QuestionMapping) else question
+        images = {
+            url: _attributes(manifest[url])
+            for url in question_images(data)
+            if url in manifest
+        }
+        if images:
+            data = {**data, "images": images}
+        annotated.append(data)
+    return annotated
+
+
+def build(
+    subject_codes: Optional[Sequence[str]] = None,
+    widths: Sequence[int] = WIDTHS,
+    quality: int = QUALITY,
+) -> Dict[str, int]:
+    """Build the variants of every referenced image and rewrite the manifest"""
+    if Image is None:
+        raise RuntimeError("Building image variants needs Pillow")
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    previous = {}
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, encoding="utf-8") as f:
+            previous = json.load(f)["images"]
+
+    # A build limited to some subjects keeps the other subjects' images
+    images = dict(previous) if subject_codes else {}
+    built = missing = 0
+    settings = {"widths": sorted(widths), "quality": quality}
+    for url in sorted(bank_images(subject_codes)):
+        if not os.path.exists(_source_path(url)):
+            logger.warning(f"Referenced image not found: {url}")
+            missing += 1
+            continue
+        old = previous.get(url)
+        if old and old.get("settings") == settings and _is_current(url, old):
+            images[url] = old
+            continue
+        entry = build_image(url, widths, quality)
+        entry["settings"] = settings
+        images[url] = entry
+        built += 1
+
+    tmp = f"{MANIFEST_PATH}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"images": images}, f, indent=1, sort_keys=True)
+    os.replace(tmp, MANIFEST_PATH)
+
+    keep = {name for entry in images.values() for name, _, _ in entry["variants"]}
+    removed = 0
+    for name in os.listdir(VARIANT_DIR):
+        if name.endswith(".webp") and name not in keep:
+            os.remove(os.path.join(VARIANT_DIR, name))
+            removed += 1
+    return {
+        "images": len(images),
+        "built": built,
+        "missing": missing,
+        "removed_variants": removed,
+    }
+
+
+def _is_current(url: str, entry: Dict) -> bool:
+    return entry["digest"] == _digest(_source_path(url)) and all(
+        os.path.exists(os.path.join(VARIANT_DIR, name))
+        for name, _, _ in entry["variants"]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Responsive question image variants")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_cmd = sub.add_parser("build", help="Build variants and the manifest")
+    build_cmd.add_argument("--subject", action="append", dest="subjects")
+    build_cmd.add_argument("--widths", type=int, nargs="+", default=list(WIDTHS))
+    build_cmd.add_argument("--quality", type=int, default=QUALITY)
+    sub.add_parser("status", help="Summarize the manifest")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "build":
+        if Image is None:
+            print("Pillow is not installed: pip install -r requirements-optional.txt")
+            return 1
+        result = build(args.subjects, args.widths, args.quality)
+        print(", ".join(f"{key}={value}" for key, value in result.items()))
+        return 0
+
+    images = load_manifest()
+    original = variants = 0
+    for url, entry in sorted(images.items()):
+        path = _source_path(url)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        smallest = min((s for _, _, s in entry["variants"]), default=size)
+        original += size
+        variants += smallest
+        print(
+            f"{url}: {entry['width']}x{entry['height']}, {size} bytes, "
+            f"{len(entry['variants'])} variants, smallest {smallest} bytes"
+        )
+    print(f"{len(images)} images, {original} bytes originals, {variants} smallest")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,323 @@
+"""Two-parameter logistic (2PL) item response model for adaptive quizzes.
+
+The probability that a user of ability ``theta`` answers question ``i``
+correctly is ``1 / (1 + exp(-a[i] * (theta - b[i])))``, where ``b`` is the
+question's difficulty and ``a`` its discrimination.
+
+- ``python -m utils.irt fit --subject AIL303m`` fits ``a`` and ``b`` for a
+  subject's bank from its test history (joint MAP estimation, every Newton
+  step vectorized over all responses with ``np.bincount``), stores them in
+  ``instance/irt/<subject>.npz`` and writes every user's ability to
+  ``user_abilities``.
+- After each graded quiz the user's ability is updated from their answers,
+  using the previous estimate as the prior.
+- Adaptive quizzes pick the questions with the most information at the
+  user's ability (averaged over ``theta`` +/- one standard error), choosing
+  randomly among the ``RANDOMESQUE`` best at each step so that users of the
+  same ability don't all get the same quiz.
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from . import user_context
+from .analytics import question_id
+from .models import TestHistory, UserAbility, instance_path
+from .shared_bank import file_lock
+
+PARAMS_DIR = os.path.join(instance_path, "irt")
+
+THETA_VARIANCE = 1.0
+B_VARIANCE = 4.0
+A_MEAN, A_VARIANCE = 1.0, 0.25
+A_RANGE = (0.2, 3.0)
+LIMIT = 4.0
+FIT_ITERATIONS = 30
+UPDATE_ITERATIONS = 10
+RANDOMESQUE = 5
+QUADRATURE = np.array([-1.0, 0.0, 1.0])
+CHUNK_ROWS = 500
+
+_params: Dict[str, "ItemParams"] = {}
+
+
+def _sigmoid(z):
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def params_path(subject_code: str) -> str:
+    return os.path.join(PARAMS_DIR, f"{subject_code}.npz")
+
+
+class ItemParams:
+    """Discrimination and difficulty of every question, in bank order"""
+
+    def __init__(self, a: np.ndarray, b: np.ndarray, responses: np.ndarray):
+        self.a = a
+        self.b = b
+        self.responses = responses
+
+    @property
+    def fitted(self) -> bool:
+        return bool(self.responses.any())
+
+    def information(self, theta: float, variance: float = 0.0) -> np.ndarray:
+        """Fisher information of every question, averaged over theta's uncertainty"""
+        points = theta + np.sqrt(variance) * QUADRATURE
+        p = _sigmoid(self.a[:, None] * (points[None, :] - self.b[:, None]))
+        return self.a**2 * (p * (1 - p)).mean(axis=1)
+
+    @classmethod
+    def for_bank(cls, subject_code: str, texts: Sequence[str], version=None):
+        """The fitted parameters aligned with ``texts``; defaults where unfitted"""
+        path = params_path(subject_code)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        key = (version, mtime, len(texts))
+        cached = _params.get(subject_code)
+        if cached is not None and cached._key == key:
+            return cached
+
+        n = len(texts)
+        a, b, responses = np.ones(n), np.zeros(n), np.zeros(n, np.int64)
+        if mtime is not None:
+            with np.load(path) as data:
+                keys, order = data["keys"], np.argsort(data["keys"])
+                ids = np.array([question_id(t) for t in texts], dtype=np.int64)
+                index = np.searchsorted(keys, ids, sorter=order)
+                index[index == len(keys)] = 0
+                index = order[index]
+                found = keys[index] == ids
+                a[found] = data["a"][index[found]]
+                b[found] = data["b"][index[found]]
+                responses[found] = data["responses"][index[found]]
+
+        params = cls(a, b, responses)
+        params._key = key
+        _params[subject_code] = params
+        return params
+
+
+def select_items(
+    params: ItemParams, theta: float, variance: float, count: int, rng=random
+) -> List[int]:
+    """Pick ``count`` question indexes by maximum information
+
+    Questions without responses only have the default parameters, whose
+    information peaks at theta 0 above most fitted questions. They are
+    picked at random once the fitted ones run out.
+    """
+    available = params.information(theta, variance)
+    fitted = params.responses > 0
+    if not fitted.any():
+        fitted[:] = True
+    available[~fitted] = -np.inf
+    chosen = []
+    for _ in range(min(count, int(fitted.sum()))):
+        k = min(RANDOMESQUE, int(fitted.sum()) - len(chosen))
+        best = np.argpartition(available, len(available) - k)[-k:]
+        pick = int(best[rng.randrange(k)])
+        chosen.append(pick)
+        available[pick] = -np.inf
+    if len(chosen) < count:
+        unfitted = np.flatnonzero(~fitted).tolist()
+        chosen.extend(rng.sample(unfitted, min(count - len(chosen), len(unfitted))))
+    return chosen
+
+
+def update_ability(
+    theta: float,
+    variance: float,
+    a: np.ndarray,
+    b: np.ndarray,
+    correct: np.ndarray,
+) -> Tuple[float, float]:
+    """Posterior mode and variance of theta after the given responses"""
+    prior_theta, prior_precision = theta, 1.0 / variance
+    for _ in range(UPDATE_ITERATIONS):
+        p = _sigmoid(a * (theta - b))
+        grad = np.sum(a * (correct - p)) - (theta - prior_theta) * prior_precision
+        information = np.sum(a * a * p * (1 - p)) + prior_precision
+        step = grad / information
+        theta = float(np.clip(theta + step, -LIMIT, LIMIT))
+        if abs(step) < 1e-6:
+            break
+    p = _sigmoid(a * (theta - b))
+    return theta, float(1.0 / (np.sum(a * a * p * (1 - p)) + prior_precision))
+
+
+def estimate(
+    users: np.ndarray,
+    items: np.ndarray,
+    correct: np.ndarray,
+    n_users: int,
+    n_items: int,
+    iterations: int = FIT_ITERATIONS,
+):
+    """Joint MAP estimate of (theta, variance) per user and (a, b) per item"""
+    y = correct.astype(np.float64)
+    attempts = np.bincount(items, minlength=n_items)
+    rate = (np.bincount(items, weights=y, minlength=n_items) + 0.5) / (attempts + 1)
+    b = np.clip(-np.log(rate / (1 - rate)), -LIMIT, LIMIT)
+    a = np.full(n_items, A_MEAN)
+    theta = np.zeros(n_users)
+
+    for _ in range(iterations):
+        ai = a[items]
+        p = _sigmoid(ai * (theta[users] - b[items]))
+        residual, weight = y - p, p * (1 - p)
+        grad = np.bincount(users, ai * residual, n_users) - theta / THETA_VARIANCE
+        hess = np.bincount(users, ai * ai * weight, n_users) + 1 / THETA_VARIANCE
+        theta = np.clip(theta + grad / hess, -LIMIT, LIMIT)
+
+        distance = theta[users] - b[items]
+        p = _sigmoid(ai * distance)
+        residual, weight = y - p, p * (1 - p)
+        grad_a = np.bincount(items, distance * residual, n_items)
+        grad_a -= (a - A_MEAN) / A_VARIANCE
+        hess_a = np.bincount(items, distance * distance * weight, n_items)
+        hess_a += 1 / A_VARIANCE
+        grad_b = -np.bincount(items, ai * residual, n_items) - b / B_VARIANCE
+        hess_b = np.bincount(items, ai * ai * weight, n_items) + 1 / B_VARIANCE
+        a = np.clip(a + grad_a / hess_a, *A_RANGE)
+        b = np.clip(b + grad_b / hess_b, -LIMIT, LIMIT)
+
+    ai = a[items]
+    p = _sigmoid(ai * (theta[users] - b[items]))
+    information = np.bincount(users, ai * ai * p * (1 - p), n_users)
+    variance = 1.0 / (information + 1 / THETA_VARIANCE)
+    return theta, variance, a, b, attempts
+
+
+def _responses(session, subject_id: int, texts: Sequence[str], chunk_rows: int):
+    """(user ids, bank indexes, correct) of every answered question in history"""
+    ids = np.array([question_id(t) for t in texts], dtype=np.int64)
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+
+    user_parts, item_parts, correct_parts = [], [], []
+    result = session.execute(
+        select(
+            TestHistory.user_id,
+            func.json_extract(TestHistory.questions, "$.results"),
+        )
+        .where(TestHistory.subject_id == subject_id)
+        .order_by(TestHistory.id)
+        .execution_options(yield_per=chunk_rows)
+    )
+    for partition in result.partitions():
+        users, qids, correct = [], [], []
+        for user_id, results in partition:
+            for r in json.loads(results) if results else ():
+                if r.get("is_unanswered") or not isinstance(r.get("question"), str):
+                    continue
+                users.append(user_id)
+                qids.append(question_id(r["question"]))
+                correct.append(bool(r.get("is_correct")))
+        if not qids:
+            continue
+        qids = np.array(qids, dtype=np.int64)
+        index = np.searchsorted(sorted_ids, qids)
+        index[index == len(sorted_ids)] = 0
+        found = sorted_ids[index] == qids
+        user_parts.append(np.array(users, dtype=np.int64)[found])
+        item_parts.append(order[index[found]])
+        correct_parts.append(np.array(correct, dtype=np.int8)[found])
+
+    if not user_parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.int8), ids
+    return (
+        np.concatenate(user_parts),
+        np.concatenate(item_parts),
+        np.concatenate(correct_parts),
+        ids,
+    )
+
+
+def fit(subject_code: str, iterations: int = FIT_ITERATIONS, chunk_rows=CHUNK_ROWS):
+    """Fit the subject's item parameters and every user's ability from history"""
+    from .quiz_handler import QuizHandler
+
+    handler = QuizHandler(subject_code)
+    texts = handler.questions.texts
+    path = params_path(subject_code)
+    os.makedirs(PARAMS_DIR, exist_ok=True)
+
+    with file_lock(path):
+        session = user_context.Session()
+        try:
+            user_ids, items, correct, ids = _responses(
+                session, handler.subject.id, texts, chunk_rows
+            )
+            users, user_index = np.unique(user_ids, return_inverse=True)
+            theta, variance, a, b, attempts = estimate(
+                user_index, items, correct, len(users), len(texts), iterations
+            )
+            counts = np.bincount(user_index, minlength=len(users))
+
+            tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+            np.savez(tmp_path, keys=ids, a=a, b=b, responses=attempts)
+            os.replace(tmp_path, path)
+
+            rows = [
+                {
+                    "user_id": int(user_id),
+                    "subject_id": handler.subject.id,
+                    "theta": float(t),
+                    "variance": float(v),
+                    "responses": int(n),
+                }
+                for user_id, t, v, n in zip(users, theta, variance, counts)
+            ]
+            for start in range(0, len(rows), 1000):
+                statement = insert(UserAbility).values(rows[start : start + 1000])
+                session.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=["user_id", "subject_id"],
+                        set_={
+                            "theta": statement.excluded.theta,
+                            "variance": statement.excluded.variance,
+                            "responses": statement.excluded.responses,
+                            "updated_at": func.now(),
+                        },
+                    )
+                )
+            session.commit()
+        finally:
+            session.close()
+    return len(correct), len(users), a, b
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit the IRT model of a subject")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fit_parser = sub.add_parser("fit", help="Fit item parameters and abilities")
+    fit_parser.add_argument("--subject", default="AIL303m")
+    fit_parser.add_argument("--iterations", type=int, default=FIT_ITERATIONS)
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    responses, users, a, b = fit(args.subject, args.iterations)
+    print(
+        f"Fitted {len(b)} questions and {users} users from {responses} responses "
+        f"in {time.perf_counter() - start:.2f}s; "
+        f"difficulty {np.percentile(b, 10):.2f}..{np.percentile(b, 90):.2f}, "
+        f"discrimination {np.percentile(a, 10):.2f}..{np.percentile(a, 90):.2f} "
+        f"(10th..90th percentile)"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
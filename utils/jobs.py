@@ -0,0 +1,389 @@
+"""In-process background jobs backed by a durable SQLite queue table.
+
+Work that does not have to finish before the response (stats rollups,
+cleanup) is enqueued as a row of the ``jobs`` table. Inside a request the row
+is added to the request's unit of work, so it is committed together with the
+change that caused it, or not at all. After the request, the process's job
+runner is woken up: a dispatcher thread claims due jobs and runs them on a
+small thread pool, each in its own unit of work. The runner only starts in
+processes that called ``init_app``; elsewhere jobs wait in the table until
+``python -m utils.jobs run``.
+
+A failed job is retried with exponential backoff until ``max_attempts``,
+then kept with status ``failed``. Jobs stuck in ``running`` (a worker died)
+are requeued after ``LEASE_SECONDS``. When the backlog grows over
+``JOBS_MAX_BACKLOG``, new jobs run inline at the end of the request that
+enqueued them instead, which slows producers down until the runner catches
+up.
+
+Handlers are registered with the ``job`` decorator and must be idempotent::
+
+    @job("rollup_user_stats")
+    def rollup_user_stats(user_id):
+        ...
+
+    enqueue("rollup_user_stats", user_id=user.id)
+
+Usage:
+    python -m utils.jobs status          # queue counts and failed jobs
+    python -m utils.jobs run             # run every due job, then exit
+    python -m utils.jobs retry           # requeue failed jobs
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from sqlalchemy import and_, func, or_, select, update
+
+from . import user_context
+from .metrics import TIME_BUCKETS, Counter, Gauge, Histogram, registry
+from .models import Job, engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_BACKLOG = 10000
+POLL_SECONDS = 5.0
+LEASE_SECONDS = 300.0
+MAX_BACKOFF_SECONDS = 300.0
+
+JOBS_TOTAL = Counter(
+    "eos_jobs_total",
+    "Finished job runs by kind and result (done, retry, failed, inline)",
+)
+JOB_SECONDS = Histogram(
+    "eos_job_duration_seconds", "Wall time per job run", TIME_BUCKETS
+)
+
+_handlers: Dict[str, Callable] = {}
+
+
+def job(kind: str):
+    """Register the decorated function as the handler of ``kind`` jobs"""
+
+    def register(fn):
+        _handlers[kind] = fn
+        return fn
+
+    return register
+
+
+def _backoff(attempts: int) -> float:
+    return min(2**attempts, MAX_BACKOFF_SECONDS)
+
+
+def _execute(kind: str, payload: dict):
+    handler = _handlers.get(kind)
+    if handler is None:
+        raise LookupError(f"No handler registered for job kind {kind!r}")
+    start = time.perf_counter()
+    try:
+        with user_context.unit_of_work():
+            handler(**payload)
+    finally:
+        JOB_SECONDS.observe(time.perf_counter() - start, kind=kind)
+
+
+class JobRunner:
+    def __init__(self, workers: int = DEFAULT_WORKERS):
+        self.enabled = False
+        self.workers = workers
+        self.max_backlog = DEFAULT_MAX_BACKLOG
+        self.counts = {"queued": 0, "running": 0, "failed": 0}
+        self._wake = threading.Event()
+        self._slots = threading.Semaphore(workers)
+        self._lock = threading.Lock()
+        # counts is written by request threads and the dispatcher
+        self._counts_lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+        self._pid = None
+
+    @property
+    def busy(self) -> bool:
+        return self.counts["queued"] >= self.max_backlog
+
+    def note_queued(self):
+        with self._counts_lock:
+            self.counts["queued"] += 1
+
+    def count_items(self):
+        with self._counts_lock:
+            return list(self.counts.items())
+
+    def start(self):
+        """Start the dispatcher and the pool in this process, if not running yet"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if (
+                self._thread is not None
+                and self._thread.is_alive()
+                and self._pid == os.getpid()
+            ):
+                return
+            self._pid = os.getpid()
+            self._slots = threading.Semaphore(self.workers)
+            self._executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="job"
+            )
+            self._thread = threading.Thread(
+                target=self._dispatch, name="job-dispatcher", daemon=True
+            )
+            self._thread.start()
+
+    def wake(self):
+        self.start()
+        self._wake.set()
+
+    def _dispatch(self):
+        while True:
+            try:
+                claimed = self.claim(self.workers)
+            except Exception:
+                logger.exception("Failed to claim jobs")
+                claimed = []
+            for job_id in claimed:
+                self._slots.acquire()
+                self._executor.submit(self._run_slot, job_id)
+            if not claimed:
+                self._wake.wait(POLL_SECONDS)
+                self._wake.clear()
+
+    def _run_slot(self, job_id: int):
+        try:
+            self.run(job_id)
+        finally:
+            self._slots.release()
+
+    def claim(self, limit: int) -> List[int]:
+        """Mark up to ``limit`` due jobs as running and return their ids"""
+        now = datetime.now()
+        expired = now - timedelta(seconds=LEASE_SECONDS)
+        # Polling an idle queue only reads: a write transaction would take
+        # the database write lock every POLL_SECONDS in every process
+        with engine.connect() as conn:
+            pending = conn.execute(
+                select(Job.id)
+                .where(
+                    or_(
+                        and_(Job.status == "queued", Job.run_at <= now),
+                        and_(Job.status == "running", Job.updated_at < expired),
+                    )
+                )
+                .limit(1)
+            ).first()
+            if pending is None:
+                self._update_counts(conn)
+                return []
+
+        claimed = []
+        with engine.begin() as conn:
+            conn.execute(
+                update(Job)
+                .where(Job.status == "running", Job.updated_at < expired)
+                .values(status="queued", updated_at=now)
+            )
+            due = conn.execute(
+                select(Job.id)
+                .where(Job.status == "queued", Job.run_at <= now)
+                .order_by(Job.run_at)
+                .limit(limit)
+            ).scalars()
+            for job_id in list(due):
+                result = conn.execute(
+                    update(Job)
+                    .where(Job.id == job_id, Job.status == "queued")
+                    .values(
+                        status="running", attempts=Job.attempts + 1, updated_at=now
+                    )
+                )
+                if result.rowcount:
+                    claimed.append(job_id)
+            self._update_counts(conn)
+        return claimed
+
+    def _update_counts(self, conn):
+        counts = dict(
+            conn.execute(select(Job.status, func.count()).group_by(Job.status)).all()
+        )
+        with self._counts_lock:
+            self.counts = {status: counts.get(status, 0) for status in self.counts}
+
+    def run(self, job_id: int):
+        """Run a claimed job, then delete it, reschedule it or mark it failed"""
+        with engine.connect() as conn:
+            row = conn.execute(
+                select(Job.kind, Job.payload, Job.attempts, Job.max_attempts).where(
+                    Job.id == job_id
+                )
+            ).first()
+        if row is None:
+            return
+        kind, payload, attempts, max_attempts = row
+
+        try:
+            _execute(kind, payload or {})
+        except Exception as e:
+            now = datetime.now()
+            if attempts < max_attempts:
+                values = {
+                    "status": "queued",
+                    "run_at": now + timedelta(seconds=_backoff(attempts)),
+                }
+                result = "retry"
+            else:
+                values = {"status": "failed"}
+                result = "failed"
+            logger.warning(f"Job {job_id} ({kind}) attempt {attempts} failed: {e}")
+            with engine.begin() as conn:
+                conn.execute(
+                    update(Job)
+                    .where(Job.id == job_id)
+                    .values(last_error=repr(e)[:1000], updated_at=now, **values)
+                )
+        else:
+            result = "done"
+            with engine.begin() as conn:
+                conn.execute(Job.__table__.delete().where(Job.id == job_id))
+        JOBS_TOTAL.inc(kind=kind, result=result)
+
+    def run_pending(self) -> int:
+        """Run every due job in the calling thread; return how many ran"""
+        ran = 0
+        while True:
+            claimed = self.claim(self.workers)
+            if not claimed:
+                return ran
+            for job_id in claimed:
+                self.run(job_id)
+                ran += 1
+
+
+runner = JobRunner()
+
+registry.append(JOBS_TOTAL)
+registry.append(JOB_SECONDS)
+registry.append(
+    Gauge(
+        "eos_jobs",
+        "Jobs in the queue table by status, as of the last poll",
+        lambda: [({"status": s}, n) for s, n in runner.count_items()],
+    )
+)
+
+
+def enqueue(kind: str, max_attempts: int = 5, delay: float = 0, **payload):
+    """Queue a job, committed with the current unit of work if there is one"""
+    from flask import has_request_context, request
+
+    if kind not in _handlers:
+        raise LookupError(f"No handler registered for job kind {kind!r}")
+
+    if runner.busy:
+        # Backpressure: the producer pays for the work instead of the queue
+        if has_request_context():
+            request.environ.setdefault("eos.jobs_inline", []).append((kind, payload))
+        else:
+            _execute(kind, payload)
+            JOBS_TOTAL.inc(kind=kind, result="inline")
+        return
+
+    row = Job(
+        kind=kind,
+        payload=payload,
+        max_attempts=max_attempts,
+        run_at=datetime.now() + timedelta(seconds=delay),
+    )
+    runner.note_queued()
+    context = user_context.current()
+    if context is not None:
+        context.session.add(row)
+    else:
+        session = user_context.Session()
+        try:
+            session.add(row)
+            session.commit()
+        finally:
+            session.close()
+
+    if has_request_context():
+        request.environ["eos.jobs_wake"] = True
+    else:
+        runner.wake()
+
+
+def init_app(app):
+    """Run the job runner in this app's processes, woken after requests that enqueue"""
+    from flask import request
+
+    app.config.setdefault("JOBS_WORKERS", DEFAULT_WORKERS)
+    app.config.setdefault("JOBS_MAX_BACKLOG", DEFAULT_MAX_BACKLOG)
+    runner.enabled = True
+    runner.workers = app.config["JOBS_WORKERS"]
+    runner.max_backlog = app.config["JOBS_MAX_BACKLOG"]
+
+    @app.teardown_request
+    def run_deferred_jobs(exc=None):
+        inline = request.environ.pop("eos.jobs_inline", ())
+        wake = request.environ.pop("eos.jobs_wake", False)
+        if exc is not None:
+            return
+        for kind, payload in inline:
+            try:
+                _execute(kind, payload)
+                JOBS_TOTAL.inc(kind=kind, result="inline")
+            except Exception:
+                logger.exception(f"Inline {kind} job failed")
+        if wake:
+            runner.wake()
+        else:
+            # Picks up jobs left queued by earlier processes
+            runner.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and run background jobs")
+    parser.add_argument("command", choices=["status", "run", "retry"])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    # Registers the application's handlers
+    from . import analytics, quiz_handler, search  # noqa: F401
+
+    if args.command == "run":
+        print(f"Ran {runner.run_pending()} jobs")
+        return 0
+
+    with engine.begin() as conn:
+        if args.command == "retry":
+            result = conn.execute(
+                update(Job)
+                .where(Job.status == "failed")
+                .values(status="queued", attempts=0, run_at=datetime.now())
+            )
+            print(f"Requeued {result.rowcount} failed jobs")
+            return 0
+
+        for status, kind, count in conn.execute(
+            select(Job.status, Job.kind, func.count()).group_by(Job.status, Job.kind)
+        ):
+            print(f"{status:8} {kind:24} {count}")
+        for job_id, kind, attempts, error in conn.execute(
+            select(Job.id, Job.kind, Job.attempts, Job.last_error)
+            .where(Job.status == "failed")
+            .order_by(Job.id.desc())
+            .limit(20)
+        ):
+            print(f"failed #{job_id} {kind} after {attempts} attempts: {error}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
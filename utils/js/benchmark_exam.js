@@ -0,0 +1,219 @@
+// Per-interaction cost of the exam client as the exam grows.
+//
+// Replays the same interactions (jump to a question, select an answer, next)
+// against a replica of the previous linked-list client and against
+// static/js/exam_core.js, with an in-memory localStorage, and reports the
+// mean microseconds per interaction and the bytes written to storage.
+//
+// Usage:
+//     node utils/js/benchmark_exam.js
+//     node utils/js/benchmark_exam.js --sizes 50,1000,10000 --interactions 2000
+
+const path = require('path');
+const { ExamState, Batcher, visibleRange } = require(
+    path.join(__dirname, '..', '..', 'static', 'js', 'exam_core.js')
+);
+
+const args = process.argv.slice(2);
+const option = (name, fallback) => {
+    const i = args.indexOf(name);
+    return i === -1 ? fallback : args[i + 1];
+};
+const sizes = option('--sizes', '50,300,1000,10000').split(',').map(Number);
+const interactions = Number(option('--interactions', 3000));
+
+class MemoryStorage {
+    constructor() {
+        this.items = new Map();
+        this.bytes = 0;
+        this.writes = 0;
+    }
+
+    setItem(key, value) {
+        this.items.set(key, value);
+        this.bytes += value.length;
+        this.writes++;
+    }
+
+    getItem(key) {
+        return this.items.has(key) ? this.items.get(key) : null;
+    }
+}
+
+function makeQuestions(count) {
+    return Array.from({ length: count }, (_, i) => ({
+        text: `Question ${i}`,
+        options: ['A', 'B', 'C', 'D'].map(letter => ({
+            type: 'text',
+            content: `Option ${letter} of question ${i}, long enough to look real`,
+        })),
+        correct_answers: [`Option A of question ${i}`],
+    }));
+}
+
+// The previous client: linked list, moveTo walks the list, and every selection
+// rewrites the hidden input and localStorage and recounts the answers
+class LegacyClient {
+    constructor(questions, storage) {
+        this.questions = questions;
+        this.storage = storage;
+        this.answers = new Array(questions.length).fill(null);
+        this.nodes = questions.map((question, index) => ({ question, index }));
+        this.nodes.forEach((node, i) => {
+            node.next = this.nodes[(i + 1) % this.nodes.length];
+        });
+        this.head = this.current = this.nodes[0];
+        this.input = '';
+    }
+
+    moveTo(index) {
+        let node = this.head;
+        for (let i = 0; i < this.nodes.length; i++) {
+            if (node.index === index) {
+                this.current = node;
+                return;
+            }
+            node = node.next;
+        }
+    }
+
+    save() {
+        this.storage.setItem('quiz', JSON.stringify({
+            answers: this.answers,
+            startTime: Date.now(),
+            currentIndex: this.current.index,
+        }));
+    }
+
+    progress() {
+        return this.answers.filter(a => a !== null && a.length > 0).length;
+    }
+
+    jump(index) {
+        this.moveTo(index);
+        this.progress();
+        this.save();
+    }
+
+    select(optionIndex) {
+        const question = this.current.question;
+        this.answers[this.current.index] = [question.options[optionIndex]];
+        this.input = JSON.stringify(this.answers);
+        this.save();
+    }
+
+    next() {
+        this.current = this.current.next;
+        this.progress();
+        this.save();
+    }
+}
+
+// The current client: array state, throttled snapshot of option indexes, and a
+// navigator that renders only the visible rows. Time is simulated: each
+// interaction advances the clock by 250 ms and fires due timers.
+class CoreClient {
+    constructor(questions, storage) {
+        this.now = 0;
+        this.pending = [];
+        const timers = {
+            setTimeout: (fn, ms) => {
+                const timer = { at: this.now + ms, fn };
+                this.pending.push(timer);
+                return timer;
+            },
+            clearTimeout: timer => {
+                this.pending = this.pending.filter(t => t !== timer);
+            },
+        };
+        this.exam = new ExamState(questions);
+        this.saver = new Batcher(
+            () => storage.setItem('quiz', JSON.stringify(this.exam.snapshot())),
+            1000,
+            timers
+        );
+    }
+
+    tick() {
+        this.now += 250;
+        const due = this.pending.filter(t => t.at <= this.now);
+        this.pending = this.pending.filter(t => t.at > this.now);
+        due.forEach(t => t.fn());
+    }
+
+    renderNav() {
+        const top = Math.floor(this.exam.index / 5) * 36;
+        const range = visibleRange(this.exam.size, 5, 36, top, 180, 2);
+        let cells = 0;
+        for (let i = range.first; i < range.last; i++) {
+            cells += this.exam.isAnswered(i) ? 2 : 1;
+        }
+        return cells;
+    }
+
+    jump(index) {
+        this.exam.moveTo(index);
+        this.renderNav();
+        this.saver.schedule();
+        this.tick();
+    }
+
+    select(optionIndex) {
+        this.exam.select(this.exam.index, [optionIndex]);
+        this.exam.progress();
+        this.renderNav();
+        this.saver.schedule();
+        this.tick();
+    }
+
+    next() {
+        this.exam.next();
+        this.renderNav();
+        this.saver.schedule();
+        this.tick();
+    }
+}
+
+function run(Client, size) {
+    const questions = makeQuestions(size);
+    const storage = new MemoryStorage();
+    const client = new Client(questions, storage);
+    let seed = 7;
+    const random = () => {
+        seed = (seed * 1103515245 + 12345) % 2147483648;
+        return seed / 2147483648;
+    };
+
+    const start = process.hrtime.bigint();
+    for (let i = 0; i < interactions; i++) {
+        const kind = i % 3;
+        if (kind === 0) client.jump(Math.floor(random() * size));
+        else if (kind === 1) client.select(Math.floor(random() * 4));
+        else client.next();
+    }
+    const elapsed = Number(process.hrtime.bigint() - start) / 1000;
+    return {
+        us: elapsed / interactions,
+        writes: storage.writes,
+        kib: storage.bytes / 1024,
+    };
+}
+
+console.log(`${interactions} interactions per run (jump, select, next)`);
+console.log(
+    'questions  legacy us/op  core us/op  speedup  legacy writes/KiB  core writes/KiB'
+);
+for (const size of sizes) {
+    run(LegacyClient, size);
+    run(CoreClient, size);
+    const legacy = run(LegacyClient, size);
+    const core = run(CoreClient, size);
+    console.log([
+        String(size).padStart(9),
+        legacy.us.toFixed(1).padStart(13),
+        core.us.toFixed(1).padStart(11),
+        `${(legacy.us / core.us).toFixed(0)}x`.padStart(8),
+        `${legacy.writes}/${legacy.kib.toFixed(0)}`.padStart(18),
+        `${core.writes}/${core.kib.toFixed(0)}`.padStart(16),
+    ].join(' '));
+}
@@ -0,0 +1,405 @@
+"""Database maintenance: history archival, purges, vacuum and analyze.
+
+The hot database only grows: every graded quiz adds a test_history row with
+its full question payload. ``python -m utils.maintenance`` keeps it small:
+
+1. ``archive``: test_history rows completed more than ``--archive-days`` ago
+   move, in batches, to an archive database next to the hot one
+   (``quiz-archive.db`` for ``quiz.db``), with the questions JSON
+   zlib-compressed. Each batch is committed to the archive before it is
+   deleted from the hot database, and a row already archived is kept, so
+   an interrupted run can simply be repeated. Test ids are AUTOINCREMENT,
+   so an archived id is never given to a new test. The users' archived totals
+   are kept in user_stats, so dashboards don't change. /history and
+   /result/<id> read archived tests back with ``archived_tests`` and
+   ``archived_test``.
+2. ``purge``: drops active quizzes abandoned past their time limit (plus
+   ``STALE_GRACE_MINUTES``) and quiz results past their expiry.
+3. ``vacuum``: switches the database to incremental auto-vacuum the first
+   time (a full VACUUM), then returns the free pages to the filesystem.
+4. ``analyze``: refreshes the query planner statistics.
+
+Each step reports its time and what it changed, and the run reports the
+database sizes before and after.
+
+Usage:
+    python -m utils.maintenance                     # all steps, 180 days
+    python -m utils.maintenance --archive-days 90
+    python -m utils.maintenance --skip archive --skip vacuum
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    func,
+    select,
+    type_coerce,
+)
+from sqlalchemy.dialects.sqlite import insert
+
+from .models import (
+    ActiveQuiz,
+    QuizResult,
+    Subject,
+    TestHistory,
+    UserStats,
+    db_path,
+    engine,
+)
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_PATH = f"{os.path.splitext(db_path)[0]}-archive.db"
+ARCHIVE_DAYS = 180
+BATCH_ROWS = 500
+STALE_GRACE_MINUTES = 60
+COMPRESS_LEVEL = 6
+STEPS = ("archive", "purge", "vacuum", "analyze")
+
+archive_metadata = MetaData()
+archived_history = Table(
+    "archived_history",
+    archive_metadata,
+    Column("id", Integer, primary_key=True),  # the original test_history id
+    Column("user_id", Integer, nullable=False),
+    Column("subject_id", Integer),
+    Column("score", Float),
+    Column("time_taken", Integer),
+    Column("completed_at", DateTime),
+    Column("payload", LargeBinary),  # zlib-compressed questions JSON
+    Index("idx_archived_user_completed", "user_id", "completed_at"),
+)
+
+_archive_engine = None
+_subjects: Dict[int, Subject] = {}
+
+
+def archive_engine(create: bool = False):
+    """Engine of the archive database, or None if it doesn't exist yet"""
+    global _archive_engine
+    if _archive_engine is None:
+        if not create and not os.path.exists(ARCHIVE_PATH):
+            return None
+        _archive_engine = create_engine(f"sqlite:///{ARCHIVE_PATH}")
+        archive_metadata.create_all(_archive_engine)
+    return _archive_engine
+
+
+def _subject(subject_id: Optional[int]) -> Optional[Subject]:
+    if subject_id not in _subjects:
+        with engine.connect() as conn:
+            row = conn.execute(
+                select(Subject.id, Subject.code, Subject.name).where(
+                    Subject.id == subject_id
+                )
+            ).first()
+        _subjects[subject_id] = (
+            Subject(id=row.id, code=row.code, name=row.name) if row else None
+        )
+    return _subjects[subject_id]
+
+
+class ArchivedTest:
+    """A test_history row read back from the archive, with the same attributes"""
+
+    archived = True
+
+    def __init__(self, row):
+        self.id = row.id
+        self.user_id = row.user_id
+        self.subject_id = row.subject_id
+        self.score = row.score
+        self.time_taken = row.time_taken
+        self.completed_at = row.completed_at
+        self._payload = getattr(row, "payload", None)
+
+    @property
+    def subject(self) -> Optional[Subject]:
+        return _subject(self.subject_id)
+
+    @property
+    def questions(self) -> Optional[dict]:
+        if not self._payload:
+            return None
+        return json.loads(zlib.decompress(self._payload))
+
+
+def archived_tests(user_id: int) -> List[ArchivedTest]:
+    """The user's archived tests, newest first, without their questions"""
+    archive = archive_engine()
+    if archive is None:
+        return []
+    t = archived_history.c
+    with archive.connect() as conn:
+        rows = conn.execute(
+            select(
+                t.id, t.user_id, t.subject_id, t.score, t.time_taken, t.completed_at
+            )
+            .where(t.user_id == user_id)
+            .order_by(t.completed_at.desc())
+        ).all()
+    return [ArchivedTest(row) for row in rows]
+
+
+def archived_test(test_id: int, user_id: int) -> Optional[ArchivedTest]:
+    archive = archive_engine()
+    if archive is None:
+        return None
+    t = archived_history.c
+    with archive.connect() as conn:
+        row = conn.execute(
+            select(archived_history).where(t.id == test_id, t.user_id == user_id)
+        ).first()
+    return ArchivedTest(row) if row else None
+
+
+def archive(cutoff: datetime, batch_rows: int = BATCH_ROWS) -> Dict[str, int]:
+    """Move test_history rows completed before ``cutoff`` to the archive"""
+    moved = raw_bytes = stored_bytes = 0
+    users = set()
+    target = None
+    while True:
+        with engine.connect() as conn:
+            # Older rows have lower ids, and the archived ones are deleted, so
+            # each batch only reads from the start of the remaining table
+            rows = conn.execute(
+                select(
+                    TestHistory.id,
+                    TestHistory.user_id,
+                    TestHistory.subject_id,
+                    TestHistory.score,
+                    TestHistory.time_taken,
+                    TestHistory.completed_at,
+                    # The stored JSON text, not decoded
+                    type_coerce(TestHistory.questions, String),
+                )
+                .where(TestHistory.completed_at < cutoff)
+                .order_by(TestHistory.id)
+                .limit(batch_rows)
+            ).all()
+        if not rows:
+            break
+
+        records = []
+        totals: Dict[int, List[float]] = {}
+        for id_, user_id, subject_id, score, time_taken, completed_at, text in rows:
+            data = (text or "").encode("utf-8")
+            payload = zlib.compress(data, COMPRESS_LEVEL) if text else None
+            raw_bytes += len(data)
+            stored_bytes += len(payload or b"")
+            records.append(
+                {
+                    "id": id_,
+                    "user_id": user_id,
+                    "subject_id": subject_id,
+                    "score": score,
+                    "time_taken": time_taken,
+                    "completed_at": completed_at,
+                    "payload": payload,
+                }
+            )
+            total = totals.setdefault(user_id, [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += score or 0.0
+            total[2] += time_taken or 0.0
+
+        target = target or archive_engine(create=True)
+        with target.begin() as conn:
+            # A row already there is this attempt, archived by an interrupted
+            # run. Anything else is a different attempt under the same id,
+            # which must not be overwritten nor lose its live copy.
+            conn.execute(insert(archived_history).on_conflict_do_nothing(), records)
+            t = archived_history.c
+            stored = {
+                row.id: (row.user_id, row.completed_at)
+                for row in conn.execute(
+                    select(t.id, t.user_id, t.completed_at).where(
+                        t.id.in_([r["id"] for r in records])
+                    )
+                )
+            }
+            clashes = [
+                r["id"]
+                for r in records
+                if stored.get(r["id"]) != (r["user_id"], r["completed_at"])
+            ]
+            if clashes:
+                raise RuntimeError(
+                    f"Archived tests {clashes} belong to other attempts; "
+                    "run `python -m utils.migrations upgrade`"
+                )
+
+        with engine.begin() as conn:
+            for user_id, (tests, score, seconds) in totals.items():
+                statement = insert(UserStats).values(
+                    user_id=user_id,
+                    archived_tests=tests,
+                    archived_score=score,
+                    archived_time=seconds,
+                )
+                conn.execute(
+                    statement.on_conflict_do_update(
+                        index_elements=["user_id"],
+                        set_={
+                            "archived_tests": func.coalesce(UserStats.archived_tests, 0)
+                            + tests,
+                            "archived_score": func.coalesce(UserStats.archived_score, 0)
+                            + score,
+                            "archived_time": func.coalesce(UserStats.archived_time, 0)
+                            + seconds,
+                        },
+                    )
+                )
+            conn.execute(
+                TestHistory.__table__.delete().where(
+                    TestHistory.id.in_([r["id"] for r in records])
+                )
+            )
+        moved += len(records)
+        users.update(totals)
+
+    # Users without stats yet got a row holding only their archived totals
+    from . import user_context
+    from .quiz_handler import rollup_user_stats
+
+    for user_id in users:
+        with user_context.unit_of_work():
+            rollup_user_stats(user_id)
+    return {
+        "rows": moved,
+        "users": len(users),
+        "json_bytes": raw_bytes,
+        "compressed_bytes": stored_bytes,
+    }
+
+
+def purge(now: Optional[datetime] = None) -> Dict[str, int]:
+    """Delete abandoned active quizzes and expired quiz results"""
+    now = now or datetime.now()
+    grace = timedelta(minutes=STALE_GRACE_MINUTES)
+    with engine.begin() as conn:
+        candidates = conn.execute(
+            select(
+                ActiveQuiz.id,
+                ActiveQuiz.start_time,
+                func.coalesce(
+                    func.json_extract(ActiveQuiz.quiz_data, "$.time_limit"),
+                    ActiveQuiz.time_limit,
+                ),
+            ).where(ActiveQuiz.start_time < now - grace)
+        ).all()
+        stale = [
+            id_
+            for id_, start_time, limit in candidates
+            if start_time + timedelta(minutes=limit or 0) + grace < now
+        ]
+        if stale:
+            conn.execute(
+                ActiveQuiz.__table__.delete().where(ActiveQuiz.id.in_(stale))
+            )
+        expired = conn.execute(
+            QuizResult.__table__.delete().where(QuizResult.expires_at < now)
+        ).rowcount
+    return {"active_quizzes": len(stale), "quiz_results": expired}
+
+
+def _pragma(conn, name: str) -> int:
+    return conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def vacuum() -> Dict[str, int]:
+    """Return free pages to the filesystem, with a full VACUUM the first time"""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        free_pages = _pragma(conn, "freelist_count")
+        full = _pragma(conn, "auto_vacuum") != 2
+        if full:
+            # Incremental mode only takes effect after a full rebuild
+            conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+        else:
+            conn.exec_driver_sql("PRAGMA incremental_vacuum")
+    return {"freed_pages": free_pages, "full": int(full)}
+
+
+def analyze() -> Dict[str, int]:
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("ANALYZE")
+        tables = conn.exec_driver_sql("SELECT count(*) FROM sqlite_stat1").scalar()
+    return {"stat_rows": tables}
+
+
+def database_size() -> Dict[str, int]:
+    with engine.connect() as conn:
+        page_size = _pragma(conn, "page_size")
+        pages = _pragma(conn, "page_count")
+        free = _pragma(conn, "freelist_count")
+    return {"bytes": page_size * pages, "free_bytes": page_size * free}
+
+
+def _mib(size: int) -> str:
+    return f"{size / 2**20:.1f} MiB"
+
+
+def run(
+    archive_days: int = ARCHIVE_DAYS,
+    skip=(),
+    batch_rows: int = BATCH_ROWS,
+) -> List[str]:
+    """Run the maintenance steps; return the report lines"""
+    before = database_size()
+    lines = [f"before: {_mib(before['bytes'])} ({_mib(before['free_bytes'])} free)"]
+    steps = {
+        "archive": lambda: archive(
+            datetime.now() - timedelta(days=archive_days), batch_rows
+        ),
+        "purge": purge,
+        "vacuum": vacuum,
+        "analyze": analyze,
+    }
+    for name in STEPS:
+        if name in skip:
+            continue
+        start = time.perf_counter()
+        result = steps[name]()
+        details = ", ".join(f"{key}={value}" for key, value in result.items())
+        lines.append(f"{name}: {time.perf_counter() - start:.2f}s {details}")
+
+    after = database_size()
+    lines.append(f"after: {_mib(after['bytes'])} ({_mib(after['free_bytes'])} free)")
+    if os.path.exists(ARCHIVE_PATH):
+        lines.append(f"archive database: {_mib(os.path.getsize(ARCHIVE_PATH))}")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive history and tidy the DB")
+    parser.add_argument("--archive-days", type=int, default=ARCHIVE_DAYS)
+    parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    parser.add_argument("--skip", action="append", choices=STEPS, default=[])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    for line in run(args.archive_days, args.skip, args.batch_rows):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
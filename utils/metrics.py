@@ -0,0 +1,266 @@
+"""Per-request timing, SQL query counting and a Prometheus-style /metrics endpoint.
+
+Every request gets a RequestTimer that collects wall time per phase:
+
+- ``bank_load``: question bank parsing (wrapped with ``phase("bank_load")``)
+- ``db``: time spent in SQL statements, with the statement count, measured by
+  SQLAlchemy engine events
+- ``render``: Jinja template rendering, measured by Flask's template signals
+
+The totals are folded into histograms when the request ends. Set
+``EOS_SERVER_TIMING=1`` (or ``app.config["SERVER_TIMING"]``) to also send the
+phases to the browser in a ``Server-Timing`` header.
+"""
+
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class Histogram:
+    """Cumulative histogram with one series per label set"""
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float]):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._series: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(key, list(s[0]), s[1], s[2]) for key, s in self._series.items()]
+        for key, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(key, le=bound)} {cumulative}"
+            yield f"{self.name}_sum{_labels(key)} {total:.6f}"
+            yield f"{self.name}_count{_labels(key)} {count}"
+
+
+class Gauge:
+    """Values read from a callback when the metrics are scraped"""
+
+    def __init__(self, name: str, description: str, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.collect():
+            yield f"{self.name}{_labels(tuple(sorted(labels.items())))} {value}"
+
+
+class Counter:
+    """Monotonic count with one series per label set"""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._series: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            yield f"{self.name}{_labels(key)} {value}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key: Tuple, **extra) -> str:
+    items = list(key) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+REQUEST_SECONDS = Histogram(
+    "eos_request_duration_seconds", "Wall time per request", TIME_BUCKETS
+)
+PHASE_SECONDS = Histogram(
+    "eos_request_phase_seconds",
+    "Wall time per request phase (bank_load, db, render)",
+    TIME_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "eos_request_queries", "SQL statements executed per request", COUNT_BUCKETS
+)
+
+registry = [REQUEST_SECONDS, PHASE_SECONDS, REQUEST_QUERIES]
+
+
+class RequestTimer:
+    __slots__ = ("start", "phases", "queries", "status", "_render_depth", "_render_start")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.queries = 0
+        self.status = None
+        self._render_depth = 0
+        self._render_start = 0.0
+
+    def add(self, phase_name: str, seconds: float):
+        self.phases[phase_name] = self.phases.get(phase_name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        parts = [
+            f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()
+        ]
+        if self.queries:
+            parts.append(f'queries;desc="{self.queries} statements"')
+        parts.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(parts)
+
+
+_current: contextvars.ContextVar[Optional[RequestTimer]] = contextvars.ContextVar(
+    "eos_request_timer", default=None
+)
+
+
+def current_timer() -> Optional[RequestTimer]:
+    return _current.get()
+
+
+@contextmanager
+def phase(name: str):
+    """Attribute the wall time of the block to ``name`` on the current request"""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("eos_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = _current.get()
+    if timer is None:
+        return
+    starts = conn.info.get("eos_query_start")
+    if starts:
+        timer.add("db", time.perf_counter() - starts.pop())
+    timer.queries += 1
+
+
+def instrument_engine(engine):
+    """Count and time every statement run through ``engine`` during a request"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _before_render(sender, template, context, **extra):
+    timer = _current.get()
+    if timer is not None:
+        if timer._render_depth == 0:
+            timer._render_start = time.perf_counter()
+        timer._render_depth += 1
+
+
+def _after_render(sender, template, context, **extra):
+    timer = _current.get()
+    if timer is not None and timer._render_depth:
+        timer._render_depth -= 1
+        if timer._render_depth == 0:
+            timer.add("render", time.perf_counter() - timer._render_start)
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app, engine):
+    """Install the request hooks, the engine listeners and the /metrics route"""
+    from flask import Response, request
+    from flask.signals import before_render_template, template_rendered
+
+    app.config.setdefault(
+        "SERVER_TIMING", os.environ.get("EOS_SERVER_TIMING", "") in ("1", "true")
+    )
+    instrument_engine(engine)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_request_timer():
+        request.environ["eos.timer_token"] = _current.set(RequestTimer())
+
+    @app.after_request
+    def record_status(response):
+        timer = _current.get()
+        if timer is not None:
+            timer.status = response.status_code
+            if app.config["SERVER_TIMING"]:
+                response.headers["Server-Timing"] = timer.server_timing()
+        return response
+
+    @app.teardown_request
+    def observe_request(exc=None):
+        token = request.environ.pop("eos.timer_token", None)
+        timer = _current.get()
+        if token is None or timer is None:
+            return
+        endpoint = request.endpoint or "unknown"
+        status = timer.status or 500
+        REQUEST_SECONDS.observe(
+            timer.elapsed(), endpoint=endpoint, method=request.method, status=status
+        )
+        for name, seconds in timer.phases.items():
+            PHASE_SECONDS.observe(seconds, endpoint=endpoint, phase=name)
+        REQUEST_QUERIES.observe(timer.queries, endpoint=endpoint)
+        _current.reset(token)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,333 @@
+"""Versioned schema migrations for the SQLite database.
+
+``Base.metadata.create_all`` creates missing tables together with their
+indexes, but never changes a table that already exists. Changes to existing
+tables are migrations: functions registered with ``migration`` under an
+increasing version number. The version of a database is SQLite's
+``PRAGMA user_version``. ``upgrade`` runs every migration above it in order
+and bumps the version after each one, under a file lock so that only one
+process migrates. A fresh database gets its tables from ``create_all`` and
+then runs every migration too, so migrations must be idempotent.
+
+``check`` runs ``EXPLAIN QUERY PLAN`` on the application's hot queries and
+fails when one of them doesn't use the index it was written for.
+
+Usage:
+    python -m utils.migrations status
+    python -m utils.migrations upgrade
+    python -m utils.migrations check
+"""
+
+import argparse
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select
+
+from .models import (
+    ActiveQuiz,
+    Base,
+    HistoryQuestion,
+    Job,
+    QuizResult,
+    ReviewItem,
+    TestHistory,
+    User,
+    db_path,
+    engine,
+)
+from .shared_bank import file_lock
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS: List[Tuple[int, str, Callable]] = []
+
+
+def migration(version: int, description: str):
+    """Register the decorated ``fn(conn)`` as the migration to ``version``"""
+
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+
+    return register
+
+
+def current_version(conn) -> int:
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def latest_version() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+@migration(1, "Create the declared indexes of existing tables")
+def _declared_indexes(conn):
+    # The indexes used to be built in class bodies and never attached
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def add_column(conn, table: str, column: str, definition: str):
+    """``ALTER TABLE ... ADD COLUMN`` unless the column already exists"""
+    columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+@migration(2, "Add archived totals to user_stats")
+def _archived_totals(conn):
+    add_column(conn, "user_stats", "archived_tests", "INTEGER DEFAULT 0")
+    add_column(conn, "user_stats", "archived_score", "FLOAT DEFAULT 0.0")
+    add_column(conn, "user_stats", "archived_time", "FLOAT DEFAULT 0.0")
+
+
+def _table_sql(conn, table: str) -> Optional[str]:
+    return conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+    ).scalar()
+
+
+def _archived_ids(archive, ids: List[int]) -> Dict[int, Tuple]:
+    """(user_id, completed_at) of the archived attempts with these ids"""
+    from .maintenance import archived_history
+
+    if archive is None or not ids:
+        return {}
+    t = archived_history.c
+    found = {}
+    with archive.connect() as conn:
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            for row in conn.execute(
+                select(t.id, t.user_id, t.completed_at).where(t.id.in_(chunk))
+            ):
+                found[row.id] = (row.user_id, row.completed_at)
+    return found
+
+
+@migration(3, "Rebuild test_history with AUTOINCREMENT ids")
+def _autoincrement_history(conn):
+    # Without AUTOINCREMENT SQLite reuses the ids of archived rows. The table
+    # can't be switched in place: rename it, create it again and copy the
+    # rows. Each step checks what is done, so an interrupted run can resume.
+    sql = _table_sql(conn, "test_history") or ""
+    if "AUTOINCREMENT" not in sql.upper() and not _table_sql(
+        conn, "test_history_old"
+    ):
+        for index in TestHistory.__table__.indexes:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+        conn.exec_driver_sql("ALTER TABLE test_history RENAME TO test_history_old")
+    if _table_sql(conn, "test_history_old"):
+        TestHistory.__table__.create(conn, checkfirst=True)
+        columns = ", ".join(c.name for c in TestHistory.__table__.columns)
+        conn.exec_driver_sql(
+            f"INSERT OR IGNORE INTO test_history ({columns}) "
+            f"SELECT {columns} FROM test_history_old"
+        )
+        conn.exec_driver_sql("DROP TABLE test_history_old")
+
+    # Rows that already reused the id of a different archived attempt get a
+    # new id, so archiving them can't collide
+    from .maintenance import archive_engine, archived_history
+
+    archive = archive_engine()
+    archived_max = 0
+    if archive is not None:
+        with archive.connect() as archive_conn:
+            archived_max = archive_conn.execute(
+                select(func.coalesce(func.max(archived_history.c.id), 0))
+            ).scalar()
+    live = conn.execute(
+        select(TestHistory.id, TestHistory.user_id, TestHistory.completed_at).where(
+            TestHistory.id <= archived_max
+        )
+    ).all()
+    archived = _archived_ids(archive, [row.id for row in live])
+    moved = [
+        row.id
+        for row in live
+        if row.id in archived and archived[row.id] != (row.user_id, row.completed_at)
+    ]
+    next_id = max(
+        archived_max,
+        conn.execute(select(func.coalesce(func.max(TestHistory.id), 0))).scalar(),
+    )
+    for old_id in moved:
+        next_id += 1
+        conn.execute(
+            TestHistory.__table__.update()
+            .where(TestHistory.id == old_id)
+            .values(id=next_id)
+        )
+    if moved:
+        # The question index holds both attempts under the old ids
+        conn.execute(HistoryQuestion.__table__.delete())
+        logger.warning(
+            f"Gave new ids to {len(moved)} tests whose id was reused after "
+            "archival; rebuild the analytics with `python -m utils.analytics "
+            "update --rebuild`"
+        )
+
+    # New ids start above every live and archived id
+    sequence = conn.exec_driver_sql(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'test_history'"
+    ).scalar()
+    if sequence is None:
+        conn.exec_driver_sql(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('test_history', ?)",
+            (next_id,),
+        )
+    elif sequence < next_id:
+        conn.exec_driver_sql(
+            "UPDATE sqlite_sequence SET seq = ? WHERE name = 'test_history'",
+            (next_id,),
+        )
+
+
+@migration(4, "Add results_version to users")
+def _results_version(conn):
+    add_column(conn, "users", "results_version", "INTEGER DEFAULT 0")
+
+
+def upgrade(bind=engine) -> List[int]:
+    """Run the pending migrations; return the versions applied"""
+    applied = []
+    with file_lock(f"{db_path}.migrate"):
+        for version, description, fn in MIGRATIONS:
+            with bind.begin() as conn:
+                if current_version(conn) >= version:
+                    continue
+                logger.info(f"Migrating database to version {version}: {description}")
+                fn(conn)
+                conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+            applied.append(version)
+    return applied
+
+
+def hot_queries():
+    """(name, statement, index it must use) for the application's hot paths"""
+    now = datetime.now()
+    return [
+        (
+            "history page",
+            select(TestHistory)
+            .where(TestHistory.user_id == 1)
+            .order_by(TestHistory.completed_at.desc()),
+            "idx_user_completed",
+        ),
+        (
+            "dashboard totals",
+            select(func.count(TestHistory.id), func.sum(TestHistory.score)).where(
+                TestHistory.user_id == 1
+            ),
+            "idx_user_completed",
+        ),
+        (
+            "subject history",
+            select(TestHistory.user_id)
+            .where(TestHistory.subject_id == 1)
+            .order_by(TestHistory.id),
+            "idx_test_history_subject",
+        ),
+        (
+            "user by name",
+            select(User).where(User.username == "alice"),
+            "sqlite_autoindex_users_1",
+        ),
+        (
+            "active quiz by token",
+            select(ActiveQuiz).where(ActiveQuiz.quiz_token == "token"),
+            "idx_quiz_token",
+        ),
+        (
+            "result by token",
+            select(QuizResult).where(QuizResult.result_token == "token"),
+            "sqlite_autoindex_quiz_results_1",
+        ),
+        (
+            "expired results",
+            select(QuizResult.id).where(QuizResult.expires_at < now),
+            "idx_quiz_results_expires",
+        ),
+        (
+            "due jobs",
+            select(Job.id)
+            .where(Job.status == "queued", Job.run_at <= now)
+            .order_by(Job.run_at),
+            "idx_jobs_status_run_at",
+        ),
+        (
+            "job poll",
+            select(Job.id)
+            .where(
+                or_(
+                    and_(Job.status == "queued", Job.run_at <= now),
+                    and_(Job.status == "running", Job.updated_at < now),
+                )
+            )
+            .limit(1),
+            "idx_jobs_status_run_at",
+        ),
+        (
+            "latest review",
+            select(func.max(ReviewItem.reviewed_at)).where(
+                ReviewItem.user_id == 1, ReviewItem.subject_id == 1
+            ),
+            "idx_review_items_reviewed",
+        ),
+    ]
+
+
+def explain(conn, statement) -> List[str]:
+    sql = statement.compile(
+        dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+    )
+    return [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def check(bind=engine) -> List[Tuple[str, str, List[str]]]:
+    """Hot queries whose plan doesn't use their index, with the plan"""
+    failures = []
+    with bind.connect() as conn:
+        for name, statement, index in hot_queries():
+            plan = explain(conn, statement)
+            if not any(f"INDEX {index}" in step for step in plan):
+                failures.append((name, index, plan))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["status", "upgrade", "check"])
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "upgrade":
+        Base.metadata.create_all(engine)
+        applied = upgrade()
+        print(f"Applied migrations {applied}" if applied else "Already up to date")
+        return 0
+
+    if args.command == "check":
+        failures = check()
+        for name, index, plan in failures:
+            print(f"{name}: expected {index}, plan was {'; '.join(plan)}")
+        total = len(hot_queries())
+        print(f"{total - len(failures)}/{total} hot queries use their index")
+        return 1 if failures else 0
+
+    with engine.connect() as conn:
+        version = current_version(conn)
+    print(f"Database {db_path} is at version {version} of {latest_version()}")
+    for number, description, _ in MIGRATIONS:
+        state = "applied" if number <= version else "pending"
+        print(f"{number:>4} {state:8} {description}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
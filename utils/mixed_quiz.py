@@ -0,0 +1,162 @@
+"""Quizzes mixing the banks of several subjects.
+
+The cached banks of every subject are numbered in one global index space
+(``CombinedIndex``): subject ``i`` owns the ids ``offsets[i]`` to
+``offsets[i + 1]``. A mixed quiz is a list of global ids, which ``locate``
+maps back to their subjects and bank indexes with one ``searchsorted``. The
+index is rebuilt only when a subject or one of the banks changes.
+
+The quiz length is split between the selected subjects by weight
+(``allocate``), and each subject's share is picked from that subject's state
+(``pick``): questions due for review first, then penalty questions and
+unseen questions from the bag, then any other question. Picking only looks
+at the user's state and at the questions it draws, never at whole banks, so
+starting a mixed quiz costs about the same for two subjects as for ten.
+"""
+
+import math
+import random
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+_index: Optional["CombinedIndex"] = None
+_index_lock = threading.Lock()
+
+
+class CombinedIndex:
+    """Global ids over the banks of several subjects"""
+
+    def __init__(self, codes: Sequence[str], banks: Sequence, versions: Sequence):
+        self.codes = list(codes)
+        self.banks = list(banks)
+        self.versions = tuple(versions)
+        self.position = {code: i for i, code in enumerate(self.codes)}
+        self.offsets = np.zeros(len(self.banks) + 1, dtype=np.int64)
+        np.cumsum([len(bank) for bank in self.banks], out=self.offsets[1:])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def size(self, code: str) -> int:
+        return len(self.banks[self.position[code]])
+
+    def global_ids(self, code: str, indexes: Sequence[int]) -> np.ndarray:
+        return np.asarray(indexes, dtype=np.int64) + self.offsets[self.position[code]]
+
+    def locate(self, ids: Sequence[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Subject positions and bank indexes of global ids"""
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.offsets, ids, side="right") - 1
+        return positions, ids - self.offsets[positions]
+
+
+def combined_index(handlers: Sequence) -> CombinedIndex:
+    """The process-wide index, rebuilt if the subjects or their banks changed"""
+    global _index
+    codes = [h.subject.code for h in handlers]
+    versions = [h.bank_version for h in handlers]
+    index = _index
+    if index is None or not _covers(index, codes, versions):
+        with _index_lock:
+            index = _index
+            if index is None or not _covers(index, codes, versions):
+                # Keep the other subjects, so alternating selections don't
+                # rebuild the index every time
+                kept = {}
+                if index is not None:
+                    kept = {
+                        code: (bank, version)
+                        for code, bank, version in zip(
+                            index.codes, index.banks, index.versions
+                        )
+                    }
+                for h in handlers:
+                    kept[h.subject.code] = (h.questions, h.bank_version)
+                ordered = sorted(kept)
+                index = CombinedIndex(
+                    ordered,
+                    [kept[code][0] for code in ordered],
+                    [kept[code][1] for code in ordered],
+                )
+                _index = index
+    return index
+
+
+def _covers(index: CombinedIndex, codes, versions) -> bool:
+    return all(
+        code in index.position and index.versions[index.position[code]] == version
+        for code, version in zip(codes, versions)
+    )
+
+
+def parse_weight(value: Optional[str]) -> float:
+    """Weight from a form field: 1 when missing or not a finite number, never < 0"""
+    try:
+        weight = float(value)
+    except (TypeError, ValueError):
+        return 1.0
+    if not math.isfinite(weight):
+        return 1.0
+    return max(0.0, weight)
+
+
+def allocate(total: int, weights: Dict[str, float], sizes: Dict[str, int]) -> Dict:
+    """Split ``total`` questions by weight, never more than a bank holds
+
+    Largest remainder rounding; the share a bank can't hold goes to the others.
+    """
+    quotas = {code: 0 for code in weights}
+    open_codes = [code for code in weights if weights[code] > 0 and sizes[code] > 0]
+    target = min(total, sum(sizes[code] for code in open_codes))
+    remaining = target
+    while remaining > 0 and open_codes:
+        weight_sum = sum(weights[code] for code in open_codes)
+        shares = {code: remaining * weights[code] / weight_sum for code in open_codes}
+        counts = {code: math.floor(share) for code, share in shares.items()}
+        by_remainder = sorted(open_codes, key=lambda c: counts[c] - shares[c])
+        for code in by_remainder[: remaining - sum(counts.values())]:
+            counts[code] += 1
+        for code in open_codes:
+            quotas[code] += min(counts[code], sizes[code] - quotas[code])
+        remaining = target - sum(quotas.values())
+        open_codes = [code for code in open_codes if quotas[code] < sizes[code]]
+    return quotas
+
+
+def pick(
+    bank,
+    quota: int,
+    due: Sequence[int],
+    penalty_questions: Dict[str, int],
+    question_bag: Sequence[str],
+    rng=random,
+) -> List[int]:
+    """Bank indexes for one subject's share of a mixed quiz"""
+    quota = min(quota, len(bank))
+    picked = list(dict.fromkeys(due))[:quota]
+    taken = set(picked)
+
+    # Penalty questions and questions not seen since the bag was last refilled
+    preferred = list(penalty_questions)
+    preferred.extend(rng.sample(question_bag, min(len(question_bag), quota)))
+    rng.shuffle(preferred)
+    for text in preferred:
+        if len(picked) >= quota:
+            break
+        i = bank.index_of(text)
+        if i is not None and i not in taken:
+            picked.append(i)
+            taken.add(i)
+
+    # sample() over a range draws without building it: enough distinct
+    # candidates to fill the quota whatever was taken already
+    if len(picked) < quota:
+        for i in rng.sample(range(len(bank)), min(len(bank), quota + len(taken))):
+            if i not in taken:
+                picked.append(i)
+                taken.add(i)
+                if len(picked) >= quota:
+                    break
+    return picked
@@ -1,6 +1,8 @@
+import json
 import os
 from sqlalchemy import (
     create_engine,
+    BigInteger,
     Column,
     Integer,
     String,
@@ -15,11 +17,17 @@ from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.mutable import MutableDict
 from datetime import datetime
 
+from .question import json_default
+
 instance_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "instance")
 os.makedirs(instance_path, exist_ok=True)
 
-db_path = os.path.join(instance_path, "quiz.db")
-engine = create_engine(f"sqlite:///{db_path}")
+db_path = os.environ.get("QUIZ_DB_PATH") or os.path.join(instance_path, "quiz.db")
+# JSON columns may hold bank questions, which serialize as their dict form
+engine = create_engine(
+    f"sqlite:///{db_path}",
+    json_serializer=lambda obj: json.dumps(obj, default=json_default),
+)
 
 Base = declarative_base()
 
@@ -31,17 +39,25 @@ class User(Base):
     username = Column(String, unique=True)
     question_bag = Column(MutableDict.as_mutable(JSON), default=dict)
     penalty_questions = Column(MutableDict.as_mutable(JSON), default=dict)
+    # Bumped when graded tests are rewritten (see utils.regrade), so cached
+    # history and result pages keyed on it are not served stale
+    results_version = Column(Integer, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
+    # Writes of a user loaded before a regrade fail rather than overwrite its
+    # penalties; the app never changes the version itself
+    __mapper_args__ = {
+        "version_id_col": results_version,
+        "version_id_generator": False,
+    }
+
     tests = relationship("TestHistory", back_populates="user", lazy="dynamic")
     active_quiz = relationship(
         "ActiveQuiz", back_populates="user", uselist=False, lazy="select"
     )
     quiz_results = relationship("QuizResult", back_populates="user", lazy="dynamic")
 
-    Index("idx_username", "username")
-
     def __repr__(self):
         return f"<User {self.username}>"
 
@@ -62,8 +78,6 @@ class Subject(Base):
     )
     quiz_results = relationship("QuizResult", back_populates="subject", lazy="dynamic")
 
-    Index("idx_subject_code", "code")
-
 
 class TestHistory(Base):
     __tablename__ = "test_history"
@@ -79,7 +93,14 @@ class TestHistory(Base):
     user = relationship("User", back_populates="tests", lazy="select")
     subject = relationship("Subject", back_populates="tests", lazy="select")
 
-    Index("idx_user_completed", "user_id", "completed_at")
+    __table_args__ = (
+        # /history, dashboard totals and stats rollups
+        Index("idx_user_completed", "user_id", "completed_at"),
+        # Per-subject scans in IRT fitting
+        Index("idx_test_history_subject", "subject_id"),
+        # Ids of archived (deleted) rows must never be handed out again
+        {"sqlite_autoincrement": True},
+    )
 
 
 class ActiveQuiz(Base):
@@ -96,7 +117,7 @@ class ActiveQuiz(Base):
     user = relationship("User", back_populates="active_quiz", lazy="select")
     subject = relationship("Subject", back_populates="active_quizzes", lazy="select")
 
-    Index("idx_quiz_token", "quiz_token")
+    __table_args__ = (Index("idx_quiz_token", "quiz_token"),)
 
 
 class QuizResult(Base):
@@ -113,7 +134,131 @@ class QuizResult(Base):
     user = relationship("User", back_populates="quiz_results", lazy="select")
     subject = relationship("Subject", back_populates="quiz_results", lazy="select")
 
-    Index("idx_result_token", "result_token")
+    # result_token is unique, so SQLite already indexes it
+    __table_args__ = (Index("idx_quiz_results_expires", "expires_at"),)
+
+
+class UserStats(Base):
+    """Per-user totals over test_history, kept up to date by a background job"""
+
+    __tablename__ = "user_stats"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    tests_taken = Column(Integer, default=0)
+    score_total = Column(Float, default=0.0)
+    time_total = Column(Float, default=0.0)
+    # Part of the totals moved to the archive database (see utils.maintenance)
+    archived_tests = Column(Integer, default=0)
+    archived_score = Column(Float, default=0.0)
+    archived_time = Column(Float, default=0.0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class UserAbility(Base):
+    """Latest IRT ability estimate of a user in a subject (see utils.irt)"""
+
+    __tablename__ = "user_abilities"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    subject_id = Column(Integer, ForeignKey("subjects.id"), primary_key=True)
+    theta = Column(Float, default=0.0)
+    variance = Column(Float, default=1.0)
+    responses = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class ReviewItem(Base):
+    """Spaced-repetition state of a question for a user (see utils.spaced_repetition)"""
+
+    __tablename__ = "review_items"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    subject_id = Column(Integer, ForeignKey("subjects.id"), primary_key=True)
+    question_id = Column(BigInteger, primary_key=True)
+    ease = Column(Float, default=2.5)
+    interval = Column(Float, default=0.0)  # days
+    repetitions = Column(Integer, default=0)
+    lapses = Column(Integer, default=0)
+    due_at = Column(DateTime, nullable=False)
+    reviewed_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        Index("idx_review_items_due", "user_id", "subject_id", "due_at"),
+        Index("idx_review_items_reviewed", "user_id", "subject_id", "reviewed_at"),
+    )
+
+
+class PenaltyMigration(Base):
+    """Marks a user's penalty counters in a subject as seeded into review_items"""
+
+    __tablename__ = "penalty_migrations"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    subject_id = Column(Integer, ForeignKey("subjects.id"), primary_key=True)
+    migrated_at = Column(DateTime, default=datetime.now)
+
+
+class Job(Base):
+    """Durable queue entry for work run after the response (see utils.jobs)"""
+
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    payload = Column(JSON, default=dict)
+    status = Column(String, default="queued")  # queued, running or failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_at = Column(DateTime, default=datetime.now)
+    last_error = Column(String)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (Index("idx_jobs_status_run_at", "status", "run_at"),)
+
+
+class HistoryQuestion(Base):
+    """Which test_history attempts hold a question (see utils.regrade)
+
+    Keyed by the question ID of ``utils.analytics.question_id``. Rows of
+    archived attempts stay, under the same test id.
+    """
+
+    __tablename__ = "history_questions"
+
+    question_id = Column(BigInteger, primary_key=True)
+    test_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    subject_id = Column(Integer)
+
+    __table_args__ = (
+        # The index watermark is the highest test id
+        Index("idx_history_questions_test", "test_id"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+class RegradeRun(Base):
+    """Progress of one shard of a regrade (see utils.regrade)"""
+
+    __tablename__ = "regrade_runs"
+
+    id = Column(Integer, primary_key=True)
+    run_key = Column(String, nullable=False)
+    subject_id = Column(Integer, ForeignKey("subjects.id"))
+    shard = Column(Integer, nullable=False)
+    shards = Column(Integer, nullable=False)
+    last_user_id = Column(Integer, default=0)
+    users_changed = Column(Integer, default=0)
+    attempts_changed = Column(Integer, default=0)
+    results_changed = Column(Integer, default=0)
+    finished_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+    __table_args__ = (
+        Index("idx_regrade_runs_shard", "run_key", "shard", "shards", unique=True),
+    )
 
 
 def init_db():
@@ -121,6 +266,11 @@ def init_db():
     # Base.metadata.drop_all(engine) # Uncomment to drop all tables before creating new ones to avoid conflicts
     Base.metadata.create_all(engine)
 
+    # Import here to avoid circular dependency
+    from .migrations import upgrade
+
+    upgrade()
+
     Session = sessionmaker(bind=engine)
     session = Session()
 
@@ -0,0 +1,193 @@
+"""Development/test-mode auditor for the SQL issued by each request.
+
+Statements are grouped per request and normalized to their shape (parameters
+and expanded IN lists collapsed). At the end of the request the auditor logs:
+
+- shapes repeated ``QUERY_AUDIT_REPEAT`` times or more, the usual sign of an
+  N+1 lazy load or of a lookup done again in a loop
+- statements slower than ``QUERY_AUDIT_SLOW_MS``, with their
+  ``EXPLAIN QUERY PLAN``
+
+It is active when the app runs in debug or testing mode, or with
+``EOS_QUERY_AUDIT=1``. Routes can be given a statement budget with
+``app.config["QUERY_BUDGETS"] = {"submit": 3}``; in testing mode a request
+over budget raises QueryBudgetExceeded. Arbitrary code can be checked with::
+
+    with query_budget(3):
+        client.post("/submit", data=...)
+"""
+
+import contextvars
+import logging
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPEAT = 3
+DEFAULT_SLOW_MS = 50.0
+
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_NUMBER = re.compile(r"(?<![\w.])\d+(?:\.\d+)?\b")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_SPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def statement_shape(statement: str) -> str:
+    """Normalize a statement so that the same query with other values compares equal"""
+    shape = _STRING.sub("?", statement)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("(?...)", shape)
+    return _SPACE.sub(" ", shape).strip()
+
+
+class QueryLog:
+    """Statements recorded while a request or a query_budget block is active"""
+
+    def __init__(self, slow_ms: float = DEFAULT_SLOW_MS):
+        self.slow_ms = slow_ms
+        self.statements: List[Tuple[str, float]] = []
+        self.slow: List[Tuple[str, float, List[str]]] = []
+
+    def __len__(self):
+        return len(self.statements)
+
+    def repeated(self, threshold: int = DEFAULT_REPEAT):
+        """Return (shape, count) for read statements issued at least ``threshold`` times"""
+        counts = Counter(
+            shape for shape, _ in self.statements if shape.startswith("SELECT")
+        )
+        return [(shape, n) for shape, n in counts.most_common() if n >= threshold]
+
+    def report(self, label: str, threshold: int = DEFAULT_REPEAT) -> List[str]:
+        lines = []
+        for shape, count in self.repeated(threshold):
+            lines.append(f"{label}: {count}x identical query (possible N+1): {shape}")
+        for statement, ms, plan in self.slow:
+            lines.append(f"{label}: slow query ({ms:.1f} ms): {statement}")
+            lines.extend(f"{label}:   plan: {row}" for row in plan)
+        return lines
+
+
+_active: contextvars.ContextVar[Tuple[QueryLog, ...]] = contextvars.ContextVar(
+    "eos_query_logs", default=()
+)
+
+
+def _explain(cursor, statement, parameters) -> List[str]:
+    try:
+        rows = cursor.connection.execute(
+            f"EXPLAIN QUERY PLAN {statement}", parameters or ()
+        ).fetchall()
+        return [row[-1] for row in rows]
+    except Exception as e:
+        return [f"(no plan: {e})"]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        conn.info.setdefault("eos_audit_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    logs = _active.get()
+    if not logs:
+        return
+    starts = conn.info.get("eos_audit_start")
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000 if starts else 0.0
+    shape = statement_shape(statement)
+    plan = None
+    for log in logs:
+        log.statements.append((shape, elapsed_ms))
+        if elapsed_ms >= log.slow_ms and not executemany:
+            if plan is None:
+                plan = _explain(cursor, statement, parameters)
+            log.slow.append((shape, elapsed_ms, plan))
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@contextmanager
+def recording(slow_ms: float = DEFAULT_SLOW_MS):
+    """Record every statement issued inside the block into the yielded QueryLog"""
+    log = QueryLog(slow_ms)
+    token = _active.set(_active.get() + (log,))
+    try:
+        yield log
+    finally:
+        _active.reset(token)
+
+
+@contextmanager
+def query_budget(limit: int, slow_ms: float = DEFAULT_SLOW_MS):
+    """Fail with QueryBudgetExceeded when the block issues more than ``limit`` statements"""
+    with recording(slow_ms) as log:
+        yield log
+    if len(log) > limit:
+        details = "\n".join(log.report("budget") or [s for s, _ in log.statements])
+        raise QueryBudgetExceeded(
+            f"{len(log)} statements issued, budget is {limit}\n{details}"
+        )
+
+
+def _enabled(app) -> bool:
+    return (
+        app.debug
+        or app.testing
+        or os.environ.get("EOS_QUERY_AUDIT", "") in ("1", "true")
+    )
+
+
+def init_app(app, engine):
+    """Audit the statements of every request while debugging or testing"""
+    from flask import request
+
+    app.config.setdefault("QUERY_AUDIT_REPEAT", DEFAULT_REPEAT)
+    app.config.setdefault("QUERY_AUDIT_SLOW_MS", DEFAULT_SLOW_MS)
+    app.config.setdefault("QUERY_BUDGETS", {})
+    instrument_engine(engine)
+
+    @app.before_request
+    def start_query_audit():
+        if _enabled(app):
+            log = QueryLog(app.config["QUERY_AUDIT_SLOW_MS"])
+            token = _active.set(_active.get() + (log,))
+            request.environ["eos.query_audit"] = (log, token)
+
+    @app.after_request
+    def check_query_audit(response):
+        audit: Optional[tuple] = request.environ.get("eos.query_audit")
+        if audit is None:
+            return response
+        log, _ = audit
+        label = f"{request.method} {request.path}"
+        for line in log.report(label, app.config["QUERY_AUDIT_REPEAT"]):
+            logger.warning(line)
+
+        budget = app.config["QUERY_BUDGETS"].get(request.endpoint)
+        if budget is not None and len(log) > budget:
+            message = f"{label}: {len(log)} statements, budget is {budget}"
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+    @app.teardown_request
+    def stop_query_audit(exc=None):
+        audit = request.environ.pop("eos.query_audit", None)
+        if audit is not None:
+            _active.reset(audit[1])
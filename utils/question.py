@@ -0,0 +1,224 @@
+"""Compact in-memory representation of a bank question.
+
+A parsed question used to be a dict holding the text, a list of
+``{"type", "content"}`` option dicts and a list of correct answer strings,
+allocated again for every question. Question keeps the same data in a slotted
+object:
+
+- option contents are a tuple of interned strings, so ``True``/``False`` and
+  other repeated options exist once per process
+- image options are a bitmask over the option indexes
+- correct answers are a bitmask over the option indexes; answers that match
+  no option are kept as they are in ``extra_answers``
+
+Question is a read-only Mapping with the keys of the old dict, so templates,
+``question["text"]`` lookups and JSON serialization see the same data.
+Correct answers come back in option order, followed by the extra answers.
+Attribute and method names deliberately differ from the keys, as Jinja tries
+attributes before items.
+
+Bank questions are shared by every quiz and never modified. A quiz that
+shuffles options holds QuizQuestion views instead: a reference to the bank
+question and the order of its options. Both are materialized into dicts only
+when rendered or serialized.
+"""
+
+import sys
+from array import array
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+KEYS = (
+    "text",
+    "image_url",
+    "options",
+    "correct_answers",
+    "option_count",
+    "has_image_options",
+)
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _bits(mask: int) -> Iterator[int]:
+    i = 0
+    while mask:
+        if mask & 1:
+            yield i
+        mask >>= 1
+        i += 1
+
+
+def _answer_value(content: str, is_image: bool) -> str:
+    # Image contents carry the "/" added when the bank was parsed, the answer
+    # column holds the path as written in the CSV
+    return content[1:] if is_image else content
+
+
+class QuestionMapping(Mapping):
+    """Read-only dict view shared by bank questions and quiz views"""
+
+    __slots__ = ()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(KEYS)
+
+    def __len__(self) -> int:
+        return len(KEYS)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: self[key] for key in KEYS}
+
+
+class Question(QuestionMapping):
+    __slots__ = (
+        "text",
+        "image_url",
+        "contents",
+        "image_mask",
+        "answer_mask",
+        "extra_answers",
+    )
+
+    def __init__(
+        self,
+        text: str,
+        image_url: Optional[str],
+        contents: Sequence[str],
+        image_mask: int = 0,
+        answer_mask: int = 0,
+        extra_answers: Sequence[str] = (),
+    ):
+        self.text = text
+        self.image_url = image_url
+        self.contents = tuple(_intern(c) for c in contents)
+        self.image_mask = image_mask
+        self.answer_mask = answer_mask
+        self.extra_answers = tuple(_intern(a) for a in extra_answers)
+
+    @classmethod
+    def from_dict(cls, question: Dict[str, Any]) -> "Question":
+        """Build a Question from the dict form (parsed rows, stored quizzes)"""
+        contents, image_mask, positions = [], 0, {}
+        for i, option in enumerate(question["options"]):
+            is_image = option.get("type") == "image"
+            if is_image:
+                image_mask |= 1 << i
+            contents.append(option["content"])
+            positions.setdefault(_answer_value(option["content"], is_image), i)
+
+        answer_mask, extra = 0, []
+        for answer in question.get("correct_answers") or ():
+            i = positions.get(answer)
+            if i is None:
+                extra.append(answer)
+            else:
+                answer_mask |= 1 << i
+
+        return cls(
+            question["text"],
+            question.get("image_url"),
+            contents,
+            image_mask,
+            answer_mask,
+            extra,
+        )
+
+    @classmethod
+    def from_record(cls, record: List[Any]) -> "Question":
+        return cls(*record)
+
+    def record(self) -> List[Any]:
+        """Positional form used by the shared bank segments"""
+        return [
+            self.text,
+            self.image_url,
+            list(self.contents),
+            self.image_mask,
+            self.answer_mask,
+            list(self.extra_answers),
+        ]
+
+    def is_image(self, i: int) -> bool:
+        return bool(self.image_mask >> i & 1)
+
+    def is_answer(self, i: int) -> bool:
+        return bool(self.answer_mask >> i & 1)
+
+    def option_dicts(
+        self, order: Optional[Sequence[int]] = None
+    ) -> List[Dict[str, str]]:
+        """Option dicts, in bank order or in the given order of option indexes"""
+        if order is None:
+            order = range(len(self.contents))
+        return [
+            {
+                "type": "image" if self.is_image(i) else "text",
+                "content": self.contents[i],
+            }
+            for i in order
+        ]
+
+    def answer_list(self, order: Optional[Sequence[int]] = None) -> List[str]:
+        if order is None:
+            order = _bits(self.answer_mask)
+        answers = [
+            _answer_value(self.contents[i], self.is_image(i))
+            for i in order
+            if self.is_answer(i)
+        ]
+        answers.extend(self.extra_answers)
+        return answers
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "text":
+            return self.text
+        if key == "image_url":
+            return self.image_url
+        if key == "options":
+            return self.option_dicts()
+        if key == "correct_answers":
+            return self.answer_list()
+        if key == "option_count":
+            return len(self.contents)
+        if key == "has_image_options":
+            return self.image_mask != 0
+        raise KeyError(key)
+
+    def shuffled(self, rng) -> "QuizQuestion":
+        """A view of this question with its options in a random order"""
+        order = list(range(len(self.contents)))
+        rng.shuffle(order)
+        return QuizQuestion(self, order)
+
+    def __repr__(self):
+        return f"<Question {self.text[:40]!r}>"
+
+
+class QuizQuestion(QuestionMapping):
+    """A bank question as one quiz shows it: the question and an option order"""
+
+    __slots__ = ("question", "order")
+
+    def __init__(self, question: Question, order: Sequence[int]):
+        self.question = question
+        self.order = array("B" if len(order) <= 256 else "H", order)
+
+    def __getitem__(self, key: str) -> Any:
+        if key == "options":
+            return self.question.option_dicts(self.order)
+        if key == "correct_answers":
+            return self.question.answer_list(self.order)
+        return self.question[key]
+
+    def __repr__(self):
+        return f"<QuizQuestion {self.question.text[:40]!r} {list(self.order)}>"
+
+
+def json_default(obj: Any) -> Any:
+    """``default=`` hook for json.dumps that writes questions as plain dicts"""
+    if isinstance(obj, QuestionMapping):
+        return obj.as_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -1,35 +1,253 @@
+import numpy as np
 import pandas as pd
 import random
 import ast
 import csv
 import os
 from sqlalchemy.orm import sessionmaker
-from utils.models import engine, User, TestHistory, ActiveQuiz, QuizResult, Subject
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import func
+from utils.models import (
+    engine,
+    User,
+    TestHistory,
+    ActiveQuiz,
+    QuizResult,
+    Subject,
+    UserAbility,
+    UserStats,
+)
+from utils.metrics import phase
+from utils.question import Question
+from utils import (
+    analytics,
+    fragment_cache,
+    irt,
+    jobs,
+    mixed_quiz,
+    quiz_pool,
+    shared_bank,
+    spaced_repetition,
+    user_context,
+)
 from datetime import datetime, timedelta
 import re
 import logging
-from typing import List, Dict, Any
-from functools import lru_cache
+import threading
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from functools import lru_cache, wraps
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_subjects: Dict[str, Subject] = {}
+
+# Parsed banks keyed by file path. Shared by every handler in the process and,
+# after a preload in a forking server, copy-on-write by every worker. Questions
+# are read-only.
+_banks: Dict[str, "QuestionBank"] = {}
+_banks_lock = threading.Lock()
+
+
+class QuestionBank(list):
+    """Parsed questions with the (mtime, size) of the file they came from.
+
+    Shares its ``texts``/``index_of`` interface with SharedQuestionBank so
+    that quiz generation can work on question indexes and only look at the
+    questions it picks.
+    """
+
+    def __init__(self, questions, version=None):
+        super().__init__(questions)
+        self.version = version
+        self._texts = None
+        self._index = None
+
+    @property
+    def texts(self) -> List[str]:
+        if self._texts is None:
+            self._texts = [q.text for q in self]
+        return self._texts
+
+    def index_of(self, text: str) -> Optional[int]:
+        if self._index is None:
+            index = {}
+            for i, t in enumerate(self.texts):
+                index.setdefault(t, i)
+            self._index = index
+        return self._index.get(text)
+
+
+def select_questions(
+    questions, penalty_questions, count: int, rng=random
+) -> List[int]:
+    """Pick up to ``count`` question indexes, each question of the bank at most once
+
+    Penalty questions first, then every other question: together that is each
+    question of the bank once, so the candidates are built from indexes and
+    only the picked questions are read. Depends only on the bank and the keys
+    of ``penalty_questions``.
+    """
+    available = []
+    for q_text in penalty_questions:
+        index = questions.index_of(q_text)
+        if index is not None:
+            available.append(index)
+    available.extend(
+        i for i, text in enumerate(questions.texts) if text not in penalty_questions
+    )
+    return rng.sample(available, min(count, len(available)))
+
+
+def _merge(first: List[int], rest: List[int], count: int) -> List[int]:
+    taken = set(first)
+    return (first + [i for i in rest if i not in taken])[:count]
+
+
+def _normalize_answer(answer):
+    if isinstance(answer, dict):
+        answer = answer["content"]
+    if isinstance(answer, str):
+        return answer.lstrip("/")
+    return answer
+
+
+def grade_answers(questions: Sequence, submitted_answers: Dict) -> List[Dict]:
+    """Result of each question for answers keyed by question number ("1", ...)"""
+    question_results = []
+    for i, question in enumerate(questions):
+        submitted = submitted_answers.get(str(i + 1), [])
+
+        if isinstance(submitted, str):
+            submitted = [submitted]
+        elif not submitted:
+            submitted = ["No answer"]
+
+        submitted_contents = [_normalize_answer(opt) for opt in submitted]
+        correct_contents = [
+            _normalize_answer(opt) for opt in question["correct_answers"]
+        ]
+
+        is_correct = set(submitted_contents) != {"No answer"} and set(
+            submitted_contents
+        ) == set(correct_contents)
+        is_unanswered = set(submitted_contents) == {"No answer"}
+
+        question_results.append(
+            {
+                "question": question["text"],
+                "submitted": submitted_contents,
+                "correct": correct_contents,
+                "is_correct": is_correct,
+                "is_unanswered": is_unanswered,
+            }
+        )
+    return question_results
+
+
+def get_subject(subject_code: str) -> Subject:
+    """Return the subject row, detached and cached for the life of the process"""
+    subject = _subjects.get(subject_code)
+    if subject is None:
+        session = sessionmaker(bind=engine)()
+        subject = session.query(Subject).filter_by(code=subject_code).first()
+        if subject:
+            session.expunge(subject)
+            _subjects[subject_code] = subject
+        session.close()
+    return subject
+
+
+def retry_on_regrade(method):
+    """Run the method again if a regrade rewrote its user in the meantime
+
+    ``User.results_version`` is the users' version column and only
+    utils.regrade bumps it, so writing back a user read before a regrade
+    batch raises StaleDataError instead of undoing the regraded penalties.
+    The session is rolled back and the method runs once more on the fresh
+    user. Flushing before returning surfaces the conflict here and holds the
+    write lock until the unit of work commits.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            result = method(self, *args, **kwargs)
+            self.db.flush()
+            return result
+        except StaleDataError:
+            self.db.rollback()
+            logger.info(
+                f"User rewritten by a regrade, retrying {method.__name__}",
+                extra={"event": "regrade_conflict"},
+            )
+        result = method(self, *args, **kwargs)
+        self.db.flush()
+        return result
+
+    return wrapper
+
 
 class QuizHandler:
     def __init__(self, subject_code: str = "AIL303m"):
         self._options_cache = {}
 
-        self.db = sessionmaker(bind=engine)()
-        self.subject = self.db.query(Subject).filter_by(code=subject_code).first()
+        self._db = None
+        self.subject = get_subject(subject_code)
         if not self.subject:
             raise ValueError(f"Subject {subject_code} not found")
 
         self.quiz_file = os.path.join("data", "bank", self.subject.data_file)
         try:
-            self.questions = self._load_questions()
+            self.questions = self._cached_questions()
         except Exception as e:
             logger.error(f"Failed to load questions for {subject_code}: {e}")
-            self.questions = []
+            self.questions = QuestionBank([])
+
+    def _bank_version(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.quiz_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _cached_questions(self) -> Sequence[Question]:
+        """Return the parsed bank, parsing it again only when the file changed"""
+        version = self._bank_version()
+        if shared_bank.enabled():
+            return shared_bank.open_bank(
+                self.subject.code, version, self._load_questions
+            )
+
+        cached = _banks.get(self.quiz_file)
+        if cached is not None and cached.version == version:
+            return cached
+
+        with _banks_lock:
+            cached = _banks.get(self.quiz_file)
+            if cached is not None and cached.version == version:
+                return cached
+            questions = QuestionBank(self._load_questions(), version)
+            _banks[self.quiz_file] = questions
+            return questions
+
+    @property
+    def bank_version(self) -> Optional[Tuple[int, int]]:
+        return self.questions.version
+
+    @property
+    def db(self):
+        """Session of the current unit of work, or this handler's own session"""
+        context = user_context.current()
+        if context is not None:
+            return context.session
+        if self._db is None:
+            self._db = sessionmaker(bind=engine)()
+        return self._db
+
+    def _commit(self):
+        """Commit now, unless a unit of work will commit at its end"""
+        if user_context.current() is None:
+            self.db.commit()
 
     @lru_cache(maxsize=128)
     def _is_image_path(self, text):
@@ -140,12 +358,13 @@ class QuizHandler:
             logger.error(f"Error cleaning list string: {s}, error: {e}")
             return [s.replace("\\n", "\n").strip()]
 
-    def _load_questions(self) -> List[Dict[str, Any]]:
+    def _load_questions(self) -> List[Question]:
         """Load and parse questions from CSV file with improved error handling"""
         try:
             self._set_csv_field_limit()
 
-            questions = self._load_questions_from_csv()
+            with phase("bank_load"):
+                questions = self._load_questions_from_csv()
 
             if not questions:
                 logger.error("No valid questions loaded from CSV")
@@ -169,7 +388,7 @@ class QuizHandler:
             except OverflowError:
                 maxInt = int(maxInt / 10)
 
-    def _load_questions_from_csv(self) -> List[Dict[str, Any]]:
+    def _load_questions_from_csv(self) -> List[Question]:
         """Helper method to load questions from CSV with better error handling"""
         try:
             df = pd.read_csv(
@@ -208,7 +427,7 @@ class QuizHandler:
             logger.error(f"Failed to read CSV file: {str(e)}")
             raise
 
-    def _parse_question_row(self, row: pd.Series, index: int) -> Dict[str, Any]:
+    def _parse_question_row(self, row: pd.Series, index: int) -> Optional[Question]:
         """Helper method to parse a single question row"""
         if len(row) < 3:
             logger.warning(f"Skipping row {index}: Insufficient columns")
@@ -225,14 +444,14 @@ class QuizHandler:
         text = text.replace("\\n", "\n")
         image_url = self._extract_image_url(text)
 
-        return {
-            "text": text,
-            "image_url": "/" + image_url if image_url else None,
-            "options": self._format_options(options),
-            "correct_answers": correct_answers,
-            "option_count": len(options),
-            "has_image_options": any(self._is_image_path(opt) for opt in options),
-        }
+        return Question.from_dict(
+            {
+                "text": text,
+                "image_url": "/" + image_url if image_url else None,
+                "options": self._format_options(options),
+                "correct_answers": correct_answers,
+            }
+        )
 
     def _extract_image_url(self, text: str) -> str:
         """Helper method to extract image URL from question text"""
@@ -252,45 +471,54 @@ class QuizHandler:
         ]
 
     def get_user_progress(self, username, subject_code=None):
-        user = self.db.query(User).filter_by(username=username).first()
-        if not user:
-            user = User(username=username)
-            self.db.add(user)
-            self.db.commit()
+        context = user_context.current()
+        if context is not None:
+            user = context.get_user(username)
+        else:
+            user = self.db.query(User).filter_by(username=username).first()
+            if not user:
+                user = User(username=username)
+                self.db.add(user)
+                self.db.commit()
 
         if subject_code:
-            if not isinstance(user.penalty_questions, dict):
-                user.penalty_questions = {}
-            if not isinstance(user.question_bag, dict):
-                user.question_bag = {}
-
-            if subject_code not in user.penalty_questions:
-                user.penalty_questions[subject_code] = {}
-
-            if subject_code not in user.question_bag or not user.question_bag.get(
-                subject_code
-            ):
-                user.question_bag[subject_code] = [
-                    q["text"]
-                    for q in self.questions
-                    if q["text"] not in user.penalty_questions.get(subject_code, {})
-                ]
-
-            self.db.commit()
-            logger.info(f"Question bag initialized/refilled for subject {subject_code}")
+            self._prepare_subject_state(user, subject_code)
+            self._commit()
 
         return user
 
+    def _prepare_subject_state(self, user: User, subject_code: str):
+        """Create the user's penalties and refill their bag for a subject"""
+        if not isinstance(user.penalty_questions, dict):
+            user.penalty_questions = {}
+        if not isinstance(user.question_bag, dict):
+            user.question_bag = {}
+
+        if subject_code not in user.penalty_questions:
+            user.penalty_questions[subject_code] = {}
+
+        if subject_code not in user.question_bag or not user.question_bag.get(
+            subject_code
+        ):
+            penalties = user.penalty_questions.get(subject_code, {})
+            user.question_bag[subject_code] = [
+                text for text in self.questions.texts if text not in penalties
+            ]
+            logger.info(
+                f"Question bag refilled for subject {subject_code}",
+                extra={"event": "bag_refill", "subject": subject_code},
+            )
+
     def save_quiz_state(self, username, quiz_token, quiz_data):
         user = self.get_user_progress(username)
         active_quiz = user.active_quiz
         if not active_quiz:
-            active_quiz = ActiveQuiz(user=user, subject=self.subject)
+            active_quiz = ActiveQuiz(user=user, subject_id=self.subject.id)
 
         active_quiz.quiz_token = quiz_token
         active_quiz.quiz_data = quiz_data
         self.db.add(active_quiz)
-        self.db.commit()
+        self._commit()
 
     def get_quiz_state(self, username, quiz_token):
         user = self.get_user_progress(username)
@@ -302,7 +530,7 @@ class QuizHandler:
         user = self.get_user_progress(username)
         if user.active_quiz:
             self.db.delete(user.active_quiz)
-            self.db.commit()
+            self._commit()
 
     def save_results(self, username, result_token, results):
         user = self.get_user_progress(username)
@@ -310,14 +538,15 @@ class QuizHandler:
 
         quiz_result = QuizResult(
             user_id=user.id,
-            subject=self.subject,
+            subject_id=self.subject.id,
             result_token=result_token,
             results=results,
             expires_at=expires_at,
         )
 
         self.db.add(quiz_result)
-        self.db.commit()
+        self._commit()
+        jobs.enqueue("cleanup_expired_results", user_id=user.id)
 
     def get_results(self, username, result_token):
         user = self.get_user_progress(username)
@@ -336,13 +565,12 @@ class QuizHandler:
         self.db.query(QuizResult).filter_by(
             user_id=user.id, result_token=result_token
         ).delete()
-        self.db.commit()
+        self._commit()
 
+    @retry_on_regrade
     def initialize_quiz(self, username, num_questions, shuffle_options=False):
         user = self.get_user_progress(username, self.subject.code)
 
-        print(f"Initializing quiz with {num_questions} questions")
-
         penalty_questions = user.penalty_questions.get(self.subject.code, {})
         question_bag = user.question_bag.get(self.subject.code, [])
 
@@ -350,173 +578,308 @@ class QuizHandler:
             user = self.get_user_progress(username)
             question_bag = user.question_bag[self.subject.code]
 
-        available_questions = []
-
-        for q_text in penalty_questions:
-            question = next((q for q in self.questions if q["text"] == q_text), None)
-            if question:
-                available_questions.append(question)
+        texts = self.questions.texts
 
         if not question_bag:
             question_bag.extend(
-                q["text"] for q in self.questions if q["text"] not in penalty_questions
+                text for text in texts if text not in penalty_questions
             )
-            self.db.commit()
+            self._commit()
+
+        # Questions due for review come first, the usual selection fills the rest
+        due = spaced_repetition.due_indexes(
+            self.db,
+            user.id,
+            self.subject.id,
+            spaced_repetition.bank_ids(self.subject.code, self.bank_version, texts),
+            penalty_questions,
+            num_questions,
+        )
+        indexes = quiz_pool.pool.take(
+            username,
+            self.subject.code,
+            self.bank_version,
+            penalty_questions,
+            num_questions,
+        )
+        if indexes is None:
+            indexes = select_questions(self.questions, penalty_questions, num_questions)
+        if due:
+            indexes = _merge(due, indexes, num_questions)
+            if len(indexes) < num_questions:
+                more = select_questions(
+                    self.questions, penalty_questions, num_questions
+                )
+                indexes = _merge(indexes, more, num_questions)
+            random.shuffle(indexes)
+        quiz = self._build_quiz([self.questions[i] for i in indexes], shuffle_options)
 
-        bag_questions = [
-            q
-            for q in self.questions
-            if q["text"] in question_bag and q["text"] not in penalty_questions
-        ]
-        available_questions.extend(bag_questions)
+        user.question_bag[self.subject.code] = question_bag
+        user.penalty_questions[self.subject.code] = penalty_questions
+        self._commit()
 
-        remaining_questions = [
-            q
-            for q in self.questions
-            if q not in available_questions and q["text"] not in penalty_questions
-        ]
-        available_questions.extend(remaining_questions)
+        logger.debug(
+            f"Quiz of {quiz['num_questions']} questions for {username}",
+            extra={"event": "quiz_started", "subject": self.subject.code},
+        )
+        return quiz
+
+    @retry_on_regrade
+    def initialize_adaptive_quiz(self, username, num_questions, shuffle_options=False):
+        """Quiz of the most informative questions at the user's estimated ability"""
+        user = self.get_user_progress(username, self.subject.code)
+        params = irt.ItemParams.for_bank(
+            self.subject.code, self.questions.texts, self.bank_version
+        )
+        if not params.fitted:
+            logger.info(f"No IRT parameters for {self.subject.code}, normal quiz")
+            return self.initialize_quiz(username, num_questions, shuffle_options)
+
+        ability = self.db.get(UserAbility, (user.id, self.subject.id))
+        theta, variance = (
+            (ability.theta, ability.variance) if ability else (0.0, irt.THETA_VARIANCE)
+        )
+        indexes = irt.select_items(params, theta, variance, num_questions)
+        quiz = self._build_quiz([self.questions[i] for i in indexes], shuffle_options)
+        quiz["mode"] = "adaptive"
+        quiz["ability"] = round(theta, 2)
+        return quiz
+
+    def _subject_handler(self, subject_code: str) -> "QuizHandler":
+        """This handler, or another subject's handler sharing its session"""
+        if subject_code == self.subject.code:
+            return self
+        handler = QuizHandler(subject_code)
+        handler._db = self.db
+        return handler
+
+    @retry_on_regrade
+    def initialize_mixed_quiz(
+        self,
+        username: str,
+        weights: Dict[str, float],
+        num_questions: int,
+        shuffle_options: bool = False,
+    ) -> Dict:
+        """Quiz drawn from the banks of several subjects, split by weight"""
+        handlers = [self._subject_handler(code) for code in weights]
+        index = mixed_quiz.combined_index(handlers)
+        quotas = mixed_quiz.allocate(
+            num_questions,
+            weights,
+            {h.subject.code: len(h.questions) for h in handlers},
+        )
+        if not sum(quotas.values()):
+            raise ValueError("Give at least one subject with questions a weight")
+
+        # One commit for every subject: each commit expires the user, whose
+        # state holds the bags of all subjects and would be reloaded each time
+        user = self.get_user_progress(username)
+        for handler in handlers:
+            handler._prepare_subject_state(user, handler.subject.code)
+        self._commit()
+
+        ids = []
+        for handler in handlers:
+            code = handler.subject.code
+            if not quotas[code]:
+                continue
+            penalty_questions = user.penalty_questions.get(code, {})
+            due = spaced_repetition.due_indexes(
+                self.db,
+                user.id,
+                handler.subject.id,
+                spaced_repetition.bank_ids(
+                    code, handler.bank_version, handler.questions.texts
+                ),
+                penalty_questions,
+                quotas[code],
+            )
+            picked = mixed_quiz.pick(
+                handler.questions,
+                quotas[code],
+                due,
+                penalty_questions,
+                user.question_bag.get(code, []),
+            )
+            ids.extend(index.global_ids(code, picked).tolist())
+        random.shuffle(ids)
 
-        random.shuffle(available_questions)
-        actual_question_count = min(num_questions, len(available_questions))
-        selected_questions = available_questions[:actual_question_count]
+        positions, local = index.locate(ids)
+        quiz = self._build_quiz(
+            [index.banks[p][i] for p, i in zip(positions.tolist(), local.tolist())],
+            shuffle_options,
+        )
+        subjects = [h.subject for h in handlers if quotas[h.subject.code]]
+        quiz["mode"] = "mixed"
+        quiz["question_subjects"] = [index.codes[p] for p in positions.tolist()]
+        quiz["subjects"] = [
+            {"code": s.code, "name": s.name, "count": quotas[s.code]} for s in subjects
+        ]
+        quiz["subject"] = {
+            "code": "+".join(s.code for s in subjects),
+            "name": "Mixed: " + ", ".join(s.name for s in subjects),
+        }
+        return quiz
 
+    def _build_quiz(self, selected_questions: List, shuffle_options: bool) -> Dict:
         if shuffle_options:
-            for question in selected_questions:
-                combined = list(zip(question["options"], question["correct_answers"]))
-                random.shuffle(combined)
-                question["options"], question["correct_answers"] = zip(*combined)
+            # Bank questions are shared: a shuffled quiz holds views with
+            # their own option order, materialized when rendered or saved
+            selected_questions = [
+                question.shuffled(random) for question in selected_questions
+            ]
 
-        start_time = datetime.now()
-        quiz = {
+        return {
             "questions": selected_questions,
             "num_questions": len(selected_questions),
-            "start_time": start_time.isoformat(),
+            "start_time": datetime.now().isoformat(),
             "subject": {
                 "code": self.subject.code,
                 "name": self.subject.name,
             },
         }
 
-        user.question_bag[self.subject.code] = question_bag
+    def _update_ability(self, user: User, question_results: List[Dict]):
+        """Fold the graded answers into the user's IRT ability, if the bank is fitted"""
+        params = irt.ItemParams.for_bank(
+            self.subject.code, self.questions.texts, self.bank_version
+        )
+        if not params.fitted:
+            return
+        answered = [
+            (self.questions.index_of(r["question"]), r["is_correct"])
+            for r in question_results
+            if not r["is_unanswered"]
+        ]
+        answered = [(i, correct) for i, correct in answered if i is not None]
+        if not answered:
+            return
+
+        ability = self.db.get(UserAbility, (user.id, self.subject.id))
+        if ability is None:
+            ability = UserAbility(
+                user_id=user.id,
+                subject_id=self.subject.id,
+                theta=0.0,
+                variance=irt.THETA_VARIANCE,
+                responses=0,
+            )
+            self.db.add(ability)
+        items = [i for i, _ in answered]
+        ability.theta, ability.variance = irt.update_ability(
+            ability.theta,
+            ability.variance,
+            params.a[items],
+            params.b[items],
+            np.array([correct for _, correct in answered], dtype=np.float64),
+        )
+        ability.responses += len(answered)
+
+    def _apply_results(self, username: str, user: User, question_results: List[Dict]):
+        """Update the user's bag and penalties of this subject from graded results"""
+        if not isinstance(user.penalty_questions, dict):
+            user.penalty_questions = {}
+        if not isinstance(user.question_bag, dict):
+            user.question_bag = {}
+
+        if self.subject.code not in user.penalty_questions:
+            user.penalty_questions[self.subject.code] = {}
+        if self.subject.code not in user.question_bag:
+            user.question_bag[self.subject.code] = []
+
+        penalty_questions = user.penalty_questions[self.subject.code]
+        question_bag = user.question_bag[self.subject.code]
+
+        for result in question_results:
+            text = result["question"]
+            if result["is_correct"]:
+                if text in question_bag:
+                    question_bag.remove(text)
+                if text in penalty_questions:
+                    penalties_remaining = penalty_questions[text] - 1
+                    if penalties_remaining <= 0:
+                        del penalty_questions[text]
+                    else:
+                        penalty_questions[text] = penalties_remaining
+            else:
+                if text in question_bag:
+                    question_bag.remove(text)
+
+                current_attempts = penalty_questions.get(text, 0) + 1
+                penalty_questions[text] = current_attempts
+
         user.penalty_questions[self.subject.code] = penalty_questions
-        self.db.commit()
+        user.question_bag[self.subject.code] = question_bag
+        self._commit()
+        quiz_pool.pool.invalidate(username, self.subject.code)
+        quiz_pool.pool.note_activity(username, self.subject.code)
+
+    def _record_attempt(
+        self,
+        user: User,
+        questions: Sequence,
+        submitted_answers: Dict,
+        question_results: List[Dict],
+        time_taken: float,
+        **payload,
+    ) -> float:
+        """Add the test history row of an attempt at this subject; return its score"""
+        correct_count = sum(1 for r in question_results if r["is_correct"])
+        score = round((correct_count / len(question_results)) * 10, 1)
+        test_history = TestHistory(
+            user=user,
+            subject_id=self.subject.id,
+            score=score,
+            time_taken=time_taken,
+            questions={
+                "questions": questions,
+                "answers": submitted_answers,
+                "results": question_results,
+                **payload,
+            },
+        )
+        self.db.add(test_history)
+        spaced_repetition.record(
+            self.db,
+            user.id,
+            self.subject.id,
+            question_results,
+            user.penalty_questions.get(self.subject.code, {}),
+        )
+        self._update_ability(user, question_results)
+        return score
 
-        print(f"Final quiz has {len(selected_questions)} questions")
-        return quiz
+    def _finish_grading(self, user: User):
+        self._commit()
+        jobs.enqueue("rollup_user_stats", user_id=user.id)
+        analytics.schedule_update()
+        fragment_cache.cache.invalidate(("user", user.id))
 
+        if user.active_quiz:
+            self.db.delete(user.active_quiz)
+            self._commit()
+
+    @retry_on_regrade
     def grade_quiz(self, username: str, quiz: Dict, submitted_answers: Dict) -> Dict:
         try:
+            if quiz.get("mode") == "mixed":
+                return self._grade_mixed_quiz(username, quiz, submitted_answers)
+
             start_time = datetime.fromisoformat(
                 quiz.get("start_time", datetime.now().isoformat())
             )
             time_taken = (datetime.now() - start_time).total_seconds()
 
-            correct_count = 0
-            question_results = []
-
             user = self.get_user_progress(username)
+            question_results = grade_answers(quiz["questions"], submitted_answers)
+            correct_count = sum(1 for r in question_results if r["is_correct"])
+            self._apply_results(username, user, question_results)
 
-            if not isinstance(user.penalty_questions, dict):
-                user.penalty_questions = {}
-            if not isinstance(user.question_bag, dict):
-                user.question_bag = {}
-
-            if self.subject.code not in user.penalty_questions:
-                user.penalty_questions[self.subject.code] = {}
-            if self.subject.code not in user.question_bag:
-                user.question_bag[self.subject.code] = []
-
-            penalty_questions = user.penalty_questions[self.subject.code]
-            question_bag = user.question_bag[self.subject.code]
-
-            if not question_bag:
-                user = self.get_user_progress(username)
-                question_bag = user.question_bag[self.subject.code]
-                penalty_questions = user.penalty_questions[self.subject.code]
-
-            for i, question in enumerate(quiz["questions"]):
-                question_number = str(i + 1)
-                submitted = submitted_answers.get(question_number, [])
-
-                if isinstance(submitted, str):
-                    submitted = [submitted]
-                elif not submitted:
-                    submitted = ["No answer"]
-
-                def normalize_path(path):
-                    if isinstance(path, dict):
-                        path = path["content"]
-                    if isinstance(path, str):
-                        return path.lstrip("/")
-                    return path
-
-                submitted_contents = [normalize_path(opt) for opt in submitted]
-                correct_contents = [
-                    normalize_path(opt) for opt in question["correct_answers"]
-                ]
-
-                is_correct = set(submitted_contents) != {"No answer"} and set(
-                    submitted_contents
-                ) == set(correct_contents)
-                is_unanswered = set(submitted_contents) == {"No answer"}
-
-                question_results.append(
-                    {
-                        "question": question["text"],
-                        "submitted": submitted_contents,
-                        "correct": correct_contents,
-                        "is_correct": is_correct,
-                        "is_unanswered": is_unanswered,
-                    }
-                )
-
-                if is_correct:
-                    correct_count += 1
-                    if question["text"] in question_bag:
-                        question_bag.remove(question["text"])
-                    if question["text"] in penalty_questions:
-                        penalties_remaining = penalty_questions[question["text"]] - 1
-                        if penalties_remaining <= 0:
-                            del penalty_questions[question["text"]]
-                        else:
-                            penalty_questions[question["text"]] = penalties_remaining
-                else:
-                    if question["text"] in question_bag:
-                        question_bag.remove(question["text"])
-
-                    current_attempts = penalty_questions.get(question["text"], 0) + 1
-                    penalty_questions[question["text"]] = current_attempts
-
-            self.db.commit()
-
-            user.penalty_questions[self.subject.code] = penalty_questions
-            user.question_bag[self.subject.code] = question_bag
-            self.db.commit()
-
-            self.db.refresh(user)
-
-            score = round((correct_count / quiz["num_questions"]) * 10, 1)
-
-            # print(f"Final penalty questions: {user.penalty_questions}")
-
-            test_history = TestHistory(
-                user=user,
-                subject=self.subject,
-                score=score,
-                time_taken=time_taken,
-                questions={
-                    "questions": quiz["questions"],
-                    "answers": submitted_answers,
-                    "results": question_results,
-                },
+            score = self._record_attempt(
+                user, quiz["questions"], submitted_answers, question_results, time_taken
             )
-            self.db.add(test_history)
-            self.db.commit()
-
-            if user.active_quiz:
-                self.db.delete(user.active_quiz)
-                self.db.commit()
+            self._finish_grading(user)
 
             results = {
                 "score": score,
@@ -526,8 +889,144 @@ class QuizHandler:
                 "time_taken": time_taken,
                 "subject": {"code": self.subject.code, "name": self.subject.name},
             }
-            logger.info(f"Quiz graded for user {username}. Score: {score}/10")
+            logger.info(
+                f"Quiz graded for user {username}. Score: {score}/10",
+                extra={
+                    "event": "quiz_graded",
+                    "subject": self.subject.code,
+                    "score": score,
+                },
+            )
             return results
+        except StaleDataError:
+            raise  # retried by retry_on_regrade
         except Exception as e:
             logger.error(f"Error grading quiz for {username}: {e}")
             raise
+
+    def _grade_mixed_quiz(
+        self, username: str, quiz: Dict, submitted_answers: Dict
+    ) -> Dict:
+        """Grade a mixed quiz as one attempt per subject, in the subjects' history"""
+        start_time = datetime.fromisoformat(
+            quiz.get("start_time", datetime.now().isoformat())
+        )
+        time_taken = (datetime.now() - start_time).total_seconds()
+
+        user = self.get_user_progress(username)
+        codes = quiz["question_subjects"]
+        question_results = grade_answers(quiz["questions"], submitted_answers)
+        for result, code in zip(question_results, codes):
+            result["subject"] = code
+
+        positions: Dict[str, List[int]] = {}
+        for i, code in enumerate(codes):
+            positions.setdefault(code, []).append(i)
+
+        breakdown = []
+        for code, part in positions.items():
+            handler = self._subject_handler(code)
+            part_results = [question_results[i] for i in part]
+            # Numbered as in the subject's own attempt
+            part_answers = {
+                str(n + 1): submitted_answers[str(i + 1)]
+                for n, i in enumerate(part)
+                if str(i + 1) in submitted_answers
+            }
+            handler._apply_results(username, user, part_results)
+            score = handler._record_attempt(
+                user,
+                [quiz["questions"][i] for i in part],
+                part_answers,
+                part_results,
+                time_taken * len(part) / len(codes),
+                mixed=quiz["subject"]["code"],
+            )
+            breakdown.append(
+                {
+                    "code": code,
+                    "name": handler.subject.name,
+                    "correct_count": sum(1 for r in part_results if r["is_correct"]),
+                    "total_questions": len(part),
+                    "score": score,
+                }
+            )
+        self._finish_grading(user)
+
+        correct_count = sum(1 for r in question_results if r["is_correct"])
+        score = round((correct_count / len(question_results)) * 10, 1)
+        logger.info(
+            f"Mixed quiz graded for user {username}. Score: {score}/10",
+            extra={
+                "event": "quiz_graded",
+                "subject": quiz["subject"]["code"],
+                "score": score,
+            },
+        )
+        return {
+            "score": score,
+            "correct_count": correct_count,
+            "total_questions": quiz["num_questions"],
+            "question_results": question_results,
+            "time_taken": time_taken,
+            "subject": quiz["subject"],
+            "subjects": breakdown,
+        }
+
+
+def parse_bank(path: str) -> List[Question]:
+    """Parse a bank file that is not (or no longer) a subject's current bank"""
+    handler = QuizHandler.__new__(QuizHandler)
+    handler._options_cache = {}
+    handler.quiz_file = path
+    return handler._load_questions()
+
+
+def preload_banks() -> int:
+    """Parse the bank of every subject into the process-wide cache"""
+    session = sessionmaker(bind=engine)()
+    codes = [code for (code,) in session.query(Subject.code).all()]
+    session.close()
+
+    loaded = 0
+    for code in codes:
+        try:
+            handler = QuizHandler(code)
+        except ValueError:
+            continue
+        if handler.questions:
+            # Build the text index now so forked workers share it too
+            handler.questions.index_of("")
+            loaded += 1
+    return loaded
+
+
+@jobs.job("rollup_user_stats")
+def rollup_user_stats(user_id: int):
+    """Recompute the user's dashboard totals from their test history"""
+    db = user_context.current().session
+    tests_taken, score_total, time_total = (
+        db.query(
+            func.count(TestHistory.id),
+            func.coalesce(func.sum(TestHistory.score), 0.0),
+            func.coalesce(func.sum(TestHistory.time_taken), 0.0),
+        )
+        .filter(TestHistory.user_id == user_id)
+        .one()
+    )
+    stats = db.get(UserStats, user_id)
+    if stats is None:
+        stats = UserStats(user_id=user_id)
+        db.add(stats)
+    stats.tests_taken = tests_taken + (stats.archived_tests or 0)
+    stats.score_total = score_total + (stats.archived_score or 0.0)
+    stats.time_total = time_total + (stats.archived_time or 0.0)
+
+
+@jobs.job("cleanup_expired_results")
+def cleanup_expired_results(user_id: int):
+    """Delete the user's results that were never viewed before expiring"""
+    db = user_context.current().session
+    db.query(QuizResult).filter(
+        QuizResult.user_id == user_id, QuizResult.expires_at < datetime.now()
+    ).delete()
@@ -0,0 +1,251 @@
+"""Warm pool of pre-selected quizzes, so that starting an exam is a pool pop.
+
+When a user shows activity on a subject (dashboard, configure page, a graded
+quiz), a background thread selects that user's next quiz with the same
+select_questions() as /configure, from the user's committed penalty state and
+a fixed size of ``POOL_QUESTIONS``. The selection is kept as question indexes
+with a fingerprint of what it depended on: the bank version and the user's
+penalty questions.
+
+initialize_quiz takes the pooled selection when its fingerprint still matches
+the user's current state, or a prefix of it when fewer questions are asked
+for (a prefix of a random sample is a random sample). Anything else is a miss
+and the quiz is selected inline as before. Grading drops the user's entry,
+entries expire after ``QUIZ_POOL_MAX_AGE`` seconds and the pool holds at most
+``QUIZ_POOL_SIZE`` entries, evicting the least recently stored.
+
+Enabled by ``init_app`` unless ``EOS_QUIZ_POOL=0``. Every process has its own
+pool; the thread starts on first use, so forked workers get their own.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from .metrics import Counter, Gauge, registry
+
+logger = logging.getLogger(__name__)
+
+POOL_QUESTIONS = 50
+DEFAULT_SIZE = 1000
+DEFAULT_MAX_AGE = 600.0
+
+POOL_LOOKUPS = Counter(
+    "eos_quiz_pool_lookups_total", "Quiz pool lookups by result (hit, miss, stale)"
+)
+
+
+def fingerprint(bank_version, penalty_questions) -> int:
+    """Hash of everything a selection depends on, besides randomness"""
+    return hash((bank_version, frozenset(penalty_questions or ())))
+
+
+class PooledQuiz:
+    __slots__ = ("fingerprint", "indexes", "created")
+
+    def __init__(self, fingerprint: int, indexes: List[int]):
+        self.fingerprint = fingerprint
+        self.indexes = indexes
+        self.created = time.monotonic()
+
+
+class QuizPool:
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_SIZE,
+        max_age: float = DEFAULT_MAX_AGE,
+        questions: int = POOL_QUESTIONS,
+    ):
+        self.enabled = False
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.questions = questions
+        self._entries: "OrderedDict[Tuple[str, str], PooledQuiz]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending: "queue.Queue[Tuple[str, str]]" = queue.Queue(maxsize)
+        self._queued = set()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def resize(self, maxsize: int):
+        """Bound the pool and its prefetch queue to ``maxsize``"""
+        with self._lock:
+            self.maxsize = maxsize
+            if self._pending.maxsize == maxsize:
+                return
+            old, self._pending = self._pending, queue.Queue(maxsize)
+            self._queued.clear()
+            while True:
+                try:
+                    key = old.get_nowait()
+                except queue.Empty:
+                    break
+                if key is not None and not self._pending.full():
+                    self._pending.put_nowait(key)
+                    self._queued.add(key)
+            # Wake a worker blocked on the old queue
+            old.put_nowait(None)
+
+    def take(
+        self, username, subject_code, bank_version, penalty_questions, count
+    ) -> Optional[List[int]]:
+        """Pop the user's pooled selection if it is still valid for their state"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.pop((username, subject_code), None)
+        if entry is None or (
+            count > len(entry.indexes) and len(entry.indexes) >= self.questions
+        ):
+            POOL_LOOKUPS.inc(result="miss")
+            return None
+        if (
+            time.monotonic() - entry.created > self.max_age
+            or entry.fingerprint != fingerprint(bank_version, penalty_questions)
+        ):
+            POOL_LOOKUPS.inc(result="stale")
+            return None
+        POOL_LOOKUPS.inc(result="hit")
+        return entry.indexes[:count]
+
+    def put(self, username, subject_code, entry: PooledQuiz):
+        with self._lock:
+            self._entries[(username, subject_code)] = entry
+            self._entries.move_to_end((username, subject_code))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username, subject_code):
+        with self._lock:
+            self._entries.pop((username, subject_code), None)
+
+    def note_activity(self, username, subject_code):
+        """Prefetch the user's next quiz, after the current request has committed"""
+        if not self.enabled:
+            return
+        from flask import has_request_context, request
+
+        if has_request_context():
+            request.environ.setdefault("eos.quiz_pool", []).append(
+                (username, subject_code)
+            )
+        else:
+            self.schedule(username, subject_code)
+
+    def schedule(self, username, subject_code):
+        key = (username, subject_code)
+        with self._lock:
+            if key in self._queued:
+                return
+            try:
+                self._pending.put_nowait(key)
+            except queue.Full:
+                logger.debug(f"Quiz pool queue full, not prefetching {key}")
+                return
+            self._queued.add(key)
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        if (
+            self._thread is not None
+            and self._thread.is_alive()
+            and self._pid == os.getpid()
+        ):
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, name="quiz-pool", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            key = self._pending.get()
+            if key is None:
+                continue
+            with self._lock:
+                self._queued.discard(key)
+            try:
+                self.prefetch(*key)
+            except Exception:
+                logger.exception(f"Failed to prefetch a quiz for {key}")
+
+    def prefetch(self, username, subject_code):
+        """Select and store the user's next quiz from their committed state"""
+        from .models import User
+        from .quiz_handler import QuizHandler, select_questions
+        from .user_context import Session
+
+        try:
+            handler = QuizHandler(subject_code)
+        except ValueError:
+            return
+
+        session = Session()
+        try:
+            row = (
+                session.query(User.penalty_questions)
+                .filter_by(username=username)
+                .first()
+            )
+        finally:
+            session.close()
+        penalties = row[0] if row and isinstance(row[0], dict) else {}
+        penalties = penalties.get(subject_code) or {}
+
+        current = fingerprint(handler.bank_version, penalties)
+        with self._lock:
+            entry = self._entries.get((username, subject_code))
+        if (
+            entry is not None
+            and entry.fingerprint == current
+            and time.monotonic() - entry.created <= self.max_age
+        ):
+            return
+
+        indexes = select_questions(handler.questions, penalties, self.questions)
+        self.put(username, subject_code, PooledQuiz(current, indexes))
+
+
+pool = QuizPool()
+
+registry.append(POOL_LOOKUPS)
+registry.append(
+    Gauge(
+        "eos_quiz_pool_entries",
+        "Pre-selected quizzes in the pool (ready) and waiting to be built (queued)",
+        lambda: [
+            ({"state": "ready"}, len(pool)),
+            ({"state": "queued"}, pool._pending.qsize()),
+        ],
+    )
+)
+
+
+def init_app(app):
+    """Enable the pool and prefetch the quizzes noted during each request"""
+    from flask import request
+
+    app.config.setdefault(
+        "QUIZ_POOL", os.environ.get("EOS_QUIZ_POOL", "1") not in ("0", "false")
+    )
+    app.config.setdefault("QUIZ_POOL_SIZE", DEFAULT_SIZE)
+    app.config.setdefault("QUIZ_POOL_MAX_AGE", DEFAULT_MAX_AGE)
+    pool.enabled = app.config["QUIZ_POOL"]
+    pool.resize(app.config["QUIZ_POOL_SIZE"])
+    pool.max_age = app.config["QUIZ_POOL_MAX_AGE"]
+
+    @app.teardown_request
+    def schedule_prefetches(exc=None):
+        # Teardown runs after the unit of work committed, so the worker sees
+        # the state this request left behind
+        for username, subject_code in request.environ.pop("eos.quiz_pool", ()):
+            if exc is None:
+                pool.schedule(username, subject_code)
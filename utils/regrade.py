@@ -0,0 +1,761 @@
+"""Regrade past attempts after a bank's answer key was corrected.
+
+Scraped answer keys are sometimes wrong. Once a row of ``data/bank/<code>.csv``
+is fixed, ``python -m utils.regrade run`` brings the stored attempts in line:
+
+1. ``diff_keys`` compares the answer keys of the old and the new bank by
+   question text. The old bank is a file (``--old``) or the bank as of a git
+   revision (``--rev``). Questions only added or removed don't regrade
+   anything.
+2. ``update_index`` brings the ``history_questions`` index up to date: one
+   row per (question ID, attempt), for live and archived attempts. Each run
+   only reads the attempts newer than the highest test id in the index, so
+   the affected attempts are found without decoding every stored quiz.
+3. The affected users are processed in batches, in ascending user id. For
+   each batch the attempts holding a changed question are read and every
+   result whose stored key differs from the new one is graded again, with
+   the rule of ``grade_answers``. Scores, the question snapshots, the
+   user_stats totals, the penalties of the changed questions (replayed
+   over the user's attempts in order) and the review items of questions
+   whose latest result flipped are then written in one transaction,
+   together with the shard's progress in ``regrade_runs``. The archive
+   database is attached to the same connection, so archived attempts change
+   in the same commit.
+
+Regrading works from the stored results, not from the old key: running it
+again changes nothing, and an interrupted run resumes after the last
+committed batch. ``--workers`` splits the users into shards by
+``user_id % shards`` and runs each shard in its own process.
+
+The batch also bumps ``users.results_version``, the users' version column:
+a request that read a user before the batch fails to write it back (see
+``QuizHandler`` retries) instead of undoing the regraded penalties.
+
+IRT abilities and question analytics are not regraded.
+
+Usage:
+    python -m utils.regrade index
+    python -m utils.regrade run --subject AIL303m --rev HEAD~1
+    python -m utils.regrade run --subject AIL303m --old old.csv --workers 4
+    python -m utils.regrade status
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from sqlalchemy import create_engine, event, func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from . import maintenance, spaced_repetition
+from .analytics import question_id
+from .maintenance import COMPRESS_LEVEL, archived_history
+from .models import (
+    HistoryQuestion,
+    RegradeRun,
+    Subject,
+    TestHistory,
+    User,
+    UserStats,
+    db_path,
+    engine,
+)
+from .quiz_handler import _normalize_answer, get_subject, parse_bank
+
+logger = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_USERS = 200
+INDEX_ROWS = 500
+IN_CHUNK = 500
+LOCK_TIMEOUT = 30
+RETRIES = 3
+COUNTS = ("users_changed", "attempts_changed", "results_changed")
+
+_engine = None
+_engine_pid = None
+
+
+class _Moved(Exception):
+    """An attempt was archived between reading and writing its batch"""
+
+
+def _write_engine():
+    """Engine whose transactions take the write lock up front, archive attached"""
+    global _engine, _engine_pid
+    if _engine is None or _engine_pid != os.getpid():
+        _engine = create_engine(
+            f"sqlite:///{db_path}", connect_args={"timeout": LOCK_TIMEOUT}
+        )
+        _engine_pid = os.getpid()
+
+        @event.listens_for(_engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            # Let the begin listener below issue BEGIN
+            dbapi_connection.isolation_level = None
+            if os.path.exists(maintenance.ARCHIVE_PATH):
+                dbapi_connection.execute(
+                    "ATTACH DATABASE ? AS archive", (maintenance.ARCHIVE_PATH,)
+                )
+
+        @event.listens_for(_engine, "begin")
+        def begin(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return _engine
+
+
+def _chunks(values: Sequence, size: int = IN_CHUNK) -> Iterable[Sequence]:
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+def _normalized(answers: Iterable) -> frozenset:
+    return frozenset(_normalize_answer(a) for a in answers or ())
+
+
+def answer_keys(questions: Sequence) -> Dict[str, List[str]]:
+    """Correct answers by question text, from the first question with the text"""
+    keys = {}
+    for question in questions:
+        keys.setdefault(question["text"], list(question["correct_answers"]))
+    return keys
+
+
+def diff_keys(old: Sequence, new: Sequence) -> Tuple[Dict[str, List[str]], int, int]:
+    """New keys of the questions whose key changed, plus added and removed counts"""
+    old_keys, new_keys = answer_keys(old), answer_keys(new)
+    changed = {
+        text: answers
+        for text, answers in new_keys.items()
+        if text in old_keys and _normalized(answers) != _normalized(old_keys[text])
+    }
+    added = sum(1 for text in new_keys if text not in old_keys)
+    removed = sum(1 for text in old_keys if text not in new_keys)
+    return changed, added, removed
+
+
+def run_key(subject_code: str, keys: Dict[str, List[str]]) -> str:
+    data = json.dumps([subject_code, sorted(keys.items())], ensure_ascii=False)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def bank_at_revision(rev: str, data_file: str):
+    """Questions of ``data/bank/<data_file>`` as of a git revision"""
+    data = subprocess.run(
+        ["git", "show", f"{rev}:data/bank/{data_file}"],
+        cwd=ROOT,
+        capture_output=True,
+        check=True,
+    ).stdout
+    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as f:
+        f.write(data)
+    try:
+        return parse_bank(f.name)
+    finally:
+        os.unlink(f.name)
+
+
+def _index_rows(test_id, user_id, subject_id, results) -> List[Dict]:
+    texts = {r.get("question") for r in results or () if r.get("question")}
+    return [
+        {
+            "question_id": question_id(text),
+            "test_id": test_id,
+            "user_id": user_id,
+            "subject_id": subject_id,
+        }
+        for text in texts
+    ]
+
+
+def _insert_index(rows: List[Dict]):
+    if rows:
+        with engine.begin() as conn:
+            conn.execute(insert(HistoryQuestion).on_conflict_do_nothing(), rows)
+
+
+def update_index(chunk_rows: int = INDEX_ROWS) -> int:
+    """Index the attempts newer than the index; return how many were read"""
+    with engine.connect() as conn:
+        watermark = conn.execute(
+            select(func.coalesce(func.max(HistoryQuestion.test_id), 0))
+        ).scalar()
+
+    attempts = 0
+    # Live rows first: a row archived meanwhile is then read from the archive.
+    # Each chunk is read before it is written, as an open cursor would keep
+    # the insert from committing.
+    last_id = watermark
+    while True:
+        with engine.connect() as conn:
+            partition = conn.execute(
+                select(
+                    TestHistory.id,
+                    TestHistory.user_id,
+                    TestHistory.subject_id,
+                    func.json_extract(TestHistory.questions, "$.results"),
+                )
+                .where(TestHistory.id > last_id)
+                .order_by(TestHistory.id)
+                .limit(chunk_rows)
+            ).all()
+        if not partition:
+            break
+        rows = []
+        for test_id, user_id, subject_id, results in partition:
+            results = json.loads(results) if results else None
+            rows.extend(_index_rows(test_id, user_id, subject_id, results))
+        _insert_index(rows)
+        attempts += len(partition)
+        last_id = partition[-1][0]
+
+    archive = maintenance.archive_engine()
+    if archive is not None:
+        t = archived_history.c
+        with archive.connect() as conn:
+            result = conn.execution_options(yield_per=chunk_rows).execute(
+                select(t.id, t.user_id, t.subject_id, t.payload)
+                .where(t.id > watermark)
+                .order_by(t.id)
+            )
+            for partition in result.partitions():
+                rows = []
+                for test_id, user_id, subject_id, payload in partition:
+                    questions = json.loads(zlib.decompress(payload)) if payload else {}
+                    rows.extend(
+                        _index_rows(
+                            test_id, user_id, subject_id, questions.get("results")
+                        )
+                    )
+                _insert_index(rows)
+                attempts += len(partition)
+    return attempts
+
+
+def regrade_payload(questions: Dict, keys: Dict[str, List[str]]):
+    """Apply ``keys`` to an attempt's stored questions in place
+
+    Returns whether anything changed, the new score and the (text, was
+    correct, is correct) outcome of every question that has a key in ``keys``.
+    """
+    results = questions.get("results") or []
+    snapshots = questions.get("questions") or []
+    changed = False
+    outcomes = []
+    for i, result in enumerate(results):
+        text = result.get("question")
+        answers = keys.get(text)
+        if answers is None:
+            continue
+        was_correct = bool(result.get("is_correct"))
+        key = _normalized(answers)
+        if frozenset(result.get("correct") or ()) != key:
+            submitted = frozenset(result.get("submitted") or ())
+            result["correct"] = [_normalize_answer(a) for a in answers]
+            result["is_correct"] = submitted != {"No answer"} and submitted == key
+            if i < len(snapshots) and snapshots[i].get("text") == text:
+                snapshots[i]["correct_answers"] = list(answers)
+            changed = True
+        outcomes.append((text, was_correct, result["is_correct"]))
+
+    correct_count = sum(1 for r in results if r.get("is_correct"))
+    score = round((correct_count / len(results)) * 10, 1) if results else None
+    return changed, score, outcomes
+
+
+def _fold(outcomes: Iterable[bool]) -> int:
+    """Penalty of a question after these outcomes, as ``_apply_results`` counts"""
+    penalty = 0
+    for is_correct in outcomes:
+        penalty = max(penalty - 1, 0) if is_correct else penalty + 1
+    return penalty
+
+
+def _affected_users(qids, subject_id, shard, shards, after, limit) -> List[int]:
+    h = HistoryQuestion
+    with engine.connect() as conn:
+        return list(
+            conn.execute(
+                select(h.user_id)
+                .distinct()
+                .where(
+                    h.question_id.in_(qids),
+                    h.subject_id == subject_id,
+                    h.user_id > after,
+                    h.user_id % shards == shard,
+                )
+                .order_by(h.user_id)
+                .limit(limit)
+            ).scalars()
+        )
+
+
+def _load_attempts(qids, subject_id, user_ids) -> List[Dict]:
+    """The users' attempts holding one of the questions, oldest first"""
+    h = HistoryQuestion
+    with engine.connect() as conn:
+        test_ids = sorted(
+            set(
+                conn.execute(
+                    select(h.test_id).where(
+                        h.question_id.in_(qids),
+                        h.subject_id == subject_id,
+                        h.user_id.in_(user_ids),
+                    )
+                ).scalars()
+            )
+        )
+        attempts = []
+        for chunk in _chunks(test_ids):
+            for row in conn.execute(
+                select(
+                    TestHistory.id,
+                    TestHistory.user_id,
+                    TestHistory.score,
+                    TestHistory.completed_at,
+                    TestHistory.questions,
+                ).where(TestHistory.id.in_(chunk))
+            ):
+                attempts.append(
+                    {**row._asdict(), "questions": row.questions or {}, "live": True}
+                )
+
+    live = {a["id"] for a in attempts}
+    archive = maintenance.archive_engine()
+    if archive is not None:
+        t = archived_history.c
+        with archive.connect() as conn:
+            for chunk in _chunks(test_ids):
+                for row in conn.execute(
+                    select(
+                        t.id, t.user_id, t.score, t.completed_at, t.payload
+                    ).where(t.id.in_(chunk))
+                ):
+                    payload = row.payload
+                    attempts.append(
+                        {
+                            "id": row.id,
+                            "user_id": row.user_id,
+                            "score": row.score,
+                            "completed_at": row.completed_at,
+                            "questions": (
+                                json.loads(zlib.decompress(payload)) if payload else {}
+                            ),
+                            "live": False,
+                            # Left behind by an interrupted archive run: the
+                            # live row is the one counted
+                            "copy": row.id in live,
+                        }
+                    )
+    attempts.sort(key=lambda a: (a["completed_at"] or datetime.min, a["id"]))
+    return attempts
+
+
+def _regrade_batch(run_id, user_ids, qids, subject_id, code, keys, dry_run) -> Dict:
+    attempts = _load_attempts(qids, subject_id, user_ids)
+
+    live_updates, archive_updates = [], []
+    outcomes: Dict[int, Dict[str, List[Tuple[bool, bool]]]] = {}
+    score_deltas: Dict[int, List[float]] = {}
+    changed_users = set()
+    counts = dict.fromkeys(COUNTS, 0)
+    for attempt in attempts:
+        changed, score, graded = regrade_payload(attempt["questions"], keys)
+        if attempt.get("copy"):
+            if changed:
+                archive_updates.append({**attempt, "score": score})
+            continue
+
+        user_id = attempt["user_id"]
+        per_text = outcomes.setdefault(user_id, {})
+        for text, was_correct, is_correct in graded:
+            per_text.setdefault(text, []).append((was_correct, is_correct))
+        if not changed:
+            continue
+
+        flipped = sum(1 for _, was, now in graded if was != now)
+        if flipped:
+            counts["attempts_changed"] += 1
+            counts["results_changed"] += flipped
+            changed_users.add(user_id)
+        delta = score - (attempt["score"] or 0.0) if score is not None else 0.0
+        deltas = score_deltas.setdefault(user_id, [0.0, 0.0])
+        deltas[0] += delta
+        if attempt["live"]:
+            live_updates.append({**attempt, "score": score})
+        else:
+            deltas[1] += delta
+            archive_updates.append({**attempt, "score": score})
+    counts["users_changed"] = len(changed_users)
+
+    penalty_deltas, review_flips = {}, {}
+    for user_id, per_text in outcomes.items():
+        deltas = {
+            text: _fold(now for _, now in pairs) - _fold(was for was, _ in pairs)
+            for text, pairs in per_text.items()
+        }
+        deltas = {text: delta for text, delta in deltas.items() if delta}
+        if deltas:
+            penalty_deltas[user_id] = deltas
+        # Attempts are oldest first: the last pair is the user's latest answer
+        flips = {
+            text: pairs[-1][1]
+            for text, pairs in per_text.items()
+            if pairs[-1][0] != pairs[-1][1]
+        }
+        if flips:
+            review_flips[user_id] = flips
+
+    if not dry_run:
+        _write_batch(
+            run_id,
+            user_ids[-1],
+            code,
+            subject_id,
+            live_updates,
+            archive_updates,
+            score_deltas,
+            penalty_deltas,
+            review_flips,
+            counts,
+        )
+    return counts
+
+
+def _write_batch(
+    run_id,
+    last_user_id,
+    code,
+    subject_id,
+    live_updates,
+    archive_updates,
+    score_deltas,
+    penalty_deltas,
+    review_flips,
+    counts,
+):
+    with _write_engine().begin() as conn:
+        for attempt in live_updates:
+            updated = conn.execute(
+                TestHistory.__table__.update()
+                .where(TestHistory.id == attempt["id"])
+                .values(score=attempt["score"], questions=attempt["questions"])
+            ).rowcount
+            if not updated:
+                raise _Moved(attempt["id"])
+        for attempt in archive_updates:
+            data = json.dumps(attempt["questions"]).encode("utf-8")
+            conn.execute(
+                archived_history.update()
+                .where(archived_history.c.id == attempt["id"])
+                .values(
+                    score=attempt["score"],
+                    payload=zlib.compress(data, COMPRESS_LEVEL),
+                )
+            )
+
+        for user_id, (total, archived) in score_deltas.items():
+            if total or archived:
+                conn.execute(
+                    UserStats.__table__.update()
+                    .where(UserStats.user_id == user_id)
+                    .values(
+                        score_total=func.coalesce(UserStats.score_total, 0) + total,
+                        archived_score=func.coalesce(UserStats.archived_score, 0)
+                        + archived,
+                        updated_at=datetime.now(),
+                    )
+                )
+
+        # Users whose rows or attempts change; see User.__mapper_args__
+        rewritten = {a["user_id"] for a in live_updates + archive_updates}
+        rewritten.update(penalty_deltas)
+        if rewritten:
+            conn.execute(
+                User.__table__.update()
+                .where(User.id.in_(sorted(rewritten)))
+                .values(results_version=func.coalesce(User.results_version, 0) + 1)
+            )
+
+        if penalty_deltas:
+            rows = conn.execute(
+                select(User.id, User.penalty_questions).where(
+                    User.id.in_(list(penalty_deltas))
+                )
+            ).all()
+            for user_id, penalty_questions in rows:
+                penalty_questions = penalty_questions or {}
+                penalties = penalty_questions.setdefault(code, {})
+                for text, delta in penalty_deltas[user_id].items():
+                    penalty = penalties.get(text, 0) + delta
+                    if penalty > 0:
+                        penalties[text] = penalty
+                    else:
+                        penalties.pop(text, None)
+                conn.execute(
+                    User.__table__.update()
+                    .where(User.id == user_id)
+                    .values(penalty_questions=penalty_questions)
+                )
+
+        now = datetime.now()
+        for user_id, flips in review_flips.items():
+            spaced_repetition.regrade(conn, user_id, subject_id, flips, now)
+
+        r = RegradeRun
+        conn.execute(
+            r.__table__.update()
+            .where(r.id == run_id)
+            .values(
+                last_user_id=last_user_id,
+                updated_at=datetime.now(),
+                **{name: getattr(r, name) + counts[name] for name in COUNTS},
+            )
+        )
+
+
+def _start_shard(key, subject_id, shard, shards) -> Tuple[int, int, bool]:
+    """Id, last user id and finished flag of the shard's progress row"""
+    r = RegradeRun
+    with engine.begin() as conn:
+        conn.execute(
+            insert(r)
+            .values(
+                run_key=key,
+                subject_id=subject_id,
+                shard=shard,
+                shards=shards,
+                last_user_id=0,
+                users_changed=0,
+                attempts_changed=0,
+                results_changed=0,
+            )
+            .on_conflict_do_nothing()
+        )
+        row = conn.execute(
+            select(r.id, r.last_user_id, r.finished_at).where(
+                r.run_key == key, r.shard == shard, r.shards == shards
+            )
+        ).one()
+    return row.id, row.last_user_id or 0, row.finished_at is not None
+
+
+def run_shard(
+    subject_id: int,
+    keys: Dict[str, List[str]],
+    key: str,
+    shard: int = 0,
+    shards: int = 1,
+    batch_users: int = BATCH_USERS,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """Regrade the users of one shard, after the last batch it committed"""
+    qids = sorted({question_id(text) for text in keys})
+    with engine.connect() as conn:
+        code = conn.execute(
+            select(Subject.code).where(Subject.id == subject_id)
+        ).scalar()
+    if dry_run:
+        run_id, after = None, 0
+    else:
+        run_id, after, finished = _start_shard(key, subject_id, shard, shards)
+        if finished:
+            return _shard_counts(run_id)
+
+    totals = dict.fromkeys(COUNTS, 0)
+    while True:
+        user_ids = _affected_users(qids, subject_id, shard, shards, after, batch_users)
+        if not user_ids:
+            break
+        for attempt in range(RETRIES):
+            try:
+                counts = _regrade_batch(
+                    run_id, user_ids, qids, subject_id, code, keys, dry_run
+                )
+                break
+            except _Moved as e:
+                if attempt == RETRIES - 1:
+                    raise
+                logger.info(f"Test {e} was archived meanwhile, retrying its batch")
+        for name in COUNTS:
+            totals[name] += counts[name]
+        after = user_ids[-1]
+
+    if dry_run:
+        return totals
+    with engine.begin() as conn:
+        conn.execute(
+            RegradeRun.__table__.update()
+            .where(RegradeRun.id == run_id)
+            .values(finished_at=datetime.now(), updated_at=datetime.now())
+        )
+    return _shard_counts(run_id)
+
+
+def _shard_counts(run_id: int) -> Dict[str, int]:
+    r = RegradeRun
+    with engine.connect() as conn:
+        row = conn.execute(
+            select(*(getattr(r, name) for name in COUNTS)).where(r.id == run_id)
+        ).one()
+    return dict(zip(COUNTS, row))
+
+
+def _init_worker():
+    # Connections inherited from the parent must not be used by the children
+    engine.dispose(close=False)
+    archive = maintenance.archive_engine()
+    if archive is not None:
+        archive.dispose(close=False)
+
+
+def regrade(
+    subject_id: int,
+    keys: Dict[str, List[str]],
+    key: str,
+    shards: Sequence[int],
+    shard_count: int,
+    workers: int = 1,
+    batch_users: int = BATCH_USERS,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """Run ``shards`` out of ``shard_count``, on up to ``workers`` processes"""
+    args = [
+        (subject_id, keys, key, shard, shard_count, batch_users, dry_run)
+        for shard in shards
+    ]
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(args)), initializer=_init_worker
+        ) as pool:
+            results = list(pool.map(run_shard, *zip(*args)))
+    else:
+        results = [run_shard(*a) for a in args]
+    return {name: sum(r[name] for r in results) for name in COUNTS}
+
+
+def _run(args) -> int:
+    subject = get_subject(args.subject)
+    if subject is None:
+        print(f"Subject {args.subject} not found", file=sys.stderr)
+        return 1
+
+    new_path = args.new or os.path.join("data", "bank", subject.data_file)
+    try:
+        old = (
+            parse_bank(args.old)
+            if args.old
+            else bank_at_revision(args.rev, subject.data_file)
+        )
+        new = parse_bank(new_path)
+    except subprocess.CalledProcessError as e:
+        print(e.stderr.decode(errors="replace").strip(), file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    keys, added, removed = diff_keys(old, new)
+    print(
+        f"{subject.code}: {len(keys)} keys changed, "
+        f"{added} questions added, {removed} removed"
+    )
+    if not keys:
+        return 0
+
+    started = time.perf_counter()
+    indexed = update_index()
+    print(f"Indexed {indexed} new attempts in {time.perf_counter() - started:.1f}s")
+
+    shard_count = args.shards or args.workers
+    if args.shard is not None and not 0 <= args.shard < shard_count:
+        print(f"--shard must be below --shards ({shard_count})", file=sys.stderr)
+        return 1
+    shards = [args.shard] if args.shard is not None else range(shard_count)
+    key = run_key(subject.code, keys)
+
+    started = time.perf_counter()
+    totals = regrade(
+        subject.id,
+        keys,
+        key,
+        shards,
+        shard_count,
+        args.workers,
+        args.batch_users,
+        args.dry_run,
+    )
+    print(
+        f"{'Would change' if args.dry_run else f'Run {key} changed'} "
+        f"{totals['users_changed']} users, {totals['attempts_changed']} attempts "
+        f"and {totals['results_changed']} answers "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+    return 0
+
+
+def _status() -> int:
+    r = RegradeRun
+    with engine.connect() as conn:
+        rows = conn.execute(
+            select(*r.__table__.c, Subject.code)
+            .outerjoin(Subject, Subject.id == r.subject_id)
+            .order_by(r.created_at, r.run_key, r.shard)
+        ).all()
+    for row in rows:
+        state = (
+            f"finished {row.finished_at:%Y-%m-%d %H:%M}"
+            if row.finished_at
+            else f"after user {row.last_user_id}"
+        )
+        print(
+            f"{row.run_key} {row.code} shard {row.shard}/{row.shards}: {state}, "
+            f"{row.users_changed} users, {row.attempts_changed} attempts, "
+            f"{row.results_changed} answers"
+        )
+    if not rows:
+        print("No regrade runs")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("index", help="Index the attempts added since the last run")
+    run = commands.add_parser("run", help="Regrade a subject after a key change")
+    run.add_argument("--subject", required=True)
+    old = run.add_mutually_exclusive_group(required=True)
+    old.add_argument("--old", help="Bank file before the change")
+    old.add_argument("--rev", help="Git revision of the bank before the change")
+    run.add_argument("--new", help="Bank file after the change (default: current)")
+    run.add_argument("--workers", type=int, default=1)
+    run.add_argument("--shards", type=int, help="Shard count (default: --workers)")
+    run.add_argument("--shard", type=int, help="Only run this shard")
+    run.add_argument("--batch-users", type=int, default=BATCH_USERS)
+    run.add_argument("--dry-run", action="store_true")
+    commands.add_parser("status", help="Show the progress of regrade runs")
+    args = parser.parse_args(argv)
+
+    if args.command == "index":
+        started = time.perf_counter()
+        indexed = update_index()
+        print(f"Indexed {indexed} new attempts in {time.perf_counter() - started:.1f}s")
+        return 0
+    if args.command == "status":
+        return _status()
+    return _run(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,394 @@
+"""Full-text search over the questions of every bank.
+
+Question text, options and correct answers of every subject are copied into
+a separate SQLite database next to ``quiz.db`` (``quiz-search.db``), with an
+FTS5 index over the text and options. The index is external-content: the
+``questions`` table holds the rows and triggers keep ``questions_fts`` in
+step with its inserts and deletes.
+
+Updates are incremental. Each bank's (mtime, size) is recorded, and a bank
+that changed is diffed against the indexed rows by a digest of each
+question's content: new questions are inserted, removed or edited ones
+deleted, and questions that only moved get their new position, which is not
+indexed. Editing a few questions of a large bank rewrites those questions
+only.
+
+Admins search at ``/admin/search?q=...``, which returns ranked (BM25, text
+weighted over options), paginated JSON. A search that finds a bank newer
+than its index queues an update job and flags the bank as stale.
+
+Usage:
+    python -m utils.search update              # index banks that changed
+    python -m utils.search update --rebuild --optimize
+    python -m utils.search query "gradient descent" --subject AIL303m
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import create_engine, event, select
+
+from . import jobs
+from .models import Subject, db_path, engine
+from .shared_bank import file_lock
+
+logger = logging.getLogger(__name__)
+
+SEARCH_PATH = f"{os.path.splitext(db_path)[0]}-search.db"
+PER_PAGE = 20
+MAX_PER_PAGE = 100
+UPDATE_DELAY = 30.0
+# BM25 weights of the subject, text and options columns
+WEIGHTS = (0.0, 10.0, 1.0)
+SNIPPET_TOKENS = 16
+# Options and answers may span lines; the tokenizer splits words on this too
+SEPARATOR = "\x1f"
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS banks (
+        subject TEXT PRIMARY KEY,
+        mtime_ns INTEGER,
+        size INTEGER,
+        questions INTEGER NOT NULL,
+        updated_at TEXT NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY,
+        subject TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        digest INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        options TEXT NOT NULL,
+        answers TEXT NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_questions_subject ON questions (subject)",
+    """CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+        subject, text, options,
+        content='questions', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS questions_ai AFTER INSERT ON questions BEGIN
+        INSERT INTO questions_fts (rowid, subject, text, options)
+        VALUES (new.id, new.subject, new.text, new.options);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS questions_ad AFTER DELETE ON questions BEGIN
+        INSERT INTO questions_fts (questions_fts, rowid, subject, text, options)
+        VALUES ('delete', old.id, old.subject, old.text, old.options);
+    END""",
+)
+
+_search_engine = None
+_last_scheduled = 0.0
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def search_engine():
+    """Engine of the search database, created with its schema on first use"""
+    global _search_engine
+    if _search_engine is None:
+        search = create_engine(f"sqlite:///{SEARCH_PATH}")
+
+        @event.listens_for(search, "connect")
+        def _pragmas(dbapi_connection, connection_record):
+            dbapi_connection.execute("PRAGMA journal_mode=WAL")
+            dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+
+        with search.begin() as conn:
+            for statement in SCHEMA:
+                conn.exec_driver_sql(statement)
+        _search_engine = search
+    return _search_engine
+
+
+def _digest(text: str, options: str, answers: str) -> int:
+    data = f"{text}\0{options}\0{answers}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little") >> 1
+
+
+def _row(question) -> Tuple[str, str, str]:
+    return (
+        question.text,
+        SEPARATOR.join(question.contents),
+        SEPARATOR.join(question.answer_list()),
+    )
+
+
+def _subject_files() -> Dict[str, str]:
+    with engine.connect() as conn:
+        rows = conn.execute(select(Subject.code, Subject.data_file)).all()
+    return {code: os.path.join("data", "bank", data_file) for code, data_file in rows}
+
+
+def _file_version(path: str) -> Optional[Tuple[int, int]]:
+    # The same (mtime, size) as QuizHandler.bank_version
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _indexed_versions(conn) -> Dict[str, Tuple[int, int]]:
+    rows = conn.exec_driver_sql("SELECT subject, mtime_ns, size FROM banks")
+    return {subject: (mtime_ns, size) for subject, mtime_ns, size in rows}
+
+
+def stale_subjects() -> List[str]:
+    """Subjects whose bank file changed since it was indexed (stat calls only)"""
+    with search_engine().connect() as conn:
+        indexed = _indexed_versions(conn)
+    stale = []
+    for code, path in sorted(_subject_files().items()):
+        version = _file_version(path)
+        if version is not None and indexed.get(code) != version:
+            stale.append(code)
+    return stale
+
+
+def _update_subject(conn, code: str, bank, version) -> Dict[str, int]:
+    existing: Dict[int, List[Tuple[int, int]]] = {}
+    for row_id, digest, position in conn.exec_driver_sql(
+        "SELECT id, digest, position FROM questions WHERE subject = ?", (code,)
+    ):
+        existing.setdefault(digest, []).append((row_id, position))
+
+    inserts, moves = [], []
+    for position, question in enumerate(bank):
+        text, options, answers = _row(question)
+        digest = _digest(text, options, answers)
+        matches = existing.get(digest)
+        if matches:
+            row_id, old_position = matches.pop()
+            if old_position != position:
+                moves.append((position, row_id))
+        else:
+            inserts.append((code, position, digest, text, options, answers))
+    deletes = [(row_id,) for rows in existing.values() for row_id, _ in rows]
+
+    if deletes:
+        conn.exec_driver_sql("DELETE FROM questions WHERE id = ?", deletes)
+    if moves:
+        conn.exec_driver_sql("UPDATE questions SET position = ? WHERE id = ?", moves)
+    if inserts:
+        conn.exec_driver_sql(
+            "INSERT INTO questions (subject, position, digest, text, options, answers)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            inserts,
+        )
+    conn.exec_driver_sql(
+        "INSERT OR REPLACE INTO banks (subject, mtime_ns, size, questions, updated_at)"
+        " VALUES (?, ?, ?, ?, ?)",
+        (code, version[0], version[1], len(bank), datetime.now().isoformat()),
+    )
+    return {
+        "inserted": len(inserts),
+        "deleted": len(deletes),
+        "moved": len(moves),
+        "unchanged": len(bank) - len(inserts) - len(moves),
+    }
+
+
+def _remove_subject(conn, code: str):
+    conn.exec_driver_sql("DELETE FROM questions WHERE subject = ?", (code,))
+    conn.exec_driver_sql("DELETE FROM banks WHERE subject = ?", (code,))
+
+
+def update(
+    subject_codes: Optional[Sequence[str]] = None,
+    rebuild: bool = False,
+    optimize: bool = False,
+) -> Dict[str, Dict[str, int]]:
+    """Index the banks that changed; return what changed per subject"""
+    from .quiz_handler import QuizHandler
+
+    search = search_engine()
+    files = _subject_files()
+    changes = {}
+    with file_lock(SEARCH_PATH):
+        with search.begin() as conn:
+            if rebuild:
+                # Dropping is much faster than deleting row by row through
+                # the index triggers
+                for table in ("questions_fts", "questions", "banks"):
+                    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {table}")
+                for statement in SCHEMA:
+                    conn.exec_driver_sql(statement)
+            indexed = _indexed_versions(conn)
+            for code in set(indexed) - set(files):
+                _remove_subject(conn, code)
+                changes[code] = {"removed": 1}
+
+        for code in sorted(files):
+            if subject_codes and code not in subject_codes:
+                continue
+            if indexed.get(code) == _file_version(files[code]) and not rebuild:
+                continue
+            handler = QuizHandler(code)
+            if handler.bank_version is None:
+                logger.warning(f"Bank of {code} could not be read, index left as is")
+                continue
+            start = time.perf_counter()
+            with search.begin() as conn:
+                changes[code] = _update_subject(
+                    conn, code, handler.questions, handler.bank_version
+                )
+            logger.info(
+                f"Indexed {code} in {time.perf_counter() - start:.2f}s: "
+                + ", ".join(f"{k}={v}" for k, v in changes[code].items())
+            )
+
+        if optimize:
+            with search.begin() as conn:
+                conn.exec_driver_sql(
+                    "INSERT INTO questions_fts (questions_fts) VALUES ('optimize')"
+                )
+    return changes
+
+
+def match_query(text: str, subject_code: Optional[str] = None) -> str:
+    """FTS5 query from user input: words and "quoted phrases", all required
+
+    A word ending in ``*`` matches as a prefix. Everything else is quoted, so
+    input can't inject FTS5 syntax.
+    """
+    terms = []
+    for phrase, word in _TERM.findall(text):
+        term = phrase if phrase else word
+        prefix = not phrase and term.endswith("*")
+        term = term.rstrip("*") if prefix else term
+        if term.strip():
+            terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise ValueError("Empty search query")
+    query = "{text options} : (" + " ".join(terms) + ")"
+    if subject_code:
+        query = 'subject : "' + subject_code.replace('"', '""') + '" AND ' + query
+    return query
+
+
+def search(
+    text: str,
+    subject_code: Optional[str] = None,
+    page: int = 1,
+    per_page: int = PER_PAGE,
+) -> Dict[str, Any]:
+    """One page of the questions matching ``text``, best match first"""
+    query = match_query(text, subject_code)
+    per_page = min(max(per_page, 1), MAX_PER_PAGE)
+    page = max(page, 1)
+    with search_engine().connect() as conn:
+        total = conn.exec_driver_sql(
+            "SELECT count(*) FROM questions_fts WHERE questions_fts MATCH ?", (query,)
+        ).scalar()
+        # Rank ids only; the rows and snippets are read for this page alone
+        ranked = conn.exec_driver_sql(
+            f"SELECT rowid, bm25(questions_fts, {', '.join(map(str, WEIGHTS))}) AS s"
+            " FROM questions_fts WHERE questions_fts MATCH ?"
+            " ORDER BY s LIMIT ? OFFSET ?",
+            (query, per_page, (page - 1) * per_page),
+        ).all()
+        rows = {}
+        if ranked:
+            ids = ", ".join(str(row_id) for row_id, _ in ranked)
+            for row in conn.exec_driver_sql(
+                "SELECT q.id, q.subject, q.position, q.text, q.options, q.answers,"
+                f" snippet(questions_fts, 1, '«', '»', '…', {SNIPPET_TOKENS})"
+                " FROM questions_fts JOIN questions q ON q.id = questions_fts.rowid"
+                f" WHERE questions_fts MATCH ? AND questions_fts.rowid IN ({ids})",
+                (query,),
+            ):
+                rows[row[0]] = row
+
+    results = []
+    for row_id, score in ranked:
+        if row_id not in rows:
+            continue
+        _, subject, position, question, options, answers, snippet = rows[row_id]
+        results.append(
+            {
+                "subject": subject,
+                "position": position,
+                "text": question,
+                "snippet": snippet,
+                "options": options.split(SEPARATOR) if options else [],
+                "correct_answers": answers.split(SEPARATOR) if answers else [],
+                "score": round(-score, 4),
+            }
+        )
+    return {
+        "query": text,
+        "subject": subject_code,
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "pages": -(-total // per_page),
+        "results": results,
+    }
+
+
+@jobs.job("update_search_index")
+def _update_job():
+    update()
+
+
+def schedule_update():
+    """Queue an index update, at most once per UPDATE_DELAY in this process"""
+    global _last_scheduled
+    now = time.monotonic()
+    if now - _last_scheduled < UPDATE_DELAY:
+        return
+    _last_scheduled = now
+    jobs.enqueue("update_search_index")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Full-text search over question banks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    update_cmd = sub.add_parser("update", help="Index banks that changed")
+    update_cmd.add_argument("--subject", action="append", dest="subjects")
+    update_cmd.add_argument("--rebuild", action="store_true", help="Index everything")
+    update_cmd.add_argument(
+        "--optimize", action="store_true", help="Merge the index into one segment"
+    )
+    query_cmd = sub.add_parser("query", help="Search the index")
+    query_cmd.add_argument("text")
+    query_cmd.add_argument("--subject")
+    query_cmd.add_argument("--page", type=int, default=1)
+    query_cmd.add_argument("--per-page", type=int, default=10)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "update":
+        changes = update(args.subjects, args.rebuild, args.optimize)
+        for code, counts in sorted(changes.items()):
+            print(f"{code}: " + ", ".join(f"{k}={v}" for k, v in counts.items()))
+        if not changes:
+            print("Index is up to date")
+        return 0
+
+    try:
+        start = time.perf_counter()
+        result = search(args.text, args.subject, args.page, args.per_page)
+        elapsed = time.perf_counter() - start
+    except ValueError as e:
+        print(e)
+        return 1
+    print(
+        f"{result['total']} matches, page {result['page']}/{result['pages']}"
+        f" ({elapsed * 1000:.1f} ms)"
+    )
+    for hit in result["results"]:
+        print(
+            f"{hit['score']:8.3f} {hit['subject']}#{hit['position']}: {hit['snippet']}"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
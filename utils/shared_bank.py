@@ -0,0 +1,224 @@
+"""Question banks serialized once into a memory-mapped segment shared by all processes.
+
+Enabled with ``EOS_SHARED_BANKS=1`` (``serve.py --shared-banks``). Instead of
+every worker holding its own list of question dicts, each bank is written once
+to ``instance/banks/<code>.bank`` and mapped read-only by every process. Pages
+come from the OS page cache, so the bank costs the same memory for one worker
+or twenty. Questions are decoded from the segment only when a request touches
+them; the question texts (needed for bag and penalty bookkeeping) are decoded
+once per process.
+
+Segment layout (little endian)::
+
+    header     magic, format, stale flag, count, generation,
+               source mtime/size, offsets of the texts and records blobs
+    offsets    count + 1 uint64 record offsets, relative to the records blob
+    texts      every question text, UTF-8, NUL separated
+    records    one JSON array per question (Question.record())
+
+When the CSV changes, a new segment is written next to the old one and
+atomically renamed over it, then the stale flag of the old segment is set.
+Processes holding the old mapping see the flag on their next access and map
+the new file; requests already using the old mapping keep a valid view.
+"""
+
+import json
+import os
+import struct
+import threading
+from collections.abc import Sequence
+from contextlib import contextmanager
+from mmap import ACCESS_READ, mmap
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .models import instance_path
+from .question import Question
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+MAGIC = b"EOSBANK\0"
+FORMAT = 2
+HEADER = struct.Struct("<8sBBxxIQqqQQ")
+STALE_OFFSET = 9
+
+SEGMENT_DIR = os.path.join(instance_path, "banks")
+
+_open: Dict[str, "SharedQuestionBank"] = {}
+_open_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("EOS_SHARED_BANKS", "") in ("1", "true")
+
+
+class SharedQuestionBank(Sequence):
+    """Read-only, zero-copy view of a bank segment"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+        (
+            magic,
+            fmt,
+            _stale,
+            self._count,
+            self.generation,
+            mtime_ns,
+            size,
+            texts_offset,
+            records_offset,
+        ) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError(f"{path} is not a question bank segment")
+
+        self.source_version = (mtime_ns, size) if size >= 0 else None
+        view = memoryview(self._mm)
+        self._offsets = view[HEADER.size : texts_offset].cast("Q")
+        self._texts_range = (texts_offset, records_offset)
+        self._records_offset = records_offset
+        self._texts: Optional[List[str]] = None
+        self._index: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("question index out of range")
+        start = self._records_offset + self._offsets[i]
+        end = self._records_offset + self._offsets[i + 1]
+        return Question.from_record(json.loads(self._mm[start:end]))
+
+    @property
+    def stale(self) -> bool:
+        return self._mm[STALE_OFFSET] != 0
+
+    @property
+    def version(self):
+        return self.source_version
+
+    @property
+    def texts(self) -> List[str]:
+        if self._texts is None:
+            start, end = self._texts_range
+            blob = self._mm[start:end].decode("utf-8")
+            self._texts = blob.split("\0") if self._count else []
+        return self._texts
+
+    def index_of(self, text: str) -> Optional[int]:
+        if self._index is None:
+            index = {}
+            for i, t in enumerate(self.texts):
+                index.setdefault(t, i)
+            self._index = index
+        return self._index.get(text)
+
+
+def write_segment(
+    path: str,
+    questions: List[Question],
+    source_version: Optional[Tuple[int, int]],
+    generation: int = 1,
+):
+    """Serialize ``questions`` into a new segment and atomically replace ``path``"""
+    records, offsets, position = [], [], 0
+    for question in questions:
+        record = json.dumps(
+            question.record(), ensure_ascii=False, separators=(",", ":")
+        )
+        record = record.encode("utf-8")
+        offsets.append(position)
+        records.append(record)
+        position += len(record)
+    offsets.append(position)
+
+    texts = "\0".join(q.text.replace("\0", "") for q in questions).encode("utf-8")
+    texts_offset = HEADER.size + 8 * len(offsets)
+    records_offset = texts_offset + len(texts)
+    mtime_ns, size = source_version if source_version else (0, -1)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                MAGIC,
+                FORMAT,
+                0,
+                len(questions),
+                generation,
+                mtime_ns,
+                size,
+                texts_offset,
+                records_offset,
+            )
+        )
+        f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        f.write(texts)
+        for record in records:
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+
+    old = None
+    if os.path.exists(path):
+        old = open(path, "r+b")
+    os.replace(tmp_path, path)
+    if old is not None:
+        with old:
+            old.seek(STALE_OFFSET)
+            old.write(b"\1")
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive lock on ``<path>.lock`` shared by every process on the host"""
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def segment_path(subject_code: str) -> str:
+    return os.path.join(SEGMENT_DIR, f"{subject_code}.bank")
+
+
+def open_bank(
+    subject_code: str,
+    source_version: Optional[Tuple[int, int]],
+    load: Callable[[], List[Question]],
+) -> SharedQuestionBank:
+    """Map the subject's segment, (re)building it from ``load()`` when out of date"""
+    bank = _open.get(subject_code)
+    if bank is not None and not bank.stale and bank.source_version == source_version:
+        return bank
+
+    with _open_lock:
+        path = segment_path(subject_code)
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        with file_lock(path):
+            try:
+                bank = SharedQuestionBank(path)
+            except (FileNotFoundError, ValueError):
+                bank = None
+
+            if bank is None or bank.source_version != source_version:
+                generation = bank.generation + 1 if bank is not None else 1
+                write_segment(path, load(), source_version, generation)
+                bank = SharedQuestionBank(path)
+
+        _open[subject_code] = bank
+        return bank
@@ -0,0 +1,324 @@
+"""SM-2 spaced repetition of questions, per user and subject.
+
+Every graded answer updates the question's ``review_items`` row with the SM-2
+rules: a correct answer moves the next review 1, 6, then ``interval * ease``
+days out, a wrong or missing answer brings the question back after
+``LAPSE_INTERVAL`` and lowers its ease.
+
+initialize_quiz puts the user's most overdue questions first. Each process
+keeps the due times of a (user, subject) in a ``ReviewQueue`` heap, so
+taking the k most overdue of n questions is O(k log n). Heap entries are
+invalidated lazily: a review pushes the new due time and the older entry of
+the same question is dropped when it surfaces. A queue is loaded from the
+table on first use and reloaded when the user's latest ``reviewed_at`` (an
+index lookup) shows another process reviewed since.
+
+Users from before the scheduler only have penalty counters. The first time
+their queue is needed or a quiz of theirs is recorded, every penalty question
+without a review item becomes one that is overdue by one hour per penalty
+point, with its ease lowered accordingly, so the most penalized questions
+still come first. A ``penalty_migrations`` row marks the (user, subject) as
+done, so items created by grading first don't stop the rest being seeded.
+"""
+
+import heapq
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from .analytics import question_id
+from .models import PenaltyMigration, ReviewItem
+
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+FIRST_INTERVAL = 1.0  # days
+SECOND_INTERVAL = 6.0
+LAPSE_INTERVAL = 10 / (24 * 60)
+PASSING_QUALITY = 3
+PENALTY_EASE_STEP = 0.2
+MAX_QUEUES = 1000
+MAX_MIGRATED = 100_000
+
+_queues: "OrderedDict[Tuple[int, int], ReviewQueue]" = OrderedDict()
+# (user, subject) pairs known to be migrated, to skip the flag lookup
+_migrated = set()
+_bank_ids: Dict[str, Tuple[object, Dict[int, int]]] = {}
+_lock = threading.Lock()
+
+
+def quality(result: Dict) -> int:
+    """SM-2 response quality (0-5) of a graded question result"""
+    if result.get("is_correct"):
+        return 4
+    return 0 if result.get("is_unanswered") else 1
+
+
+def review(item: ReviewItem, quality: int, now: datetime):
+    """Apply one SM-2 review to ``item``"""
+    ease = item.ease or INITIAL_EASE
+    if quality >= PASSING_QUALITY:
+        repetitions = item.repetitions or 0
+        if repetitions == 0:
+            interval = FIRST_INTERVAL
+        elif repetitions == 1:
+            interval = SECOND_INTERVAL
+        else:
+            interval = (item.interval or FIRST_INTERVAL) * ease
+        item.repetitions = repetitions + 1
+    else:
+        interval = LAPSE_INTERVAL
+        item.repetitions = 0
+        item.lapses = (item.lapses or 0) + 1
+    miss = 5 - quality
+    item.ease = max(MIN_EASE, ease + 0.1 - miss * (0.08 + miss * 0.02))
+    item.interval = interval
+    item.due_at = now + timedelta(days=interval)
+    item.reviewed_at = now
+
+
+class ReviewQueue:
+    """Due times of a user's review items in one subject, in a heap"""
+
+    def __init__(self, due: Dict[int, float], version: Optional[datetime]):
+        self.due = due
+        self.heap = [(ts, qid) for qid, ts in due.items()]
+        heapq.heapify(self.heap)
+        self.version = version
+
+    def push(self, qid: int, ts: float):
+        self.due[qid] = ts
+        heapq.heappush(self.heap, (ts, qid))
+        if len(self.heap) > 2 * len(self.due) + 64:
+            self.heap = [(ts, qid) for qid, ts in self.due.items()]
+            heapq.heapify(self.heap)
+
+    def overdue(
+        self, now: float, count: int, accept: Optional[Callable[[int], bool]] = None
+    ) -> List[int]:
+        """Up to ``count`` question ids due at ``now``, most overdue first"""
+        taken, seen, skipped = [], set(), []
+        while self.heap and len(taken) < count and self.heap[0][0] <= now:
+            ts, qid = heapq.heappop(self.heap)
+            if self.due.get(qid) != ts or qid in seen:
+                continue  # superseded by a later review
+            seen.add(qid)
+            (taken if accept is None or accept(qid) else skipped).append(qid)
+        for qid in taken + skipped:
+            heapq.heappush(self.heap, (self.due[qid], qid))
+        return taken
+
+
+def _latest_review(db, user_id: int, subject_id: int) -> Optional[datetime]:
+    return db.execute(
+        select(func.max(ReviewItem.reviewed_at)).where(
+            ReviewItem.user_id == user_id, ReviewItem.subject_id == subject_id
+        )
+    ).scalar()
+
+
+def migrate_penalties(
+    db, user_id: int, subject_id: int, penalty_questions: Dict[str, int], now
+):
+    """Seed review items from the legacy penalty counters, once per subject
+
+    Only questions without a review item are seeded. The flag row is inserted
+    first, so a concurrent migration of the same pair waits on the write lock
+    and then finds it done. Pairs are remembered only once their flag is
+    found stored, as the caller's transaction may still roll back.
+    """
+    key = (user_id, subject_id)
+    with _lock:
+        if key in _migrated:
+            return
+    if db.get(PenaltyMigration, key) is not None:
+        with _lock:
+            if len(_migrated) >= MAX_MIGRATED:
+                _migrated.clear()
+            _migrated.add(key)
+        return
+    flagged = db.execute(
+        insert(PenaltyMigration)
+        .values(user_id=user_id, subject_id=subject_id, migrated_at=now)
+        .on_conflict_do_nothing()
+    ).rowcount
+    if flagged and penalty_questions:
+        _seed_penalties(db, user_id, subject_id, penalty_questions, now)
+
+
+def _seed_penalties(
+    db, user_id: int, subject_id: int, penalty_questions: Dict[str, int], now
+):
+    existing = set(
+        db.scalars(
+            select(ReviewItem.question_id).where(
+                ReviewItem.user_id == user_id, ReviewItem.subject_id == subject_id
+            )
+        )
+    )
+    items = {}
+    for text, penalty in penalty_questions.items():
+        qid = question_id(text)
+        if qid in existing:
+            continue
+        penalty = max(int(penalty or 0), 1)
+        items[qid] = ReviewItem(
+            user_id=user_id,
+            subject_id=subject_id,
+            question_id=qid,
+            ease=max(MIN_EASE, INITIAL_EASE - PENALTY_EASE_STEP * penalty),
+            interval=0.0,
+            repetitions=0,
+            lapses=penalty,
+            due_at=now - timedelta(hours=penalty),
+            reviewed_at=now,
+        )
+    db.add_all(items.values())
+    db.flush()
+
+
+def _queue(db, user_id: int, subject_id: int, penalty_questions) -> ReviewQueue:
+    migrate_penalties(db, user_id, subject_id, penalty_questions, datetime.now())
+    version = _latest_review(db, user_id, subject_id)
+
+    key = (user_id, subject_id)
+    with _lock:
+        queue = _queues.get(key)
+        if queue is not None and queue.version == version:
+            _queues.move_to_end(key)
+            return queue
+
+    rows = db.execute(
+        select(ReviewItem.question_id, ReviewItem.due_at).where(
+            ReviewItem.user_id == user_id, ReviewItem.subject_id == subject_id
+        )
+    )
+    queue = ReviewQueue({qid: due_at.timestamp() for qid, due_at in rows}, version)
+    with _lock:
+        _queues[key] = queue
+        while len(_queues) > MAX_QUEUES:
+            _queues.popitem(last=False)
+    return queue
+
+
+def bank_ids(subject_code: str, version, texts: Sequence[str]) -> Dict[int, int]:
+    """Question id -> bank index, built once per bank version"""
+    cached = _bank_ids.get(subject_code)
+    if cached is None or cached[0] != version:
+        ids = {}
+        for i, text in enumerate(texts):
+            ids.setdefault(question_id(text), i)
+        cached = _bank_ids[subject_code] = (version, ids)
+    return cached[1]
+
+
+def due_indexes(
+    db,
+    user_id: int,
+    subject_id: int,
+    ids: Dict[int, int],
+    penalty_questions: Dict[str, int],
+    count: int,
+    now: Optional[datetime] = None,
+) -> List[int]:
+    """Bank indexes of the user's most overdue questions, at most ``count``"""
+    queue = _queue(db, user_id, subject_id, penalty_questions)
+    now = now or datetime.now()
+    with _lock:
+        qids = queue.overdue(now.timestamp(), count, ids.__contains__)
+    return [ids[qid] for qid in qids]
+
+
+def record(
+    db,
+    user_id: int,
+    subject_id: int,
+    results: Iterable[Dict],
+    penalty_questions: Dict[str, int],
+    now: Optional[datetime] = None,
+):
+    """Review every graded question of a quiz, in the caller's transaction"""
+    now = now or datetime.now()
+    migrate_penalties(db, user_id, subject_id, penalty_questions, now)
+    qualities = {
+        question_id(r["question"]): quality(r)
+        for r in results
+        if isinstance(r.get("question"), str)
+    }
+    if not qualities:
+        return
+    items = {
+        item.question_id: item
+        for item in db.scalars(
+            select(ReviewItem).where(
+                ReviewItem.user_id == user_id,
+                ReviewItem.subject_id == subject_id,
+                ReviewItem.question_id.in_(list(qualities)),
+            )
+        )
+    }
+    for qid, q in qualities.items():
+        item = items.get(qid)
+        if item is None:
+            item = ReviewItem(
+                user_id=user_id,
+                subject_id=subject_id,
+                question_id=qid,
+                ease=INITIAL_EASE,
+                interval=0.0,
+                repetitions=0,
+                lapses=0,
+            )
+            db.add(item)
+            items[qid] = item
+        review(item, q, now)
+
+    with _lock:
+        queue = _queues.get((user_id, subject_id))
+        if queue is not None:
+            for qid in qualities:
+                queue.push(qid, items[qid].due_at.timestamp())
+            queue.version = now
+
+
+def regrade(conn, user_id: int, subject_id: int, outcomes: Dict[str, bool], now):
+    """Review again the questions whose latest result a regrade flipped
+
+    ``outcomes`` maps question texts to their corrected result. SM-2 state
+    can't be replayed, so each item gets one review with that result as of
+    ``now``: a question the user did answer right stops being drilled, one
+    they got wrong comes back soon. Runs on a Core connection, in the
+    regrade's transaction.
+    """
+    t = ReviewItem.__table__
+    results = {question_id(text): correct for text, correct in outcomes.items()}
+    rows = conn.execute(
+        select(t).where(
+            t.c.user_id == user_id,
+            t.c.subject_id == subject_id,
+            t.c.question_id.in_(list(results)),
+        )
+    ).mappings()
+    for row in rows.all():
+        item = SimpleNamespace(**row)
+        review(item, quality({"is_correct": results[item.question_id]}), now)
+        conn.execute(
+            t.update()
+            .where(
+                t.c.user_id == user_id,
+                t.c.subject_id == subject_id,
+                t.c.question_id == item.question_id,
+            )
+            .values(
+                ease=item.ease,
+                interval=item.interval,
+                repetitions=item.repetitions,
+                lapses=item.lapses,
+                due_at=item.due_at,
+                reviewed_at=item.reviewed_at,
+            )
+        )
@@ -0,0 +1,174 @@
+"""Request-scoped unit of work for users and their progress.
+
+Within a unit of work every QuizHandler shares one session, each user is
+loaded once (with their active quiz) and kept in the session's identity map,
+and all writes are flushed in a single commit when the unit of work ends.
+Outside of one, QuizHandler keeps committing after every change as before.
+
+A bounded, process-wide cache maps usernames to user ids so that repeated
+lookups go through the primary key instead of the username.
+"""
+
+import contextvars
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, sessionmaker
+
+from .models import User, engine
+
+Session = sessionmaker(bind=engine)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_bulk_write(orm_execute_state):
+    # Query.delete()/update() don't show up in session.new/dirty/deleted
+    if orm_execute_state.is_delete or orm_execute_state.is_update:
+        orm_execute_state.session.info["eos_writes"] = True
+
+
+@event.listens_for(Session, "after_flush")
+def _note_flush(session, flush_context):
+    # Flushed objects (a new user, autoflushed changes) leave new/dirty/deleted
+    session.info["eos_writes"] = True
+
+
+class UserIdCache:
+    """Thread-safe LRU mapping of username to user id"""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[int]:
+        with self._lock:
+            user_id = self._data.get(username)
+            if user_id is not None:
+                self._data.move_to_end(username)
+            return user_id
+
+    def put(self, username: str, user_id: int):
+        with self._lock:
+            self._data[username] = user_id
+            self._data.move_to_end(username)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, username: str):
+        with self._lock:
+            self._data.pop(username, None)
+
+
+user_ids = UserIdCache()
+
+
+class UserContext:
+    def __init__(self):
+        self.session = Session()
+        self._users: Dict[str, User] = {}
+
+    def get_user(self, username: str) -> User:
+        """Return the user, loading it (and its active quiz) at most once"""
+        user = self._users.get(username)
+        if user is not None:
+            return user
+
+        user_id = user_ids.get(username)
+        if user_id is not None:
+            user = self.session.get(
+                User, user_id, options=[joinedload(User.active_quiz)]
+            )
+            if user is None or user.username != username:
+                user_ids.discard(username)
+                user = None
+        if user is None:
+            user = (
+                self.session.query(User)
+                .options(joinedload(User.active_quiz))
+                .filter_by(username=username)
+                .first()
+            )
+        if user is None:
+            user = User(username=username, question_bag={}, penalty_questions={})
+            self.session.add(user)
+            self.session.flush()
+
+        user_ids.put(username, user.id)
+        self._users[username] = user
+        return user
+
+    @property
+    def has_changes(self) -> bool:
+        session = self.session
+        return bool(
+            session.new
+            or session.dirty
+            or session.deleted
+            or session.info.get("eos_writes")
+        )
+
+    def commit(self):
+        """Flush every pending write in one transaction"""
+        if self.has_changes:
+            self.session.commit()
+        else:
+            self.session.rollback()
+        self.session.info.pop("eos_writes", None)
+
+    def close(self):
+        self.session.close()
+        self._users.clear()
+
+
+_current: contextvars.ContextVar[Optional[UserContext]] = contextvars.ContextVar(
+    "eos_user_context", default=None
+)
+
+
+def current() -> Optional[UserContext]:
+    return _current.get()
+
+
+@contextmanager
+def unit_of_work():
+    """Run the block in a UserContext, committing once at the end"""
+    context = UserContext()
+    token = _current.set(context)
+    try:
+        yield context
+        context.commit()
+    finally:
+        _current.reset(token)
+        context.close()
+
+
+def init_app(app):
+    """Open a UserContext per request, commit it before the response is sent"""
+    from flask import request
+
+    @app.before_request
+    def open_user_context():
+        request.environ["eos.user_context"] = _current.set(UserContext())
+
+    @app.after_request
+    def commit_user_context(response):
+        context = _current.get()
+        if context is not None and "eos.user_context" in request.environ:
+            context.commit()
+        return response
+
+    @app.teardown_request
+    def close_user_context(exc=None):
+        token = request.environ.pop("eos.user_context", None)
+        if token is None:
+            return
+        context = _current.get()
+        _current.reset(token)
+        if context is not None:
+            if exc is not None:
+                context.session.rollback()
+            context.close()